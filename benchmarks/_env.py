@@ -0,0 +1,55 @@
+"""Environment for benchmarks.
+
+config.py is read on import and wants a telegram token and a GLPI server that
+answers. Benchmarks never talk to real services, so they point config to a
+local stand-in and keep DATA_DIR in a temporary directory.
+"""
+import os
+import tempfile
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _HeadHandler(BaseHTTPRequestHandler):
+    """Answers 200 to the availability check made by config.py"""
+
+    def do_HEAD(self) -> None:  # pylint: disable=invalid-name
+        """ Reply to HEAD request """
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format: str, *args: typing.Any) -> None:  # pylint: disable=redefined-builtin
+        return
+
+
+def serve(handler: typing.Type[BaseHTTPRequestHandler]) -> str:
+    """Start http server in a daemon thread
+
+    Args:
+        handler (typing.Type[BaseHTTPRequestHandler]): request handler
+
+    Returns:
+        str: GLPI_BASE_URL pointing to the server
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/apirest.php/"
+
+
+def prepare(glpi_base_url: typing.Optional[str] = None) -> str:
+    """Set environment variables read by config.py. Call it before importing bot
+
+    Args:
+        glpi_base_url (typing.Optional[str]): GLPI stand-in. Defaults to a server that only answers HEAD.
+
+    Returns:
+        str: DATA_DIR
+    """
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:benchmark")
+    os.environ["GLPI_BASE_URL"] = glpi_base_url or serve(_HeadHandler)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    data_dir: str = tempfile.mkdtemp(prefix="glpi-bench-") + "/"
+    os.environ["DATA_DIR"] = data_dir
+    return data_dir
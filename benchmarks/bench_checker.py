@@ -0,0 +1,311 @@
+"""End-to-end benchmark of the checker against a simulated GLPI.
+
+A local HTTP server plays GLPI: it answers initSession, killSession, ticket
+search, getMultipleItems and solution sub-items from an in-memory set of
+tickets. Every GLPI user has its own telegram user. Before every measured
+cycle a share of tickets (churn) changes status and date_mod. run_cycle of the
+checker queues notifications, and notifier.sender delivers them to a stub
+instead of Telegram.
+
+For every population it prints the mean cycle time, GLPI requests per cycle,
+peak python memory of one cycle (tracemalloc) and the p95 lag from the change
+to the delivery. The server runs in the same process, so it competes with the
+checker for the GIL: compare numbers of one machine and one revision with
+another, not with production.
+
+Usage:
+    python -m benchmarks.bench_checker --users 1000 10000 50000 --churn 0.01
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import typing
+import unittest.mock
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+from benchmarks import _env
+
+GLPI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class World:
+    """Tickets of the simulated GLPI"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # ticket id -> [requester glpi id, status, name, date_mod]
+        self.tickets: typing.Dict[int, typing.List] = {}
+        self.by_requester: typing.Dict[int, typing.List[int]] = {}
+
+    def populate(self, users: int, tickets_per_user: int, seed: int) -> None:
+        """ Create tickets of every glpi user """
+        rnd = random.Random(seed)
+        with self.lock:
+            self.tickets.clear()
+            self.by_requester.clear()
+            ticket_id: int = 1
+            for glpi_id in range(1, users + 1):
+                for _ in range(tickets_per_user):
+                    self.tickets[ticket_id] = [
+                        glpi_id,
+                        rnd.randint(1, 4),
+                        f"ticket {ticket_id}",
+                        "2020-01-01 10:00:00",
+                    ]
+                    self.by_requester.setdefault(glpi_id, []).append(ticket_id)
+                    ticket_id += 1
+
+    def churn(self, share: float, rnd: random.Random) -> int:
+        """ Change status and date_mod of a share of tickets, return their number """
+        now: str = time.strftime(GLPI_DATE_FORMAT)
+        with self.lock:
+            changed: typing.List[int] = rnd.sample(
+                list(self.tickets), int(len(self.tickets) * share)
+            )
+            for ticket_id in changed:
+                ticket = self.tickets[ticket_id]
+                ticket[1] = rnd.choice([status for status in range(1, 6) if status != ticket[1]])
+                ticket[3] = now
+        return len(changed)
+
+
+WORLD = World()
+
+
+class GLPIHandler(BaseHTTPRequestHandler):
+    """Just enough of GLPI REST API for the checker"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: typing.Any) -> None:  # pylint: disable=redefined-builtin
+        return
+
+    def _reply(self, status: int, body: typing.Any) -> None:
+        data: bytes = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self) -> None:  # pylint: disable=invalid-name
+        """ Availability check of config.py """
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """ Route GLPI call """
+        url = urllib.parse.urlsplit(self.path)
+        parts: typing.List[str] = url.path.split("/apirest.php/", 1)[-1].strip("/").split("/")
+        query: typing.Dict[str, str] = dict(urllib.parse.parse_qsl(url.query))
+        if parts[0] == "initSession":
+            login: str = base64.b64decode(
+                self.headers["Authorization"].split(" ", 1)[1]
+            ).decode().split(":", 1)[0]
+            self._reply(200, {"session_token": login})
+        elif parts[0] == "killSession":
+            self._reply(200, True)
+        elif parts[0] == "search":
+            self._search(query)
+        elif parts[0] == "getMultipleItems":
+            self._multiple_items(query)
+        elif parts[0].lower() == "ticket" and len(parts) == 3:
+            self._sub_items(int(parts[1]), parts[2], query)
+        else:
+            self._reply(400, ["ERROR", f"not simulated: {url.path}"])
+
+    def _range(self, query: typing.Dict[str, str], rows: typing.List) -> typing.Optional[typing.List]:
+        start, end = (int(value) for value in query.get("range", "0-49").split("-"))
+        if start > 0 and start >= len(rows):
+            self._reply(400, ["ERROR_RANGE_EXCEED_TOTAL", "range exceeds total"])
+            return None
+        return rows[start : end + 1]
+
+    def _search(self, query: typing.Dict[str, str]) -> None:
+        field: str = query.get("criteria[0][field]", "")
+        with WORLD.lock:
+            if field == "4":
+                ids = WORLD.by_requester.get(int(query["criteria[0][value]"]), [])
+            else:
+                since: str = query.get("criteria[0][value]", "")
+                ids = sorted(
+                    (ticket_id for ticket_id, ticket in WORLD.tickets.items() if ticket[3] > since),
+                    key=lambda ticket_id: WORLD.tickets[ticket_id][3],
+                )
+            rows = [
+                {
+                    "2": ticket_id,
+                    "1": WORLD.tickets[ticket_id][2],
+                    "12": WORLD.tickets[ticket_id][1],
+                    "19": WORLD.tickets[ticket_id][3],
+                    "4": WORLD.tickets[ticket_id][0],
+                }
+                for ticket_id in ids
+            ]
+        page = self._range(query, rows)
+        if page is not None:
+            self._reply(200, {"totalcount": len(rows), "data": page})
+
+    def _multiple_items(self, query: typing.Dict[str, str]) -> None:
+        items: typing.List[typing.Dict] = []
+        with WORLD.lock:
+            for key, value in query.items():
+                if not key.endswith("[items_id]"):
+                    continue
+                _, status, name, date_mod = WORLD.tickets[int(value)]
+                items.append({"id": int(value), "status": status, "name": name, "date_mod": date_mod})
+        self._reply(200, items)
+
+    def _sub_items(self, ticket_id: int, sub_itemtype: str, query: typing.Dict[str, str]) -> None:
+        rows: typing.List[typing.Dict] = []
+        if sub_itemtype.lower() == "itilsolution":
+            rows = [{"id": ticket_id, "content": f"&lt;p&gt;Solution of {ticket_id}&lt;/p&gt;"}]
+        page = self._range(query, rows)
+        if page is not None:
+            self._reply(200, page)
+
+
+_env.prepare(_env.serve(GLPIHandler))
+
+# pylint: disable=wrong-import-position
+import bot.app.checker as checker  # noqa: E402
+import bot.app.notifier as notifier  # noqa: E402
+from bot.db.dbhelper import DBHelper  # noqa: E402
+from bot.db.outbox import Outbox  # noqa: E402
+from bot.db.sqlitehelper import SQLiteHelper  # noqa: E402
+from bot.db.storage import Storage  # noqa: E402
+from bot.metrics import LAG, METRICS  # noqa: E402
+import config  # noqa: E402
+
+
+async def send_stub(chat_id: int, text: str, **kwargs: typing.Any) -> None:
+    """ Replaces Bot.send_message """
+    METRICS.count("bench.sent")
+
+
+def fresh_storage() -> Storage:
+    """Empty storage in a new directory: a population does not see users,
+    snapshots and checker state of the previous one. vedis if it is
+    STORAGE_BACKEND, SQLite otherwise (no Redis server is needed)"""
+    directory: str = tempfile.mkdtemp(dir=os.path.dirname(config.SQLITE_FILE))
+    if config.STORAGE_BACKEND == "vedis":
+        return DBHelper(
+            os.path.join(directory, "db.db"),
+            cache_size=config.DB_CACHE_SIZE,
+            batch_window=config.DB_BATCH_WINDOW if config.DB_BATCH_WINDOW >= 0 else None,
+        )
+    return SQLiteHelper(os.path.join(directory, "db.sqlite3"))
+
+
+async def create_users(storage: Storage, users: int) -> None:
+    """ One logged in telegram user for every glpi user """
+    for glpi_id in range(1, users + 1):
+        await storage.set_data(
+            chat=glpi_id,
+            user=glpi_id,
+            data={
+                "login": f"user{glpi_id}",
+                "password": "secret",
+                "glpi_id": glpi_id,
+                "logged_in": True,
+            },
+        )
+
+
+async def drain(outbox: Outbox, timeout: float) -> None:
+    """ Wait until the sender empties the outbox """
+    deadline: float = time.monotonic() + timeout
+    while len(outbox.pending()) > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def bench(args: argparse.Namespace, users: int) -> typing.Dict[str, float]:
+    """ Run the checker over a population and collect the numbers """
+    rnd = random.Random(args.seed)
+    WORLD.populate(users, args.tickets, args.seed)
+    storage: Storage = fresh_storage()
+    await create_users(storage, users)
+    outbox = Outbox(config.OUTBOX_DIR)
+    sender = asyncio.ensure_future(notifier.sender(outbox, storage))
+
+    # The first cycle only fills the snapshots
+    await checker.run_cycle(storage, outbox, None, None)
+    await drain(outbox, args.timeout)
+    METRICS.summaries.clear()
+    METRICS.counters.clear()
+
+    changed: int = 0
+    for cycle in range(args.cycles + 1):
+        changed += WORLD.churn(args.churn, rnd)
+        if cycle == args.cycles:
+            tracemalloc.start()
+        await checker.run_cycle(storage, outbox, None, None)
+        if cycle == args.cycles:
+            peak: int = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        await drain(outbox, args.timeout)
+    sender.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await sender
+    await storage.close()
+
+    cycles: int = args.cycles + 1
+    return {
+        "users": users,
+        # The traced cycle is slower, it is not counted
+        "cycle_s": METRICS.summaries["cycle"].total
+        - METRICS.summaries["cycle"].samples[-1],
+        "requests": METRICS.summaries["cycle_glpi_requests"].total / cycles,
+        "peak_mb": peak / 2 ** 20,
+        "changed": changed / cycles,
+        "sent": METRICS.counters["bench.sent"] / cycles,
+        "lag_p95_s": METRICS.summaries[LAG].percentile(0.95) if LAG in METRICS.summaries else 0.0,
+    }
+
+
+def main() -> int:
+    """ Entry point """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--tickets", type=int, default=5, help="tickets per user")
+    parser.add_argument("--churn", type=float, default=0.01, help="share of tickets changed per cycle")
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="max wait for delivery, s")
+    args = parser.parse_args()
+
+    # Back-to-back cycles: nobody counts as checked recently, Telegram is not throttled
+    checker.CHECK_PERIOD = 0
+    notifier.NOTIFY_GLOBAL_RATE = notifier.NOTIFY_CHAT_RATE = 1e9
+    notifier.OUTBOX_POLL_PERIOD = 0.01
+
+    print(
+        f"{'users':>7} {'cycle, s':>9} {'requests':>9} {'peak, MB':>9}"
+        f" {'changed':>8} {'sent':>7} {'lag p95, s':>11}"
+    )
+    loop = asyncio.get_event_loop()
+    with unittest.mock.patch.object(notifier.bot, "send_message", send_stub):
+        for users in args.users:
+            row = loop.run_until_complete(bench(args, users))
+            print(
+                f"{row['users']:>7} {row['cycle_s'] / args.cycles:>9.2f} {row['requests']:>9.0f}"
+                f" {row['peak_mb']:>9.1f} {row['changed']:>8.0f} {row['sent']:>7.0f}"
+                f" {row['lag_p95_s']:>11.2f}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
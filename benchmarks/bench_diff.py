@@ -0,0 +1,170 @@
+"""Equivalence check and benchmark of the diff engines.
+
+Both check_diff and check_diff_vectorized get the same synthetic snapshots:
+once without arrays of a glpi user (cold) and once for the next cycle, when
+arrays of the previous snapshot are kept. The arrays are used at every size
+(MIN_TICKETS is 0), so the speedup below MIN_TICKETS shows why it is there.
+The script stops with an error if their (messages, proposed_solutions,
+closed_tickets) or have_changes differ, and prints time of every engine.
+
+Usage:
+    python -m benchmarks.bench_diff --sizes 1000 10000 50000 --churn 0.05
+"""
+import argparse
+import copy
+import random
+import sys
+import time
+import typing
+
+from benchmarks import _env
+
+_env.prepare()
+
+# pylint: disable=wrong-import-position
+from bot.app.ticket_diff import Diff, add_fingerprints, check_diff  # noqa: E402
+from bot.app import vector_diff  # noqa: E402
+from bot.app.vector_diff import VectorDiff  # noqa: E402
+
+
+class StubSession:
+    """Replaces UserSession: no GLPI requests"""
+
+    @staticmethod
+    def get_last_solutions(ticket_ids: typing.List[int]) -> typing.Dict[int, str]:
+        """ Fake solution texts """
+        return {ticket_id: f"solution {ticket_id}" for ticket_id in ticket_ids}
+
+
+def next_snapshot(
+    old: typing.Dict[int, typing.Dict], churn: float, rnd: random.Random, first_id: int
+) -> typing.Dict[int, typing.Dict]:
+    """Snapshot of the next poll: some tickets are changed, removed and added
+
+    Args:
+        old (typing.Dict[int, typing.Dict]): snapshot of the previous poll
+        churn (float): share of changed, added and removed tickets
+        rnd (random.Random): random source
+        first_id (int): id of the first added ticket
+
+    Returns:
+        typing.Dict[int, typing.Dict]: new snapshot with fingerprints
+    """
+    new: typing.Dict[int, typing.Dict] = copy.deepcopy(old)
+    for ticket in new.values():
+        ticket.pop("fingerprint", None)
+    changed: int = int(len(old) * churn)
+    for ticket_id in rnd.sample(list(new), changed):
+        what: float = rnd.random()
+        if what < 0.2:
+            del new[ticket_id]
+            continue
+        if what < 0.7:
+            new[ticket_id]["status"] = rnd.randint(1, 6)
+        elif what < 0.8:
+            new[ticket_id]["name"] += " (renamed)"
+        new[ticket_id]["date_mod"] = f"2021-01-{rnd.randint(1, 28):02d} 12:00:00"
+    for ticket_id in range(first_id, first_id + changed // 5):
+        new[ticket_id] = {
+            "status": 1,
+            "name": f"ticket {ticket_id}",
+            "date_mod": "2021-01-01 12:00:00",
+        }
+    add_fingerprints(new)
+    return new
+
+
+def make_snapshots(
+    size: int, churn: float, seed: int
+) -> typing.Tuple[
+    typing.Dict[int, typing.Dict], typing.Dict[int, typing.Dict], typing.Dict[int, typing.Dict]
+]:
+    """Ticket snapshots of one user saved before and polled in two next cycles
+
+    Args:
+        size (int): number of tickets
+        churn (float): share of changed, added and removed tickets
+        seed (int): random seed
+
+    Returns:
+        typing.Tuple[...]: old, new and the one after new
+    """
+    rnd = random.Random(seed)
+    old: typing.Dict[int, typing.Dict] = {}
+    for ticket_id in rnd.sample(range(1, size * 4), size):
+        old[ticket_id] = {
+            "status": rnd.randint(1, 6),
+            "name": f"ticket {ticket_id}",
+            "date_mod": f"2020-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 10:00:00",
+        }
+    add_fingerprints(old)
+    for ticket_id in rnd.sample(list(old), max(1, size // 100)):
+        del old[ticket_id]["fingerprint"]  # snapshots from older versions
+    new: typing.Dict[int, typing.Dict] = next_snapshot(old, churn, rnd, size * 4)
+    return old, new, next_snapshot(new, churn, rnd, size * 5)
+
+
+def measure(
+    engine: typing.Callable[..., Diff],
+    old: typing.Dict[int, typing.Dict],
+    new: typing.Dict[int, typing.Dict],
+    repeat: int,
+    **kwargs: typing.Any,
+) -> typing.Tuple[float, Diff]:
+    """ Best time of several runs and the result """
+    best: float = float("inf")
+    result: typing.Optional[Diff] = None
+    for _ in range(repeat):
+        started: float = time.perf_counter()
+        result = engine(old, new, user_session=StubSession(), **kwargs)
+        best = min(best, time.perf_counter() - started)
+    assert result is not None
+    return best, result
+
+
+def compare(name: str, expected: Diff, actual: Diff) -> bool:
+    """ Print both results if they differ """
+    if expected == actual:
+        return True
+    print(f"Engines diverge on {name}", file=sys.stderr)
+    print(f"check_diff: {expected}", file=sys.stderr)
+    print(f"check_diff_vectorized: {actual}", file=sys.stderr)
+    return False
+
+
+def main() -> int:
+    """ Entry point """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--churn", type=float, default=0.05)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    vector_diff.MIN_TICKETS = 0
+
+    print(
+        f"{'tickets':>8} {'check_diff, s':>14} {'cold, s':>10} {'speedup':>8}"
+        f" {'check_diff, s':>14} {'next cycle, s':>14} {'speedup':>8}"
+    )
+    for size in args.sizes:
+        old, new, newer = make_snapshots(size, args.churn, args.seed)
+        dict_time, dict_result = measure(check_diff, old, new, args.repeat)
+        engine: VectorDiff = VectorDiff()
+        cold_time, cold_result = measure(engine, old, new, args.repeat)
+        # The cycle that saved new keeps its arrays, the next one compares new with newer
+        measure(engine, old, new, 1, key=1)
+        next_dict_time, next_dict_result = measure(check_diff, new, newer, args.repeat)
+        next_time, next_result = measure(engine, new, newer, args.repeat, key=1)
+        if not compare(f"{size} tickets", dict_result, cold_result) or not compare(
+            f"{size} tickets, next cycle", next_dict_result, next_result
+        ):
+            return 1
+        print(
+            f"{size:>8} {dict_time:>14.4f} {cold_time:>10.4f} {dict_time / cold_time:>8.2f}"
+            f" {next_dict_time:>14.4f} {next_time:>14.4f} {next_dict_time / next_time:>8.2f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
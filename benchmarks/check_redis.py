@@ -0,0 +1,167 @@
+"""Check of RedisHelper and RedisOutbox against a running Redis server.
+
+Keys are written under a separate prefix and deleted at the end, so a server
+of a working bot may be used. The script stops with an error on the first
+result that differs from the expected one.
+
+Usage:
+    redis-server --port 6379 &
+    python -m benchmarks.check_redis --url redis://localhost:6379/15 --users 1200
+"""
+import argparse
+import asyncio
+import sys
+import typing
+import uuid
+
+from bot.db.outbox import LOGOUT
+from bot.db.redishelper import RedisHelper, RedisOutbox
+
+
+def expect(name: str, actual: typing.Any, expected: typing.Any) -> None:
+    """Stop with an error if actual differs from expected
+
+    Args:
+        name (str): what is checked
+        actual (typing.Any): result of RedisHelper
+        expected (typing.Any): correct result
+    """
+    if actual != expected:
+        sys.exit(f"{name}: got {actual!r}, expected {expected!r}")
+    print(f"ok {name}")
+
+
+async def check(storage: RedisHelper, users: int) -> None:
+    """Run every operation of the storage once
+
+    Args:
+        storage (RedisHelper): storage under a temporary prefix
+        users (int): number of users written for the iterators
+    """
+    await storage.set_state(chat=1, user=1, state="MAIN")
+    expect("get_state", await storage.get_state(chat=1, user=1), "MAIN")
+    await storage.set_state(chat=1, user=1, state=None)
+    expect("reset state", await storage.get_state(chat=1, user=1, default="-"), "-")
+
+    await storage.set_data(chat=1, user=1, data={"a": 1, "b": 2})
+    await storage.update_data(chat=1, user=1, data={"c": 3})
+    expect("update_data", await storage.get_data(chat=1, user=1), {"a": 1, "b": 2, "c": 3})
+    expect(
+        "pop_data",
+        await storage.pop_data(chat=1, user=1, keys=("a", "x"), default=""),
+        {"a": 1, "x": ""},
+    )
+    expect("data after pop", await storage.get_data(chat=1, user=1), {"b": 2, "c": 3})
+    expect(
+        "compare_and_update_data, other value",
+        await storage.compare_and_update_data(chat=1, user=1, expected={"b": 0}, data={"d": 4}),
+        False,
+    )
+    expect(
+        "compare_and_update_data, same value",
+        await storage.compare_and_update_data(chat=1, user=1, expected={"b": 2}, data={"d": 4}),
+        True,
+    )
+    expect("data after compare", await storage.get_data(chat=1, user=1), {"b": 2, "c": 3, "d": 4})
+
+    await storage.set_bucket(chat=1, user=1, bucket={"x": 1})
+    await storage.update_bucket(chat=1, user=1, bucket={"y": 2})
+    expect("update_bucket", await storage.get_bucket(chat=1, user=1), {"x": 1, "y": 2})
+
+    for user_id in range(1, users + 1):
+        await storage.update_data(chat=user_id, user=user_id, data={"glpi_id": user_id % 7 + 100})
+    expect(
+        "iter_users",
+        sorted(user_id for batch in storage.iter_users(batch_size=100) for user_id in batch),
+        list(range(1, users + 1)),
+    )
+    index: typing.Dict[int, typing.List[int]] = {
+        glpi_id: [user_id for user_id in range(1, users + 1) if user_id % 7 + 100 == glpi_id]
+        for glpi_id in range(100, 107)
+    }
+    expect("glpi_index", storage.glpi_index(), index)
+    expect("count_glpi_users", storage.count_glpi_users(), len(index))
+    expect(
+        "iter_glpi_index after 103",
+        [item for batch in storage.iter_glpi_index(after=103, batch_size=2) for item in batch],
+        [(glpi_id, index[glpi_id]) for glpi_id in range(104, 107)],
+    )
+    await storage.update_data(chat=1, user=1, data={"glpi_id": None})
+    index[101].remove(1)
+    expect("glpi_index after logout", storage.glpi_index(), index)
+    storage.rebuild_glpi_index()
+    expect("rebuild_glpi_index", storage.glpi_index(), index)
+
+    tickets: typing.Dict[int, typing.Dict] = {
+        ticket_id: {"status": 1, "name": f"ticket {ticket_id}"} for ticket_id in range(1, 301)
+    }
+    storage.write_tickets_glpi(100, tickets)
+    storage.update_tickets_glpi(100, {1: {"status": 2, "name": "ticket 1"}}, deleted=[2, 3])
+    tickets[1]["status"] = 2
+    del tickets[2], tickets[3]
+    expect("all_tickets_glpi", storage.all_tickets_glpi(100), tickets)
+    read: typing.Dict[int, typing.Dict] = {}
+    for batch in storage.iter_tickets_glpi(100, batch_size=50):
+        read.update(batch)
+    expect("iter_tickets_glpi", read, tickets)
+
+    storage.set_checker_state("watermark", "2020-01-01 10:00:00")
+    storage.set_checker_states({"cursor": 5, "polled": {"100": 1.5}})
+    expect("get_checker_state", storage.get_checker_state("watermark"), "2020-01-01 10:00:00")
+    expect(
+        "get_checker_states",
+        storage.get_checker_states(["cursor", "polled", "missing"]),
+        {"cursor": 5, "polled": {"100": 1.5}, "missing": None},
+    )
+
+
+def check_outbox(outbox: RedisOutbox) -> None:
+    """Run every operation of the outbox once
+
+    Args:
+        outbox (RedisOutbox): outbox under a temporary prefix
+    """
+    first: typing.Optional[str] = outbox.put(1, "first", key="k1")
+    second: typing.Optional[str] = outbox.put(2, action=LOGOUT)
+    expect("put repeated key", outbox.put(1, "first", key="k1"), None)
+    expect("pending", outbox.pending(), [first, second])
+    assert first is not None and second is not None
+    entry: typing.Dict = outbox.read(first)
+    expect("read", (entry["user_id"], entry["text"], entry["action"]), (1, "first", "message"))
+    entry["sent_parts"] = 1
+    outbox.update(first, entry)
+    expect("update", outbox.read(first)["sent_parts"], 1)
+    outbox.ack(first)
+    outbox.update(first, entry)
+    expect("update after ack", outbox.pending(), [second])
+    try:
+        outbox.read(first)
+        sys.exit("read after ack: no KeyError")
+    except KeyError:
+        print("ok read after ack")
+    outbox.ack(second)
+    expect("put repeated key after ack", outbox.put(1, "first", key="k1"), None)
+
+
+def main() -> None:
+    """ Parse arguments, check the storage and delete its keys """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="redis://localhost:6379/15", help="Redis server")
+    parser.add_argument("--users", type=int, default=1200, help="users written for the iterators")
+    args = parser.parse_args()
+
+    prefix: str = f"glpibot-check-{uuid.uuid4().hex}:"
+    storage = RedisHelper(args.url, prefix=prefix)
+    try:
+        asyncio.run(check(storage, args.users))
+        check_outbox(RedisOutbox(args.url, key_ttl=60, prefix=prefix))
+    finally:
+        keys: typing.List[str] = list(storage._redis.scan_iter(prefix + "*"))  # pylint: disable=protected-access
+        if len(keys) > 0:
+            storage._redis.delete(*keys)  # pylint: disable=protected-access
+        asyncio.run(storage.close())
+    print("RedisHelper and RedisOutbox: all checks passed")
+
+
+if __name__ == "__main__":
+    main()
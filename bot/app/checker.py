@@ -3,164 +3,139 @@
 import typing
 import logging
 import asyncio
-import aiogram
-from aiogram.dispatcher import FSMContext
+import datetime
+import functools
+import hashlib
+import time
 import aioschedule
-from config import CHECK_PERIOD, GLPI_TICKET_URL
-from bot.app.core import bot
+from config import (
+    CHECK_FEED,
+    CHECK_HISTORY,
+    CHECK_PERIOD,
+    CHECKER_METRICS_FILENAME,
+    DEBOUNCE_PERIOD,
+    DIFF_ENGINE,
+    DIGEST_WINDOW,
+    GLPI_UTC_OFFSET,
+    LAG_SLO,
+    METRICS_PERIOD,
+    NOTIFY_DIGEST,
+    SHADOW_ENGINE,
+)
 import bot.app.keyboard as keyboard
+from bot.app.debounce import Debouncer
+from bot.app.digest import Digest
+from bot.app.shadow import Shadow
+from bot.app.ticket_diff import Diff, add_fingerprints, check_diff
+from bot.app.ticket_history import history_messages, merge_messages
 from bot.db.dbhelper import DBHelper
-from bot.usersession import UserSession, StupidError
+from bot.db.outbox import LOGOUT
+from bot.db.storage import NotificationQueue
+from bot.usersession import UserSession, ServiceSession, REQUESTERS
 from bot.glpi_api import GLPIError
-import bot.app.generic.generic as generic
-
-STATUS = "status"
-
-
-def check_diff(
-    old_ticket_dict: typing.Dict[int, typing.Dict],
-    new_ticket_dict: typing.Dict[int, typing.Dict],
-    user_session: UserSession,
-) -> typing.Tuple[typing.Tuple[typing.Dict, typing.Dict, typing.Dict], bool]:
-    """ Read old data, compare it with the new data, rewrite new data, return diff """
-    logging.info("len(old_ticket_dict) = %s", len(old_ticket_dict))
-    logging.info("len(new_ticket_dict) = %s", len(new_ticket_dict))
-    logging.info("old_ticket_dict = %s", old_ticket_dict)
-    logging.info("new_ticket_dict = %s", new_ticket_dict)
-    # old_ticket_dict: typing.Dict[
-    #     int, typing.Dict[str, typing.Union[None, int, str]]
-    # ] = {ticket["id"]: ticket for ticket in old_tickets_list}
-    # new_ticket_dict: typing.Dict[
-    #     int, typing.Dict[str, typing.Union[None, int, str]]
-    # ] = {ticket["id"]: ticket for ticket in new_tickets_list}
-
-    messages: typing.Dict[int, str] = dict()
-    have_changes: bool = False
-    proposed_solutions = dict()
-    closed_tickets = dict()
-    for ticket_id in old_ticket_dict.keys() | new_ticket_dict.keys():
-        logging.info("got ticket_id %s", ticket_id)
-        logging.info(
-            "in old_ticket_dict: %s, in new_ticket_dict: %s",
-            ticket_id in old_ticket_dict,
-            ticket_id in new_ticket_dict,
+from bot.metrics import METRICS, reporter
+
+WATERMARK = "watermark"
+CURSOR = "cursor"
+POLLED = "polled:"
+LAST_CYCLE = "last_cycle"
+HELD_DIGEST = "digest"
+HELD_DEBOUNCE = "debounce"
+WATERMARK_OVERLAP = 60
+GLPI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def engine_by_name(name: str) -> typing.Callable[..., Diff]:
+    """ Return check_diff or its replacement """
+    if name == "vector":
+        # numpy is imported only when the engine is used
+        from bot.app.vector_diff import (  # pylint: disable=import-outside-toplevel
+            check_diff_vectorized,
         )
-        if ticket_id in old_ticket_dict and ticket_id in new_ticket_dict:
-            for elem in old_ticket_dict[ticket_id]:
-                # logging.info(f"old_ticket_dict[ticket_id] = {old_ticket_dict[ticket_id]}")
-                # logging.info(f"type = {type(old_ticket_dict[ticket_id])} elem = {type(elem)} {elem}")
-                if old_ticket_dict[ticket_id].get(elem, None) != new_ticket_dict[
-                    ticket_id
-                ].get(elem, None):
-                    have_changes = True
-            old_status = old_ticket_dict[ticket_id].get(STATUS, None)
-            new_status = new_ticket_dict[ticket_id].get(STATUS, None)
-            if old_status != new_status:
-                name: str = (
-                    '"' +
-                    str(new_ticket_dict[ticket_id].get("name", None)) + '"'
-                )
-                date_mod: str = str(
-                    new_ticket_dict[ticket_id].get("date_mod", None))
-                # messages[ticket_id] = f"Status: old = {old_status} new = {new_status}"
-                if new_status == 1:  # Новый
-                    messages[ticket_id] = (
-                        f"Ваша заявка с номером <a href=\"{GLPI_TICKET_URL}{ticket_id}\">{ticket_id} {name}</a> пересоздана."
-                        + f" Дата и время назначения: {date_mod}"
-                    )
-                elif new_status == 2:  # В работе (назначена)
-                    messages[ticket_id] = (
-                        f"Ваша заявка с номером <a href=\"{GLPI_TICKET_URL}{ticket_id}\">{ticket_id} {name}</a> назначена."
-                        + f" Дата и время назначения: {date_mod}"
-                    )
-                elif new_status == 3:  # В работе (запланирована)
-                    messages[ticket_id] = (
-                        f"Ваша заявка с номером <a href=\"{GLPI_TICKET_URL}{ticket_id}\">{ticket_id} {name}</a> запланирована."
-                        + f" Дата и время изменения: {date_mod}"
-                    )
-                elif new_status == 4:  # Ожидает ответа от заявителя
-                    messages[ticket_id] = (
-                        f"Ваша заявка с номером <a href=\"{GLPI_TICKET_URL}{ticket_id}\">{ticket_id} {name}</a>"
-                        + f" ожидает ответа от заявителя. Дата и время изменения: {date_mod}"
-                    )
-                elif new_status == 5:  # Решена
-                    solution: str = user_session.get_last_solution(ticket_id)
-                    messages[ticket_id] = (
-                        f"По Вашей заявке с номером <a href=\"{GLPI_TICKET_URL}{ticket_id}\">{ticket_id} {name}</a>"
-                        + f" предложено решение: {solution}.\nДата и время изменения: {date_mod}"
-                    )
-                    proposed_solutions[ticket_id] = messages[ticket_id]
-                    # TODO Add buttons
-                elif new_status == 6:  # Закрыто
-                    messages[ticket_id] = ""
-                    closed_tickets[ticket_id] = messages[ticket_id]
-                    # TODO Add button
-                else:
-                    messages[
-                        ticket_id
-                    ] = f"Status: old = {old_status} new = {new_status}"
-                    logging.error(
-                        "UNKNOWN STATUS: old = %s new = %s", old_status, new_status
-                    )
-                    logging.error("old_ticket = %s",
-                                  old_ticket_dict[ticket_id])
-                    logging.error("new_ticket = %s",
-                                  new_ticket_dict[ticket_id])
-        elif ticket_id in old_ticket_dict and ticket_id not in new_ticket_dict:
-            logging.info("Deleted ticket: %s", old_ticket_dict[ticket_id])
-            # TODO Think about it
-            messages[
-                ticket_id
-            ] = f"Ваша заявка с номером {ticket_id} \"{old_ticket_dict[ticket_id].get('name',None)}\" удалена."
-            have_changes = True
-        elif ticket_id not in old_ticket_dict and ticket_id in new_ticket_dict:
-            logging.info("New ticket %s", new_ticket_dict[ticket_id])
-            # TODO Think about it
-            # messages[ticket_id] = "NEW"
-            have_changes = True
-        elif ticket_id not in old_ticket_dict and ticket_id in new_ticket_dict:
-            logging.error(
-                "Impossible: ticket_id not in old_ticket_dict and ticket_id in new_ticket_dict"
-            )
-            logging.error("ticket_id = %s", ticket_id)
-            logging.error("old_ticket_dict = %s", old_ticket_dict)
-            logging.error("new_ticket_dict = %s", new_ticket_dict)
-            raise StupidError("Never ever can I get here")
-        else:
-            logging.error("Impossible: ELSE")
-            logging.error("ticket_id = %s", ticket_id)
-            logging.error("old_ticket_dict = %s", old_ticket_dict)
-            logging.error("new_ticket_dict = %s", new_ticket_dict)
-            raise StupidError("Never ever can I get here")
-
-        continue
-    logging.info("messages = %s", messages)
-    return (messages, proposed_solutions, closed_tickets), have_changes
-
-
-# def write_diff(dbhelper: DBHelper, replace_ticket_dict, delete_ticket_list):
-#     logging.info("replace_ticket_dict = %s", replace_ticket_dict)
-#     logging.info("delete_ticket_list = %s", delete_ticket_list)
-#     # dbhelper.update_tickets(
-#     #     replace_ticket_dict=replace_ticket_dict, delete_ticket_id=delete_ticket_list
-#     # )
-
-
-async def process_messages(
+
+        return check_diff_vectorized
+    return check_diff
+
+
+@functools.lru_cache(maxsize=None)
+def diff_engine() -> typing.Callable[..., Diff]:
+    """ Return the engine selected in config, wrapped in Shadow if a candidate is set """
+    engine: typing.Callable[..., Diff] = engine_by_name(DIFF_ENGINE)
+    if SHADOW_ENGINE != "":
+        return Shadow(engine, engine_by_name(SHADOW_ENGINE))
+    return engine
+
+
+def notification_key(user_id: int, text: str) -> str:
+    """ Idempotency key of the notification: the same text for the same user """
+    return hashlib.blake2b(
+        f"{user_id}\n{text}".encode("utf8"), digest_size=16
+    ).hexdigest()
+
+
+def glpi_time(date: typing.Optional[str]) -> typing.Optional[float]:
+    """ GLPI date (local time of the server, GLPI_UTC_OFFSET) as unix time """
+    if date is None:
+        return None
+    try:
+        parsed: datetime.datetime = datetime.datetime.strptime(str(date), GLPI_DATE_FORMAT)
+    except ValueError:
+        return None
+    if GLPI_UTC_OFFSET is None:
+        return time.mktime(parsed.timetuple())
+    return parsed.replace(
+        tzinfo=datetime.timezone(datetime.timedelta(hours=GLPI_UTC_OFFSET))
+    ).timestamp()
+
+
+def queue(
+    outbox: NotificationQueue,
+    user_id: int,
+    text: str,
+    reply_markup: typing.Optional[typing.Dict] = None,
+    changed: typing.Optional[float] = None,
+) -> None:
+    """ Put notification to the outbox and count it """
+    name: typing.Optional[str] = outbox.put(
+        user_id,
+        text,
+        reply_markup=reply_markup,
+        key=notification_key(user_id, text),
+        changed=changed,
+    )
+    if name is None:
+        METRICS.count("notifications_repeated")
+        return
+    METRICS.count("notifications")
+    if changed is not None:
+        METRICS.observe("lag_queued", time.time() - changed)
+
+
+def process_messages(
+    outbox: NotificationQueue,
     user_id: int,
     messages: typing.Dict,
     proposed_solutions: typing.Dict,
     closed_tickets: typing.Dict,
+    digest: typing.Optional[Digest] = None,
+    tickets: typing.Optional[typing.Dict[int, typing.Dict]] = None,
 ) -> None:
-    """Sends messages about changed tickets to user
+    """Queues messages about changed tickets for the bot process
 
     Args:
-        user_id ([type]): [description]
-        messages ([type]): [description]
-        proposed_solutions ([type]): [description]
-        closed_tickets ([type]): [description]
+        outbox (NotificationQueue): queue read by the bot process
+        user_id (int): telegram user id
+        messages (typing.Dict): message text for every changed ticket
+        proposed_solutions (typing.Dict): tickets that got a solution
+        closed_tickets (typing.Dict): tickets that were closed
+        digest (typing.Optional[Digest]): holds plain messages instead of queueing them. Defaults to None.
+        tickets (typing.Optional[typing.Dict[int, typing.Dict]]): new snapshots, date_mod is used to
+            measure lag. Defaults to None.
     """
-    # TODO Write proper docstring
+    changed: typing.Dict[int, typing.Optional[float]] = {
+        ticket_id: glpi_time((tickets or {}).get(ticket_id, {}).get("date_mod", None))
+        for ticket_id in messages
+    }
     for ticket_id in proposed_solutions:
         logging.info(
             "proposed_solution: user_id = %s, ticket_id = %s message = %s",
@@ -168,13 +143,13 @@ async def process_messages(
             ticket_id,
             messages[ticket_id],
         )
-        message: aiogram.types.Message = await bot.send_message(
+        queue(
+            outbox,
             user_id,
             messages[ticket_id],
-            reply_markup=keyboard.select_approve_refuse(ticket_id),
+            reply_markup=keyboard.select_approve_refuse(ticket_id).to_python(),
+            changed=changed[ticket_id],
         )
-        logging.info("message = %s %s", message.message_id, message)
-        del messages[ticket_id]
 
     for ticket_id in closed_tickets:
         logging.info(
@@ -183,81 +158,412 @@ async def process_messages(
             ticket_id,
             messages[ticket_id],
         )
-        # await bot.send_message(
+        # outbox.put(
         #     user_id,
         #     f"closed_ticket: {messages[ticket_id]}",
-        #     reply_markup=keyboard.select_repeat_ticket(ticket_id),
+        #     reply_markup=keyboard.select_repeat_ticket(ticket_id).to_python(),
         # )
-        del messages[ticket_id]
 
     for ticket_id in messages:
+        if ticket_id in proposed_solutions or ticket_id in closed_tickets:
+            continue
         logging.info(
             "user_id = %s, ticket_id = %s message = %s",
             user_id,
             ticket_id,
             messages[ticket_id],
         )
-        await bot.send_message(user_id, f"{messages[ticket_id]}")
+        if digest is not None:
+            digest.add(user_id, [f"{messages[ticket_id]}"], changed=changed[ticket_id])
+            continue
+        queue(outbox, user_id, f"{messages[ticket_id]}", changed=changed[ticket_id])
+
+
+def flush_digest(outbox: NotificationQueue, digest: typing.Optional[Digest]) -> None:
+    """ Queues digests of users whose window is over """
+    if digest is None:
+        return
+    for user_id, (texts, changed) in digest.due().items():
+        logging.info("digest: user_id = %s messages = %d", user_id, len(texts))
+        for text in texts:
+            queue(outbox, user_id, text, changed=changed)
+
 
+async def linked_sessions(
+    dbhelper: DBHelper, glpi_id: int, user_ids: typing.List[int]
+) -> typing.List[UserSession]:
+    """Sessions of telegram users that are logged in as the glpi user
 
-async def run_check(dbhelper: DBHelper) -> None:
-    """Check for every user if it has updates"""
-    # TODO add error catch
-    for user_id in dbhelper.all_user():
-        logging.info("checker.run_check: user_id = %s", user_id)
+    Args:
+        dbhelper (DBHelper): storage
+        glpi_id (int): glpi user id
+        user_ids (typing.List[int]): telegram users linked to glpi_id in the index
+
+    Returns:
+        typing.List[UserSession]: logged in sessions, in the order of user_ids
+    """
+    sessions: typing.List[UserSession] = []
+    for user_id in user_ids:
         user_session: UserSession = UserSession(user_id)
         await user_session.create(dbhelper=dbhelper)
-        if not user_session.is_logged_in or user_session.glpi_id is None:
+        if not user_session.is_logged_in or user_session.glpi_id != glpi_id:
             # TODO notify user if he is suddenly unlogged (due password change or else)
             continue
-        old_tickets: typing.Dict[int, typing.Dict] = dbhelper.all_tickets_glpi(
-            user_session.glpi_id
-        )
+        sessions.append(user_session)
+    return sessions
+
+
+def poll_glpi_user(
+    sessions: typing.List[UserSession],
+    old_tickets: typing.Dict[int, typing.Dict],
+    outbox: NotificationQueue,
+) -> typing.Tuple[typing.Optional[UserSession], typing.Dict[int, typing.Dict]]:
+    """Polls tickets with credentials of the first session that still works.
+    Sessions with a wrong password are logged out and removed from the list
+
+    Args:
+        sessions (typing.List[UserSession]): sessions of one glpi user
+        old_tickets (typing.Dict[int, typing.Dict]): last snapshot
+        outbox (NotificationQueue): queue read by the bot process
+
+    Returns:
+        typing.Tuple[typing.Optional[UserSession], typing.Dict[int, typing.Dict]]: session used and new tickets
+    """
+    while len(sessions) > 0:
+        user_session: UserSession = sessions[0]
         try:
-            new_tickets: typing.Dict[int, typing.Dict] = user_session.get_all_my_tickets(
-                open_only=False, full_info=False
-            )
+            return user_session, user_session.poll_my_tickets(known=old_tickets)
         except GLPIError as err:
             # logging.info(err.__dict__)
             error_text = str(err)
             logging.info("error_text = %s", error_text)
-            if "Incorrect username or password" in error_text:
-                await generic.logout(user_id, FSMContext(
-                    storage=dbhelper, chat=user_id, user=user_id))
-                continue
-            else:
+            if "Incorrect username or password" not in error_text:
                 raise
+            # FSM records are written by the bot process only
+            outbox.put(user_session.user_id, action=LOGOUT)
+            sessions.pop(0)
+    return None, {}
+
+
+def save_held(
+    dbhelper: DBHelper,
+    digest: typing.Optional[Digest],
+    debouncer: typing.Optional[Debouncer],
+) -> None:
+    """ Save notifications and changes held in memory """
+    if digest is not None:
+        dbhelper.set_checker_state(HELD_DIGEST, digest.to_state())
+    if debouncer is not None:
+        dbhelper.set_checker_state(HELD_DEBOUNCE, debouncer.to_state())
 
-        logging.debug(
-            "checker.run_check: old_tickets = %d %s", len(
-                old_tickets), old_tickets
+
+def load_held(
+    dbhelper: DBHelper,
+    digest: typing.Optional[Digest],
+    debouncer: typing.Optional[Debouncer],
+) -> None:
+    """ Restore notifications and changes held before the restart """
+    if digest is not None:
+        digest.load_state(dbhelper.get_checker_state(HELD_DIGEST, {}))
+    if debouncer is not None:
+        debouncer.load_state(dbhelper.get_checker_state(HELD_DEBOUNCE, {}))
+
+
+def snapshot_changes(
+    old_tickets: typing.Dict[int, typing.Dict], new_tickets: typing.Dict[int, typing.Dict]
+) -> typing.Tuple[typing.Dict[int, typing.Dict], typing.List[int]]:
+    """Tickets to write and ticket ids to delete, so the stored snapshot becomes new_tickets
+
+    Args:
+        old_tickets (typing.Dict[int, typing.Dict]): stored snapshot
+        new_tickets (typing.Dict[int, typing.Dict]): polled snapshot
+
+    Returns:
+        typing.Tuple[typing.Dict[int, typing.Dict], typing.List[int]]: changed and deleted
+    """
+    changed: typing.Dict[int, typing.Dict] = {
+        ticket_id: ticket
+        for ticket_id, ticket in new_tickets.items()
+        if old_tickets.get(ticket_id, None) != ticket
+    }
+    deleted: typing.List[int] = [
+        ticket_id for ticket_id in old_tickets if ticket_id not in new_tickets
+    ]
+    return changed, deleted
+
+
+def cycle_batches(
+    dbhelper: DBHelper, cursor: typing.Optional[int]
+) -> typing.Iterator[typing.List[typing.Tuple[int, typing.List[int]]]]:
+    """Glpi users in the order of the check: the cycle goes on after the last
+    checked one, so a restart does not start from the beginning
+
+    Args:
+        dbhelper (DBHelper): storage
+        cursor (typing.Optional[int]): last checked glpi user
+
+    Yields:
+        typing.List[typing.Tuple[int, typing.List[int]]]: next batch of glpi users
+            with their telegram users
+    """
+    yield from dbhelper.iter_glpi_index(after=cursor)
+    if cursor is None:
+        return
+    for batch in dbhelper.iter_glpi_index():
+        batch = [(glpi_id, user_ids) for glpi_id, user_ids in batch if glpi_id <= cursor]
+        if len(batch) > 0:
+            yield batch
+        if len(batch) == 0 or batch[-1][0] == cursor:
+            return
+
+
+async def check_glpi_user(
+    dbhelper: DBHelper,
+    outbox: NotificationQueue,
+    engine: typing.Callable[..., Diff],
+    glpi_id: int,
+    user_ids: typing.List[int],
+    digest: typing.Optional[Digest] = None,
+    debouncer: typing.Optional[Debouncer] = None,
+) -> None:
+    """ Poll tickets of one glpi user and queue its updates for all linked telegram users """
+    logging.info("checker.run_check: glpi_id = %s user_ids = %s", glpi_id, user_ids)
+    sessions: typing.List[UserSession] = await linked_sessions(
+        dbhelper, glpi_id, user_ids
+    )
+    old_tickets: typing.Dict[int, typing.Dict] = dbhelper.all_tickets_glpi(glpi_id)
+    user_session, new_tickets = poll_glpi_user(sessions, old_tickets, outbox)
+    dbhelper.set_checker_states({f"{POLLED}{glpi_id}": time.time(), CURSOR: glpi_id})
+    if user_session is None:
+        METRICS.count("glpi_users_without_session")
+        return
+
+    add_fingerprints(new_tickets)
+    logging.debug(
+        "checker.run_check: old_tickets = %d %s", len(
+            old_tickets), old_tickets
+    )
+    logging.debug(
+        "checker.run_check: new_tickets = %d %s", len(
+            new_tickets), new_tickets
+    )
+    old_view, new_view, hidden = old_tickets, new_tickets, False
+    if debouncer is not None:
+        old_view, new_view, hidden = debouncer.apply(glpi_id, old_tickets, new_tickets)
+    # All tickets of the glpi user: the vector engine keeps their arrays for the next cycle
+    messages, have_changes = engine(old_view, new_view, user_session=user_session, key=glpi_id)
+    if have_changes and CHECK_HISTORY:
+        messages = merge_messages(
+            messages, history_messages(old_view, new_view, user_session)
         )
-        logging.debug(
-            "checker.run_check: new_tickets = %d %s", len(
-                new_tickets), new_tickets
+    if have_changes or hidden:
+        METRICS.count("glpi_users_changed")
+        logging.info("checker.run_check: messages = %s", messages)
+        # Queue first: if the checker dies before the write, the repeat is dropped by key
+        for linked in sessions:
+            process_messages(
+                outbox, linked.user_id, *messages, digest=digest, tickets=new_view
+            )
+        flush_digest(outbox, digest)
+        save_held(dbhelper, digest, debouncer)
+        dbhelper.update_tickets_glpi(glpi_id, *snapshot_changes(old_tickets, new_tickets))
+
+
+async def run_check(
+    dbhelper: DBHelper,
+    outbox: NotificationQueue,
+    digest: typing.Optional[Digest] = None,
+    debouncer: typing.Optional[Debouncer] = None,
+    pace: float = 0.0,
+) -> None:
+    """Check every glpi user once and send its updates to all linked telegram users.
+    Glpi users checked less than CHECK_PERIOD ago (before a restart) are skipped.
+    With pace, logins are spread: there are pace seconds between glpi users"""
+    engine: typing.Callable[..., Diff] = diff_engine()
+    for batch in cycle_batches(dbhelper, dbhelper.get_checker_state(CURSOR)):
+        polled: typing.Dict[str, float] = dbhelper.get_checker_states(
+            [f"{POLLED}{glpi_id}" for glpi_id, _ in batch], 0.0
         )
-        messages, have_changes = check_diff(
-            old_tickets, new_tickets, user_session=user_session
+        for glpi_id, user_ids in batch:
+            if time.time() - polled[f"{POLLED}{glpi_id}"] < CHECK_PERIOD:
+                logging.info("checker.run_check: glpi_id = %s is checked recently", glpi_id)
+                METRICS.count("glpi_users_skipped")
+                continue
+            if pace > 0:
+                await asyncio.sleep(pace)
+            try:
+                with METRICS.timer("glpi_user_check"):
+                    await check_glpi_user(
+                        dbhelper, outbox, engine, glpi_id, user_ids, digest, debouncer
+                    )
+            except Exception as err:  # pylint: disable=broad-except
+                # One broken glpi user must not stop the check of the others
+                METRICS.error(err)
+                logging.exception("checker.run_check: glpi_id = %s failed", glpi_id)
+            METRICS.count("glpi_users_checked")
+
+
+def move_watermark(watermark: str, seconds: int) -> str:
+    """ Shift GLPI date by seconds """
+    moved = datetime.datetime.strptime(watermark, GLPI_DATE_FORMAT) + datetime.timedelta(
+        seconds=seconds
+    )
+    return moved.strftime(GLPI_DATE_FORMAT)
+
+
+async def run_check_global(
+    dbhelper: DBHelper,
+    outbox: NotificationQueue,
+    digest: typing.Optional[Digest] = None,
+    debouncer: typing.Optional[Debouncer] = None,
+) -> None:
+    """Read tickets modified since the last check with one search and
+    send the changes to every telegram user that follows the requester"""
+    if dbhelper.count_glpi_users() == 0:
+        logging.info("checker.run_check_global: nobody to notify")
+        return
+    watermark: typing.Optional[str] = dbhelper.get_checker_state(WATERMARK)
+    if watermark is not None and glpi_time(watermark) is None:
+        logging.warning("checker.run_check_global: bad watermark %r is dropped", watermark)
+        watermark = None
+    since: typing.Optional[str] = None
+    if watermark is not None:
+        # Tickets changed during the same second as the watermark might come after the search
+        since = move_watermark(watermark, -WATERMARK_OVERLAP)
+    service_session: ServiceSession = ServiceSession()
+    changed: typing.Dict[int, typing.Dict] = service_session.get_tickets_modified_since(
+        since
+    )
+    held: typing.List[int] = [] if debouncer is None else debouncer.pending()
+    if len(changed) == 0 and len(held) == 0:
+        return
+
+    # Only glpi users that may get a notification are kept from the index
+    wanted: typing.Set[int] = set(held)
+    for ticket in changed.values():
+        wanted.update(ticket[REQUESTERS])
+    index: typing.Dict[int, typing.List[int]] = {
+        glpi_id: user_ids
+        for batch in dbhelper.iter_glpi_index()
+        for glpi_id, user_ids in batch
+        if glpi_id in wanted
+    }
+    by_requester: typing.Dict[int, typing.Dict[int, typing.Dict]] = {}
+    for ticket_id, ticket in changed.items():
+        for requester in ticket.pop(REQUESTERS):
+            if requester in index:
+                by_requester.setdefault(requester, {})[ticket_id] = ticket
+    add_fingerprints(changed)
+    for glpi_id in held:
+        # Held changes are released even if nothing new came for the glpi user
+        if glpi_id in index:
+            by_requester.setdefault(glpi_id, {})
+
+    engine: typing.Callable[..., Diff] = diff_engine()
+    for glpi_id, new_tickets in by_requester.items():
+        all_tickets: typing.Dict[int, typing.Dict] = dbhelper.all_tickets_glpi(glpi_id)
+        old_tickets: typing.Dict[int, typing.Dict] = {
+            ticket_id: all_tickets[ticket_id]
+            for ticket_id in new_tickets
+            if ticket_id in all_tickets
+        }
+        old_view, new_view, hidden = old_tickets, new_tickets, False
+        if debouncer is not None:
+            old_view, new_view, hidden = debouncer.apply(
+                glpi_id, old_tickets, new_tickets, stored=all_tickets
+            )
+        messages, have_changes = engine(old_view, new_view, user_session=service_session)
+        if not have_changes and not hidden:
+            continue
+        if have_changes and CHECK_HISTORY:
+            messages = merge_messages(
+                messages, history_messages(old_view, new_view, service_session)
+            )
+        logging.info(
+            "checker.run_check_global: glpi_id = %s users = %s messages = %s",
+            glpi_id,
+            index[glpi_id],
+            messages,
         )
-        if have_changes:
-            dbhelper.write_tickets_glpi(
-                glpi_id=user_session.glpi_id, data=new_tickets)
-            logging.info("checker.run_check: messages = %s", messages)
-            await process_messages(user_id, *messages)
-
-        # for ticket_id in messages:
-        #     logging.info(
-        #         "checker.run_check: user_id = %s, ticket_id = %s message = %s",
-        #         user_id,
-        #         ticket_id,
-        #         messages[ticket_id],
-        #     )
-        #     await bot.send_message(user_id, f"{messages[ticket_id]}")
-
-
-async def scheduler(dbhelper: DBHelper) -> None:
-    """ Main scheduler for regilar ticket check """
-    aioschedule.every(CHECK_PERIOD).seconds.do(run_check, dbhelper=dbhelper)
+        METRICS.count("glpi_users_changed")
+        for user_id in index[glpi_id]:
+            process_messages(
+                outbox, user_id, *messages, digest=digest, tickets=new_view
+            )
+        flush_digest(outbox, digest)
+        save_held(dbhelper, digest, debouncer)
+        # The feed has only changed tickets: nothing is deleted
+        dbhelper.update_tickets_glpi(glpi_id, snapshot_changes(old_tickets, new_tickets)[0])
+
+    # A ticket without date_mod must not move the watermark: "None" sorts above every date
+    dates: typing.List[str] = [
+        str(ticket["date_mod"])
+        for ticket in changed.values()
+        if glpi_time(ticket.get("date_mod", None)) is not None
+    ]
+    if watermark is not None:
+        dates.append(watermark)
+    if len(dates) > 0:
+        dbhelper.set_checker_state(WATERMARK, max(dates))
+
+
+async def run_cycle(
+    dbhelper: DBHelper,
+    outbox: NotificationQueue,
+    digest: typing.Optional[Digest],
+    debouncer: typing.Optional[Debouncer],
+    pace: float = 0.0,
+) -> None:
+    """ One check; digests that are due are sent even if nothing changed """
+    glpi_requests: int = METRICS.counters["glpi_requests"]
+    try:
+        with METRICS.timer("cycle"):
+            if CHECK_FEED == "global":
+                await run_check_global(dbhelper, outbox, digest, debouncer)
+            else:
+                await run_check(dbhelper, outbox, digest, debouncer, pace=pace)
+            flush_digest(outbox, digest)
+    except Exception as err:
+        METRICS.error(err)
+        raise
+    finally:
+        METRICS.observe("cycle_glpi_requests", METRICS.counters["glpi_requests"] - glpi_requests)
+    engine: typing.Callable[..., Diff] = diff_engine()
+    if isinstance(engine, Shadow):
+        engine.report()
+    save_held(dbhelper, digest, debouncer)
+    dbhelper.set_checker_state(LAST_CYCLE, time.time())
+
+
+async def scheduler(dbhelper: DBHelper, outbox: NotificationQueue) -> None:
+    """Main scheduler for regilar ticket check.
+    It resumes after a restart: held notifications are restored, the first check
+    waits for the period of the last one and spreads the logins over CHECK_PERIOD"""
+    digest: typing.Optional[Digest] = Digest(DIGEST_WINDOW) if NOTIFY_DIGEST else None
+    debouncer: typing.Optional[Debouncer] = (
+        Debouncer(DEBOUNCE_PERIOD) if DEBOUNCE_PERIOD > 0 else None
+    )
+    load_held(dbhelper, digest, debouncer)
+    asyncio.ensure_future(
+        reporter(CHECKER_METRICS_FILENAME, METRICS_PERIOD, LAG_SLO, lag="lag_queued")
+    )
+    last_cycle: typing.Optional[float] = dbhelper.get_checker_state(LAST_CYCLE)
+    if last_cycle is not None:
+        delay: float = min(CHECK_PERIOD, last_cycle + CHECK_PERIOD - time.time())
+        if delay > 0:
+            logging.info("checker.scheduler: first check in %.1f s", delay)
+            await asyncio.sleep(delay)
+    await run_cycle(
+        dbhelper,
+        outbox,
+        digest,
+        debouncer,
+        pace=CHECK_PERIOD / max(1, dbhelper.count_glpi_users()),
+    )
+
+    aioschedule.every(CHECK_PERIOD).seconds.do(
+        run_cycle, dbhelper=dbhelper, outbox=outbox, digest=digest, debouncer=debouncer
+    )
     while True:
         await aioschedule.run_pending()
         await asyncio.sleep(1)
@@ -1,6 +1,5 @@
 """Init variables
 """
-import sys
 import logging
 import typing
 import aiogram
@@ -8,11 +7,50 @@ from aiogram import types
 from aiogram.types import base
 
 import config
-import bot.db.dbhelper as dbhelper
+from bot.db.storage import open_storage
+from bot.app.logger import init_logging
 
 MAX_MESSAGE_LENGTH = 2000
 
 
+def split_message(text: str) -> typing.List[str]:
+    """Splits text into parts that fit into one telegram message.
+    Lines are kept whole when possible"""
+    if len(text) < MAX_MESSAGE_LENGTH:
+        return [text]
+    messages: typing.List[str] = []
+    buffer: str = ""
+    for line in text.split("\n"):
+        line = str.strip(line)
+        if len(buffer + line) <= MAX_MESSAGE_LENGTH:
+            if len(buffer) == 0:
+                buffer = line
+            else:
+                buffer += "\n" + line
+            continue
+        # len(buffer) + line > max_len
+        if len(buffer) > 0:
+            messages.append(buffer)
+        if len(line) < MAX_MESSAGE_LENGTH:
+            buffer = line
+            continue
+
+        # len(line) > max_len
+        buffer = ""
+        while len(line) > MAX_MESSAGE_LENGTH:
+            chunk = str.strip(line[:MAX_MESSAGE_LENGTH])
+            if len(chunk) > 0:
+                messages.append(chunk)
+            line = str.strip(line[MAX_MESSAGE_LENGTH:])
+
+        if len(line) > 0:
+            messages.append(line)
+
+    if len(buffer) > 0:
+        messages.append(buffer)
+    return messages
+
+
 class Bot(aiogram.Bot):
     """
     Base bot class with careful send_message function
@@ -34,43 +72,8 @@ class Bot(aiogram.Bot):
             None,
         ] = None,
     ) -> types.Message:
-        def split_me(text: str) -> typing.List[str]:
-            if len(text) < MAX_MESSAGE_LENGTH:
-                return [text]
-            messages: typing.List[str] = []
-            buffer: str = ""
-            for line in text.split("\n"):
-                line = str.strip(line)
-                if len(buffer + line) <= MAX_MESSAGE_LENGTH:
-                    if len(buffer) == 0:
-                        buffer = line
-                    else:
-                        buffer += "\n" + line
-                    continue
-                # len(buffer) + line > max_len
-                if len(buffer) > 0:
-                    messages.append(buffer)
-                if len(line) < MAX_MESSAGE_LENGTH:
-                    buffer = line
-                    continue
-
-                # len(line) > max_len
-                buffer = ""
-                while len(line) > MAX_MESSAGE_LENGTH:
-                    chunk = str.strip(line[:MAX_MESSAGE_LENGTH])
-                    if len(chunk) > 0:
-                        messages.append(chunk)
-                    line = str.strip(line[MAX_MESSAGE_LENGTH:])
-
-                if len(line) > 0:
-                    messages.append(line)
-
-            if len(buffer) > 0:
-                messages.append(buffer)
-            return messages
-
         logging.info("type(text) = %s text = %s", type(text), text)
-        messages = split_me(text)
+        messages = split_message(text)
         if len(messages) == 0:
             return
         for message in messages[:-1]:
@@ -94,19 +97,15 @@ class Bot(aiogram.Bot):
         )
 
 
-formatter: logging.Formatter = logging.Formatter(
-    fmt="%(asctime)s [%(filename)15s:%(lineno)4s - %(funcName)20s() ] - %(message)s",
-    datefmt="%d-%b-%y %H:%M:%S",
-)
-handler_stdout: logging.Handler = logging.StreamHandler(sys.stdout)
-handler_stdout.setFormatter(formatter)
-handler_file: logging.Handler = logging.FileHandler(
-    filename=config.LOG_FILENAME, mode="a"
-)
-handler_file.setFormatter(formatter)
-logging.getLogger().setLevel(config.LOG_LEVEL)
-logging.getLogger().addHandler(handler_stdout)
-logging.getLogger().addHandler(handler_file)
+init_logging(config.LOG_FILENAME)
 
 bot = Bot(token=config.TELEGRAM_TOKEN,parse_mode="HTML")
-dp = aiogram.Dispatcher(bot, storage=dbhelper.DBHelper(config.DB_FILE))
+# Only the bot writes user records (the checker writes its own state and ticket
+# snapshots), so it may keep them in memory
+dp = aiogram.Dispatcher(
+    bot,
+    storage=open_storage(
+        cache_size=config.DB_CACHE_SIZE,
+        batch_window=config.DB_BATCH_WINDOW if config.DB_BATCH_WINDOW >= 0 else None,
+    ),
+)
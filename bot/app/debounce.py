@@ -0,0 +1,101 @@
+"""Holds status changes of tickets for a while, so a ticket that flaps
+(2 → 4 → 2, 5 → 2) gives one notification about the net change or none
+"""
+import time
+import typing
+
+from bot.app.ticket_diff import STATUS
+from bot.app.ticket_history import LAST_LOG_ID
+
+Views = typing.Tuple[typing.Dict[int, typing.Dict], typing.Dict[int, typing.Dict], bool]
+
+
+class Debouncer:
+    """Status changes held for every glpi user.
+
+    A held ticket keeps the snapshot it had before its first change (baseline).
+    Until the period is over the diff engine sees no change of the ticket,
+    then it compares the baseline with the latest snapshot.
+    """
+
+    def __init__(self, period: int):
+        self.period: int = period
+        # glpi_id -> ticket_id -> (time of the first change, baseline snapshot)
+        self.held: typing.Dict[int, typing.Dict[int, typing.Tuple[float, typing.Dict]]] = {}
+
+    def pending(self) -> typing.List[int]:
+        """ Glpi users that have held tickets """
+        return [glpi_id for glpi_id, held in self.held.items() if len(held) > 0]
+
+    def to_state(self) -> typing.Dict:
+        """ Held tickets as json-friendly dict, to survive a restart """
+        return {
+            str(glpi_id): {
+                str(ticket_id): [since, baseline]
+                for ticket_id, (since, baseline) in held.items()
+            }
+            for glpi_id, held in self.held.items()
+            if len(held) > 0
+        }
+
+    def load_state(self, state: typing.Dict) -> None:
+        """ Restore held tickets saved by to_state """
+        for glpi_id, held in state.items():
+            self.held[int(glpi_id)] = {
+                int(ticket_id): (since, baseline)
+                for ticket_id, (since, baseline) in held.items()
+            }
+
+    def apply(
+        self,
+        glpi_id: int,
+        old_ticket_dict: typing.Dict[int, typing.Dict],
+        new_ticket_dict: typing.Dict[int, typing.Dict],
+        stored: typing.Optional[typing.Dict[int, typing.Dict]] = None,
+        now: typing.Optional[float] = None,
+    ) -> Views:
+        """Snapshots to give to the diff engine instead of the real ones
+
+        Args:
+            glpi_id (int): glpi user id
+            old_ticket_dict (typing.Dict[int, typing.Dict]): old snapshots
+            new_ticket_dict (typing.Dict[int, typing.Dict]): new snapshots
+            stored (typing.Optional[typing.Dict[int, typing.Dict]]): all saved tickets of
+                the glpi user when new_ticket_dict has only the changed ones. Defaults to None.
+            now (typing.Optional[float]): current time. Defaults to None.
+
+        Returns:
+            Views: old view, new view and whether some change is hidden
+        """
+        now = time.time() if now is None else now
+        held = self.held.setdefault(glpi_id, {})
+        old_view: typing.Dict[int, typing.Dict] = dict(old_ticket_dict)
+        new_view: typing.Dict[int, typing.Dict] = dict(new_ticket_dict)
+        hidden: bool = False
+        for ticket_id, ticket in new_ticket_dict.items():
+            if ticket_id not in old_ticket_dict:
+                continue
+            old_ticket: typing.Dict = old_ticket_dict[ticket_id]
+            if ticket_id not in held:
+                if old_ticket.get(STATUS, None) == ticket.get(STATUS, None):
+                    continue
+                held[ticket_id] = (now, old_ticket)
+            since, baseline = held[ticket_id]
+            if now - since >= self.period:
+                del held[ticket_id]
+                old_view[ticket_id] = baseline
+                continue
+            if LAST_LOG_ID in old_ticket and LAST_LOG_ID not in ticket:
+                ticket[LAST_LOG_ID] = old_ticket[LAST_LOG_ID]
+            old_view[ticket_id] = ticket
+            hidden = True
+        for ticket_id in [ticket_id for ticket_id in held if ticket_id not in new_ticket_dict]:
+            since, baseline = held[ticket_id]
+            if stored is None or ticket_id not in stored:
+                # Removed: the engine reports it from the old snapshot
+                del held[ticket_id]
+            elif now - since >= self.period:
+                del held[ticket_id]
+                old_view[ticket_id] = baseline
+                new_view[ticket_id] = stored[ticket_id]
+        return old_view, new_view, hidden
@@ -0,0 +1,94 @@
+"""Collects plain notifications of a user and sends them as few messages
+"""
+import time
+import typing
+
+from bot.app.ticket import MAX_MESSAGE_LENGTH
+
+SEPARATOR = "\n\n"
+
+
+def pack(texts: typing.List[str], limit: int = MAX_MESSAGE_LENGTH) -> typing.List[str]:
+    """Joins texts into as few messages as possible, each not longer than limit.
+    A text that is longer than limit by itself stays alone, the sender splits it
+
+    Args:
+        texts (typing.List[str]): notifications in the order they came
+        limit (int): max length of a message. Defaults to MAX_MESSAGE_LENGTH.
+
+    Returns:
+        typing.List[str]: messages
+    """
+    messages: typing.List[str] = []
+    buffer: str = ""
+    for text in texts:
+        if len(buffer) == 0:
+            buffer = text
+        elif len(buffer) + len(SEPARATOR) + len(text) <= limit:
+            buffer += SEPARATOR + text
+        else:
+            messages.append(buffer)
+            buffer = text
+    if len(buffer) > 0:
+        messages.append(buffer)
+    return messages
+
+
+class Digest:
+    """Notifications held for every user until the window of the user is over.
+    The window starts with the first notification held"""
+
+    def __init__(self, window: int):
+        self.window: int = window
+        self.started: typing.Dict[int, float] = {}
+        self.texts: typing.Dict[int, typing.List[str]] = {}
+        # The earliest GLPI change among the held notifications
+        self.changed: typing.Dict[int, typing.Optional[float]] = {}
+
+    def add(
+        self, user_id: int, texts: typing.List[str], changed: typing.Optional[float] = None
+    ) -> None:
+        """ Hold notifications of the user """
+        if len(texts) == 0:
+            return
+        if user_id not in self.texts:
+            self.started[user_id] = time.time()
+            self.texts[user_id] = []
+            self.changed[user_id] = changed
+        elif changed is not None:
+            self.changed[user_id] = min(changed, self.changed[user_id] or changed)
+        self.texts[user_id].extend(texts)
+
+    def due(
+        self, now: typing.Optional[float] = None
+    ) -> typing.Dict[int, typing.Tuple[typing.List[str], typing.Optional[float]]]:
+        """Take messages of users whose window is over
+
+        Returns:
+            typing.Dict[int, typing.Tuple[typing.List[str], typing.Optional[float]]]:
+                packed messages and the earliest change for every user
+        """
+        now = time.time() if now is None else now
+        result: typing.Dict[int, typing.Tuple[typing.List[str], typing.Optional[float]]] = {}
+        for user_id in [
+            user_id
+            for user_id, started in self.started.items()
+            if now - started >= self.window
+        ]:
+            del self.started[user_id]
+            result[user_id] = (pack(self.texts.pop(user_id)), self.changed.pop(user_id))
+        return result
+
+    def to_state(self) -> typing.Dict:
+        """ Held notifications as json-friendly dict, to survive a restart """
+        return {
+            str(user_id): [self.started[user_id], texts, self.changed[user_id]]
+            for user_id, texts in self.texts.items()
+        }
+
+    def load_state(self, state: typing.Dict) -> None:
+        """ Restore held notifications saved by to_state """
+        for user_id, (started, texts, *changed) in state.items():
+            self.started[int(user_id)] = started
+            self.texts[int(user_id)] = texts
+            self.changed[int(user_id)] = changed[0] if len(changed) > 0 else None
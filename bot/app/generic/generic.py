@@ -189,8 +189,9 @@ async def process_to_select_priority(
     """
     user_session = UserSession(user_id)
     await user_session.create(state)
-    title = await user_session.pop_field(key="title")
-    description = await user_session.pop_field(key="description")
+    fields: Dict[str, str] = await user_session.pop_fields("title", "description")
+    title = fields["title"]
+    description = fields["description"]
     logging.info("title = _%s_ description = _%s_", title, description)
     if len(title) == 0 or len(description) == 0:
         logging.warning(
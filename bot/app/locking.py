@@ -0,0 +1,54 @@
+"""Handlers of one user run one by one: a second message or button press waits
+until the handler of the first one has written the user record
+"""
+import typing
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from bot.db.locks import USER_LOCKS, KeyedLocks
+from bot.metrics import METRICS
+
+# Key of data passed from pre_process to post_process
+LOCK = "user_lock"
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """Holds the lock of the user while the message or callback query is processed"""
+
+    def __init__(self, locks: KeyedLocks = USER_LOCKS):
+        super().__init__()
+        self._locks: KeyedLocks = locks
+
+    async def _acquire(self, user: typing.Optional[types.User], data: typing.Dict) -> None:
+        if user is None:
+            return
+        if self._locks.locked(user.id):
+            METRICS.count("user_lock_waits")
+        lock = self._locks(user.id)
+        await lock.acquire()
+        data[LOCK] = lock
+
+    @staticmethod
+    def _release(data: typing.Dict) -> None:
+        lock = data.pop(LOCK, None)
+        if lock is not None:
+            lock.release()
+
+    async def on_pre_process_message(self, message: types.Message, data: typing.Dict) -> None:
+        await self._acquire(message.from_user, data)
+
+    async def on_post_process_message(
+        self, message: types.Message, results: typing.List, data: typing.Dict
+    ) -> None:
+        self._release(data)
+
+    async def on_pre_process_callback_query(
+        self, callback_query: types.CallbackQuery, data: typing.Dict
+    ) -> None:
+        await self._acquire(callback_query.from_user, data)
+
+    async def on_post_process_callback_query(
+        self, callback_query: types.CallbackQuery, results: typing.List, data: typing.Dict
+    ) -> None:
+        self._release(data)
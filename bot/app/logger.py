@@ -0,0 +1,25 @@
+"""Logging configuration shared by the bot and the checker processes
+"""
+import sys
+import logging
+
+import config
+
+
+def init_logging(filename: str) -> None:
+    """Send log records to stdout and to the file
+
+    Args:
+        filename (str): log file name
+    """
+    formatter: logging.Formatter = logging.Formatter(
+        fmt="%(asctime)s [%(filename)15s:%(lineno)4s - %(funcName)20s() ] - %(message)s",
+        datefmt="%d-%b-%y %H:%M:%S",
+    )
+    handler_stdout: logging.Handler = logging.StreamHandler(sys.stdout)
+    handler_stdout.setFormatter(formatter)
+    handler_file: logging.Handler = logging.FileHandler(filename=filename, mode="a")
+    handler_file.setFormatter(formatter)
+    logging.getLogger().setLevel(config.LOG_LEVEL)
+    logging.getLogger().addHandler(handler_stdout)
+    logging.getLogger().addHandler(handler_file)
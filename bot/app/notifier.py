@@ -0,0 +1,175 @@
+"""Delivers notifications queued by the checker process
+"""
+import logging
+import asyncio
+import time
+import typing
+from aiogram import types
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    ChatNotFound,
+    NetworkError,
+    RetryAfter,
+    TelegramAPIError,
+    UserDeactivated,
+)
+
+from config import (
+    NOTIFY_CHAT_RATE,
+    NOTIFY_GLOBAL_RATE,
+    OUTBOX_KEY_TTL,
+    OUTBOX_POLL_PERIOD,
+)
+from bot.app.core import bot, split_message
+from bot.app.rate_limit import KeyedBuckets, TokenBucket
+from bot.metrics import LAG, METRICS
+from bot.db.locks import USER_LOCKS
+from bot.db.outbox import LOGOUT, MESSAGE
+from bot.db.storage import NotificationQueue
+import bot.app.generic.generic as generic
+
+SENT_PARTS = "sent_parts"
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+
+async def deliver(
+    name: str, entry: typing.Dict, outbox: NotificationQueue, storage: BaseStorage
+) -> bool:
+    """Performs one step of a queued notification: one telegram message.
+    Long texts are sent part by part, the number of sent parts is saved in
+    the entry, so a restart does not repeat them
+
+    Args:
+        name (str): name of the queue entry
+        entry (typing.Dict): queue entry, updated with the progress
+        outbox (NotificationQueue): the queue
+        storage (BaseStorage): storage of the dispatcher
+
+    Returns:
+        bool: True if the notification is complete
+    """
+    user_id: int = entry["user_id"]
+    action: str = entry.get("action", MESSAGE)
+    if action == LOGOUT:
+        # The same lock as handlers of the user take, so the logout does not
+        # interleave with a wizard step that reads and writes the data
+        async with USER_LOCKS(user_id):
+            await generic.logout(
+                user_id, FSMContext(storage=storage, chat=user_id, user=user_id)
+            )
+        return True
+    parts: typing.List[str] = split_message(entry["text"])
+    sent: int = entry.get(SENT_PARTS, 0)
+    reply_markup: typing.Optional[types.InlineKeyboardMarkup] = None
+    if sent == len(parts) - 1 and entry.get("reply_markup") is not None:
+        reply_markup = types.InlineKeyboardMarkup.to_object(entry["reply_markup"])
+    await bot.send_message(user_id, parts[sent], reply_markup=reply_markup)
+    if sent + 1 >= len(parts):
+        return True
+    entry[SENT_PARTS] = sent + 1
+    outbox.update(name, entry)
+    return False
+
+
+def backoff(attempts: int) -> float:
+    """ Delay before the next attempt after a network error """
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+
+
+async def sender(outbox: NotificationQueue, storage: BaseStorage) -> None:
+    """Reads the queue and delivers notifications in the order they came.
+    The order is kept within every chat, a chat that waits for its token
+    bucket or for a retry does not hold the others. An entry that fails for an
+    unexpected reason stays in the queue and is retried with a backoff"""
+    global_bucket: TokenBucket = TokenBucket(NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_RATE)
+    chat_buckets: KeyedBuckets = KeyedBuckets(NOTIFY_CHAT_RATE)
+    entries: typing.Dict[str, typing.Dict] = {}
+    retries: typing.Dict[str, typing.Tuple[int, float]] = {}
+    keys_expired: float = 0.0
+
+    def postpone(name: str, now: float, err: Exception) -> None:
+        METRICS.error(err)
+        attempts: int = retries.get(name, (0, 0.0))[0] + 1
+        retries[name] = (attempts, now + backoff(attempts))
+        logging.error("Notification %s is postponed for %s s: %s", name, backoff(attempts), err)
+
+    while True:
+        try:
+            pending: typing.List[str] = outbox.pending()
+            for name in set(entries) - set(pending):
+                del entries[name]
+                retries.pop(name, None)
+            waiting: typing.Set[int] = set()
+            for name in pending:
+                if name not in entries:
+                    if retries.get(name, (0, 0.0))[1] > time.monotonic():
+                        continue
+                    try:
+                        entries[name] = outbox.read(name)
+                        int(entries[name]["user_id"])
+                    except (OSError, ValueError, KeyError, TypeError) as err:
+                        entries.pop(name, None)
+                        # The file stays in new/ and is read again later
+                        postpone(name, time.monotonic(), err)
+                        continue
+                entry: typing.Dict = entries[name]
+                user_id: int = entry["user_id"]
+                if user_id in waiting:
+                    continue
+                now: float = time.monotonic()
+                if retries.get(name, (0, 0.0))[1] > now or not chat_buckets.take(user_id, now):
+                    waiting.add(user_id)
+                    continue
+                await asyncio.sleep(global_bucket.delay())
+                global_bucket.take()
+                logging.info("notifier.sender: %s %s", name, entry)
+                try:
+                    done: bool = await deliver(name, entry, outbox, storage)
+                except (BotBlocked, ChatNotFound, UserDeactivated) as err:
+                    METRICS.error(err)
+                    logging.warning("User ID %s cannot be notified: %s", user_id, err)
+                    done = True
+                except RetryAfter as err:
+                    METRICS.error(err)
+                    # Flood control is applied to the whole bot: stop the pass
+                    logging.error("Notification %s waits %s s: %s", name, err.timeout, err)
+                    await asyncio.sleep(err.timeout)
+                    break
+                except NetworkError as err:
+                    postpone(name, now, err)
+                    waiting.add(user_id)
+                    continue
+                except TelegramAPIError as err:
+                    METRICS.error(err)
+                    # Would fail forever (bad markup and so on), do not block the chat
+                    logging.error("Notification %s is dropped: %s", name, err)
+                    done = True
+                except Exception as err:  # pylint: disable=broad-except
+                    # Storage, timeouts and so on: the entry stays in the queue
+                    logging.exception("Notification %s failed", name)
+                    postpone(name, now, err)
+                    waiting.add(user_id)
+                    continue
+                if done:
+                    METRICS.count("notifications_done")
+                    if entry.get("changed") is not None:
+                        METRICS.observe(LAG, time.time() - entry["changed"])
+                    outbox.ack(name)
+                    del entries[name]
+                    retries.pop(name, None)
+                else:
+                    waiting.add(user_id)
+            chat_buckets.prune()
+            if time.monotonic() - keys_expired > OUTBOX_KEY_TTL / 24:
+                keys_expired = time.monotonic()
+                logging.info(
+                    "notifier.sender: %d keys expired", outbox.expire_keys(OUTBOX_KEY_TTL)
+                )
+        except Exception as err:  # pylint: disable=broad-except
+            # Nothing else delivers notifications: the sender must keep going
+            METRICS.error(err)
+            logging.exception("notifier.sender: the pass failed")
+        await asyncio.sleep(OUTBOX_POLL_PERIOD)
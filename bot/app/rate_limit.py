@@ -0,0 +1,60 @@
+"""Token buckets for Telegram flood limits
+"""
+import time
+import typing
+
+
+class TokenBucket:
+    """Gives out up to `rate` tokens per second, not more than `capacity` at once"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now <= self.updated:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: typing.Optional[float] = None) -> float:
+        """ Seconds to wait until a token is available """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: typing.Optional[float] = None) -> bool:
+        """ Take a token if it is available """
+        if self.delay(now) > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self, now: typing.Optional[float] = None) -> bool:
+        """ The bucket is in its initial state and may be forgotten """
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= self.capacity
+
+
+class KeyedBuckets:
+    """Separate token bucket for every key (telegram chat)"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self._buckets: typing.Dict[typing.Hashable, TokenBucket] = {}
+
+    def take(self, key: typing.Hashable, now: typing.Optional[float] = None) -> bool:
+        """ Take a token from the bucket of the key if it is available """
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        return self._buckets[key].take(now)
+
+    def prune(self) -> None:
+        """ Forget full buckets, they are equal to new ones """
+        now: float = time.monotonic()
+        for key in [key for key, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[key]
@@ -0,0 +1,150 @@
+"""Runs a candidate diff engine next to the production one on the same data.
+Only the result of the production engine is used; the candidate is checked
+for divergence and its CPU cost is compared.
+Only diff engines can be shadowed: both get the tickets polled once. Polling
+modes (CHECK_FEED, the two-phase poll) decide what is read from GLPI, so they
+can't share one poll. A diff engine goes to GLPI only for proposed solutions.
+Solutions read by the production engine are given to the candidate, not read
+again, so instead of GLPI requests the solutions each engine asks for are counted
+"""
+import typing
+import logging
+import time
+
+from bot.app.ticket_diff import Diff
+from bot.metrics import METRICS
+from bot.usersession import UserSession
+
+PARTS = ("messages", "proposed_solutions", "closed_tickets")
+
+
+def divergence(primary: Diff, candidate: Diff) -> typing.Dict[str, typing.List[int]]:
+    """Tickets that are different in the results of two engines
+
+    Args:
+        primary (Diff): result of the production engine
+        candidate (Diff): result of the candidate engine
+
+    Returns:
+        typing.Dict[str, typing.List[int]]: ticket ids for every differing part
+    """
+    result: typing.Dict[str, typing.List[int]] = {}
+    for name, ours, theirs in zip(PARTS, primary[0], candidate[0]):
+        differing: typing.List[int] = sorted(
+            ticket_id
+            for ticket_id in ours.keys() | theirs.keys()
+            if ours.get(ticket_id, None) != theirs.get(ticket_id, None)
+        )
+        if len(differing) > 0:
+            result[name] = differing
+    if primary[1] != candidate[1]:
+        result["have_changes"] = []
+    return result
+
+
+class SharedSolutions:
+    """UserSession for both engines: solutions read by one are reused by the other"""
+
+    def __init__(self, user_session: UserSession):
+        self._user_session: UserSession = user_session
+        self._solutions: typing.Dict[int, str] = {}
+        # Solutions asked for by the engine that runs now, read or reused
+        self.asked: int = 0
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._user_session, name)
+
+    def get_last_solutions(self, ticket_ids: typing.List[int]) -> typing.Dict[int, str]:
+        """ Read only solutions that are not read yet """
+        self.asked += len(ticket_ids)
+        missing: typing.List[int] = [
+            ticket_id for ticket_id in ticket_ids if ticket_id not in self._solutions
+        ]
+        if len(missing) > 0:
+            self._solutions.update(self._user_session.get_last_solutions(missing))
+        return {ticket_id: self._solutions[ticket_id] for ticket_id in ticket_ids}
+
+
+class Shadow:
+    """Diff engine that calls both engines and returns the production result"""
+
+    def __init__(
+        self, primary: typing.Callable[..., Diff], candidate: typing.Callable[..., Diff]
+    ):
+        self.primary: typing.Callable[..., Diff] = primary
+        self.candidate: typing.Callable[..., Diff] = candidate
+        self._reset()
+
+    def _reset(self) -> None:
+        self.runs: int = 0
+        self.divergences: int = 0
+        self.cpu: typing.Dict[str, float] = {"primary": 0.0, "candidate": 0.0}
+        self.solutions: typing.Dict[str, int] = {"primary": 0, "candidate": 0}
+
+    def _measure(
+        self,
+        name: str,
+        engine: typing.Callable[..., Diff],
+        old_ticket_dict: typing.Dict[int, typing.Dict],
+        new_ticket_dict: typing.Dict[int, typing.Dict],
+        shared: SharedSolutions,
+        key: typing.Optional[int],
+    ) -> Diff:
+        shared.asked = 0
+        started: float = time.process_time()
+        result: Diff = engine(old_ticket_dict, new_ticket_dict, user_session=shared, key=key)
+        self.cpu[name] += time.process_time() - started
+        self.solutions[name] += shared.asked
+        return result
+
+    def __call__(
+        self,
+        old_ticket_dict: typing.Dict[int, typing.Dict],
+        new_ticket_dict: typing.Dict[int, typing.Dict],
+        user_session: UserSession,
+        key: typing.Optional[int] = None,
+    ) -> Diff:
+        shared: SharedSolutions = SharedSolutions(user_session)
+        result: Diff = self._measure(
+            "primary", self.primary, old_ticket_dict, new_ticket_dict, shared, key
+        )
+        self.runs += 1
+        try:
+            shadow: Diff = self._measure(
+                "candidate", self.candidate, old_ticket_dict, new_ticket_dict, shared, key
+            )
+        except Exception:  # pylint: disable=broad-except
+            self.divergences += 1
+            METRICS.count("shadow.errors")
+            logging.exception("shadow: candidate engine failed")
+            return result
+        differing = divergence(result, shadow)
+        if len(differing) > 0:
+            self.divergences += 1
+            METRICS.count("shadow.divergences")
+            logging.warning(
+                "shadow: engines diverge on %s\nprimary = %s\ncandidate = %s",
+                differing,
+                result,
+                shadow,
+            )
+        return result
+
+    def report(self) -> None:
+        """ Log the cost of both engines since the last report and start over """
+        if self.runs == 0:
+            return
+        logging.info(
+            "shadow: runs = %d divergences = %d cpu primary = %.3f s candidate = %.3f s"
+            " (x%.2f) solutions asked primary = %d candidate = %d",
+            self.runs,
+            self.divergences,
+            self.cpu["primary"],
+            self.cpu["candidate"],
+            self.cpu["candidate"] / self.cpu["primary"] if self.cpu["primary"] > 0 else 0.0,
+            self.solutions["primary"],
+            self.solutions["candidate"],
+        )
+        METRICS.observe("shadow.cpu_primary", self.cpu["primary"])
+        METRICS.observe("shadow.cpu_candidate", self.cpu["candidate"])
+        self._reset()
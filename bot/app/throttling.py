@@ -0,0 +1,80 @@
+"""Anti-flood for handlers that go to GLPI: a user who repeats such a command
+too often gets a notice instead of one more GLPI login
+"""
+import logging
+import typing
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import Throttled
+
+from bot.metrics import METRICS
+
+RATE_LIMIT = "throttling_rate_limit"
+KEY = "throttling_key"
+# Notice is sent on the first throttled call only, the next ones are dropped silently
+NOTICE_TIMES = 1
+NOTICE = "Слишком часто. Подождите пару секунд и повторите"
+
+
+def rate_limit(limit: float, key: typing.Optional[str] = None) -> typing.Callable:
+    """Marks handler to be called not more often than once per limit seconds per user
+
+    Args:
+        limit (float): seconds between two calls
+        key (typing.Optional[str]): bucket name, handlers with one key share the limit.
+            Defaults to None - name of the handler.
+    """
+
+    def decorator(func: typing.Callable) -> typing.Callable:
+        setattr(func, RATE_LIMIT, limit)
+        setattr(func, KEY, key or func.__name__)
+        return func
+
+    return decorator
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Checks rate_limit of the handler with the buckets of the storage"""
+
+    async def _throttle(self) -> typing.Optional[Throttled]:
+        handler = current_handler.get()
+        if handler is None or not hasattr(handler, RATE_LIMIT):
+            return None
+        try:
+            await self.manager.dispatcher.throttle(
+                getattr(handler, KEY), rate=getattr(handler, RATE_LIMIT)
+            )
+        except Throttled as throttled:
+            METRICS.count("throttled")
+            logging.info(
+                "User ID %s is throttled on %s: %d calls",
+                throttled.user,
+                throttled.key,
+                throttled.exceeded_count,
+            )
+            return throttled
+        return None
+
+    async def on_process_message(self, message: types.Message, data: typing.Dict) -> None:
+        """ Drop the message if the handler is called too often """
+        throttled: typing.Optional[Throttled] = await self._throttle()
+        if throttled is None:
+            return
+        if throttled.exceeded_count <= NOTICE_TIMES + 1:
+            await message.answer(NOTICE)
+        raise CancelHandler()
+
+    async def on_process_callback_query(
+        self, callback_query: types.CallbackQuery, data: typing.Dict
+    ) -> None:
+        """ Drop the button press if the handler is called too often """
+        throttled: typing.Optional[Throttled] = await self._throttle()
+        if throttled is None:
+            return
+        # The button keeps spinning until the callback is answered
+        await callback_query.answer(
+            NOTICE if throttled.exceeded_count <= NOTICE_TIMES + 1 else None
+        )
+        raise CancelHandler()
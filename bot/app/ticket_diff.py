@@ -0,0 +1,219 @@
+"""Comparison of ticket snapshots and messages about the changes
+"""
+import typing
+import logging
+import hashlib
+import json
+from config import GLPI_TICKET_URL
+from bot.usersession import UserSession
+
+STATUS = "status"
+FINGERPRINT = "fingerprint"
+TRACKED_FIELDS = (STATUS, "name", "date_mod")
+
+Diff = typing.Tuple[typing.Tuple[typing.Dict, typing.Dict, typing.Dict], bool]
+
+
+def fingerprint(ticket: typing.Dict) -> str:
+    """Compact digest of tracked fields of the ticket
+
+    Args:
+        ticket (typing.Dict): ticket snapshot
+
+    Returns:
+        str: 16 hex digits
+    """
+    source: str = json.dumps(
+        [ticket.get(field, None) for field in TRACKED_FIELDS], ensure_ascii=False
+    )
+    return hashlib.blake2b(source.encode("utf8"), digest_size=8).hexdigest()
+
+
+def add_fingerprints(ticket_dict: typing.Dict[int, typing.Dict]) -> None:
+    """Store fingerprint inside every ticket snapshot that has none.
+    Snapshots copied from the previous poll keep their fingerprint"""
+    for ticket in ticket_dict.values():
+        if FINGERPRINT not in ticket:
+            ticket[FINGERPRINT] = fingerprint(ticket)
+
+
+def status_message(
+    ticket_id: int,
+    old_ticket: typing.Dict,
+    new_ticket: typing.Dict,
+    solutions: typing.Mapping[int, str],
+) -> typing.Tuple[str, typing.Optional[int]]:
+    """Message about changed status of the ticket
+
+    Args:
+        ticket_id (int): ticket id
+        old_ticket (typing.Dict): old snapshot
+        new_ticket (typing.Dict): new snapshot
+        solutions (typing.Mapping[int, str]): prefetched proposed solutions
+
+    Returns:
+        typing.Tuple[str, typing.Optional[int]]: message text and new status
+    """
+    old_status = old_ticket.get(STATUS, None)
+    new_status = new_ticket.get(STATUS, None)
+    name: str = '"' + str(new_ticket.get("name", None)) + '"'
+    date_mod: str = str(new_ticket.get("date_mod", None))
+    link: str = f"<a href=\"{GLPI_TICKET_URL}{ticket_id}\">{ticket_id} {name}</a>"
+    # messages[ticket_id] = f"Status: old = {old_status} new = {new_status}"
+    if new_status == 1:  # Новый
+        return (
+            f"Ваша заявка с номером {link} пересоздана."
+            + f" Дата и время назначения: {date_mod}"
+        ), new_status
+    if new_status == 2:  # В работе (назначена)
+        return (
+            f"Ваша заявка с номером {link} назначена."
+            + f" Дата и время назначения: {date_mod}"
+        ), new_status
+    if new_status == 3:  # В работе (запланирована)
+        return (
+            f"Ваша заявка с номером {link} запланирована."
+            + f" Дата и время изменения: {date_mod}"
+        ), new_status
+    if new_status == 4:  # Ожидает ответа от заявителя
+        return (
+            f"Ваша заявка с номером {link}"
+            + f" ожидает ответа от заявителя. Дата и время изменения: {date_mod}"
+        ), new_status
+    if new_status == 5:  # Решена
+        solution: str = solutions.get(ticket_id, "")
+        return (
+            f"По Вашей заявке с номером {link}"
+            + f" предложено решение: {solution}.\nДата и время изменения: {date_mod}"
+        ), new_status
+    if new_status == 6:  # Закрыто
+        return "", new_status
+    logging.error("UNKNOWN STATUS: old = %s new = %s", old_status, new_status)
+    logging.error("old_ticket = %s", old_ticket)
+    logging.error("new_ticket = %s", new_ticket)
+    return f"Status: old = {old_status} new = {new_status}", None
+
+
+def prefetch_solutions(
+    new_ticket_dict: typing.Dict[int, typing.Dict],
+    status_changed: typing.Iterable[int],
+    user_session: UserSession,
+) -> typing.Dict[int, str]:
+    """Reads solutions of all resolved tickets at once, before messages are made
+
+    Args:
+        new_ticket_dict (typing.Dict[int, typing.Dict]): new snapshots
+        status_changed (typing.Iterable[int]): tickets with changed status
+        user_session (UserSession): session to read proposed solutions
+
+    Returns:
+        typing.Dict[int, str]: solution for every resolved ticket
+    """
+    resolved: typing.List[int] = [
+        ticket_id
+        for ticket_id in status_changed
+        if new_ticket_dict[ticket_id].get(STATUS, None) == 5
+    ]
+    if len(resolved) == 0:
+        return {}
+    return user_session.get_last_solutions(resolved)
+
+
+def render_changes(
+    old_ticket_dict: typing.Dict[int, typing.Dict],
+    new_ticket_dict: typing.Dict[int, typing.Dict],
+    status_changed: typing.Iterable[int],
+    removed: typing.Iterable[int],
+    solutions: typing.Mapping[int, str],
+) -> typing.Tuple[typing.Dict, typing.Dict, typing.Dict]:
+    """Messages for the tickets found by a diff engine
+
+    Args:
+        old_ticket_dict (typing.Dict[int, typing.Dict]): old snapshots
+        new_ticket_dict (typing.Dict[int, typing.Dict]): new snapshots
+        status_changed (typing.Iterable[int]): tickets with changed status
+        removed (typing.Iterable[int]): tickets that disappeared
+        solutions (typing.Mapping[int, str]): prefetched proposed solutions
+
+    Returns:
+        typing.Tuple[typing.Dict, typing.Dict, typing.Dict]: messages, proposed_solutions, closed_tickets
+    """
+    messages: typing.Dict[int, str] = dict()
+    proposed_solutions = dict()
+    closed_tickets = dict()
+    for ticket_id in status_changed:
+        messages[ticket_id], new_status = status_message(
+            ticket_id,
+            old_ticket_dict[ticket_id],
+            new_ticket_dict[ticket_id],
+            solutions,
+        )
+        if new_status == 5:
+            proposed_solutions[ticket_id] = messages[ticket_id]
+            # TODO Add buttons
+        elif new_status == 6:
+            closed_tickets[ticket_id] = messages[ticket_id]
+            # TODO Add button
+    for ticket_id in removed:
+        logging.info("Deleted ticket: %s", old_ticket_dict[ticket_id])
+        # TODO Think about it
+        messages[
+            ticket_id
+        ] = f"Ваша заявка с номером {ticket_id} \"{old_ticket_dict[ticket_id].get('name',None)}\" удалена."
+    return messages, proposed_solutions, closed_tickets
+
+
+def check_diff(
+    old_ticket_dict: typing.Dict[int, typing.Dict],
+    new_ticket_dict: typing.Dict[int, typing.Dict],
+    user_session: UserSession,
+    key: typing.Optional[int] = None,
+) -> Diff:
+    """Read old data, compare it with the new data, rewrite new data, return diff.
+    key (glpi_id) is not used: the vector engine keeps its arrays by it"""
+    logging.info("len(old_ticket_dict) = %s", len(old_ticket_dict))
+    logging.info("len(new_ticket_dict) = %s", len(new_ticket_dict))
+    logging.debug("old_ticket_dict = %s", old_ticket_dict)
+    logging.debug("new_ticket_dict = %s", new_ticket_dict)
+
+    have_changes: bool = False
+    status_changed: typing.List[int] = []
+    removed: typing.List[int] = []
+    for ticket_id in old_ticket_dict.keys() | new_ticket_dict.keys():
+        if ticket_id in old_ticket_dict and ticket_id in new_ticket_dict:
+            old_fingerprint: typing.Optional[str] = old_ticket_dict[ticket_id].get(
+                FINGERPRINT, None
+            )
+            if old_fingerprint is None:
+                # Snapshot written before fingerprints: rewrite it once
+                have_changes = True
+                old_fingerprint = fingerprint(old_ticket_dict[ticket_id])
+            new_fingerprint: str = new_ticket_dict[ticket_id].get(
+                FINGERPRINT, None
+            ) or fingerprint(new_ticket_dict[ticket_id])
+            if old_fingerprint == new_fingerprint:
+                continue
+            logging.debug("changed ticket_id %s", ticket_id)
+            have_changes = True
+            if old_ticket_dict[ticket_id].get(STATUS, None) != new_ticket_dict[
+                ticket_id
+            ].get(STATUS, None):
+                status_changed.append(ticket_id)
+        elif ticket_id in old_ticket_dict:
+            removed.append(ticket_id)
+            have_changes = True
+        else:
+            logging.info("New ticket %s", new_ticket_dict[ticket_id])
+            # TODO Think about it
+            # messages[ticket_id] = "NEW"
+            have_changes = True
+
+    messages, proposed_solutions, closed_tickets = render_changes(
+        old_ticket_dict,
+        new_ticket_dict,
+        status_changed,
+        removed,
+        prefetch_solutions(new_ticket_dict, status_changed, user_session),
+    )
+    logging.info("messages = %s", messages)
+    return (messages, proposed_solutions, closed_tickets), have_changes
@@ -0,0 +1,135 @@
+"""Messages built from GLPI history (Log sub-items) of changed tickets
+"""
+import typing
+import logging
+from config import GLPI_TICKET_URL
+from bot.app.ticket import int_to_status, int_to_urgency
+from bot.app.ticket_diff import FINGERPRINT
+from bot.usersession import UserSession
+
+LAST_LOG_ID = "last_log_id"
+STATUS_OPTION = "12"
+URGENCY_OPTION = "10"
+FIELD_NAMES = {
+    "1": "Заголовок",
+    "3": "Приоритет",
+    "4": "Инициатор",
+    "5": "Исполнитель",
+    "7": "Категория",
+    "8": "Группа исполнителей",
+    "10": "Срочность",
+    "12": "Статус",
+    "18": "Время решения",
+    "21": "Описание",
+}
+
+
+def changed_tickets(
+    old_ticket_dict: typing.Dict[int, typing.Dict],
+    new_ticket_dict: typing.Dict[int, typing.Dict],
+) -> typing.List[int]:
+    """ Tickets present in both snapshots with different fingerprints """
+    return [
+        ticket_id
+        for ticket_id, ticket in new_ticket_dict.items()
+        if ticket_id in old_ticket_dict
+        and old_ticket_dict[ticket_id].get(FINGERPRINT, None) != ticket.get(FINGERPRINT, None)
+    ]
+
+
+def _value(option: str, value: typing.Any) -> str:
+    """ User-friendly value of the field """
+    if option in (STATUS_OPTION, URGENCY_OPTION) and str(value).isdigit():
+        if option == STATUS_OPTION:
+            return int_to_status(int(value))
+        return int_to_urgency(int(value))
+    return str(value)
+
+
+def describe_row(row: typing.Dict) -> str:
+    """One line about one field transition
+
+    Args:
+        row (typing.Dict): Log sub-item
+
+    Returns:
+        str: description
+    """
+    option: str = str(row.get("id_search_option", 0))
+    date_mod: str = str(row.get("date_mod", ""))
+    if option == "0":
+        # Not a field: something was linked to the ticket (followup, document...)
+        return f"{date_mod} {row.get('itemtype_link', '')}: {row.get('new_value', '')}"
+    field: str = FIELD_NAMES.get(option, f"Поле {option}")
+    old_value: str = _value(option, row.get("old_value", ""))
+    new_value: str = _value(option, row.get("new_value", ""))
+    return f"{date_mod} {field}: {old_value} → {new_value}"
+
+
+def history_messages(
+    old_ticket_dict: typing.Dict[int, typing.Dict],
+    new_ticket_dict: typing.Dict[int, typing.Dict],
+    user_session: UserSession,
+) -> typing.Dict[int, str]:
+    """Reads only new history rows of changed tickets and makes a message for each of them.
+    The last seen log id is carried over into the new snapshots
+
+    Args:
+        old_ticket_dict (typing.Dict[int, typing.Dict]): old snapshots
+        new_ticket_dict (typing.Dict[int, typing.Dict]): new snapshots, get LAST_LOG_ID
+        user_session (UserSession): session to read history
+
+    Returns:
+        typing.Dict[int, str]: message for every ticket with new history rows
+    """
+    for ticket_id, ticket in new_ticket_dict.items():
+        if ticket_id in old_ticket_dict and LAST_LOG_ID in old_ticket_dict[ticket_id]:
+            ticket[LAST_LOG_ID] = old_ticket_dict[ticket_id][LAST_LOG_ID]
+
+    wanted: typing.Dict[int, typing.Tuple[typing.Optional[int], typing.Optional[str]]] = {
+        ticket_id: (
+            old_ticket_dict[ticket_id].get(LAST_LOG_ID, None),
+            old_ticket_dict[ticket_id].get("date_mod", None),
+        )
+        for ticket_id in changed_tickets(old_ticket_dict, new_ticket_dict)
+    }
+    if len(wanted) == 0:
+        return {}
+    rows: typing.Dict[int, typing.List[typing.Dict]] = user_session.get_new_log_rows(wanted)
+
+    messages: typing.Dict[int, str] = {}
+    for ticket_id, ticket_rows in rows.items():
+        if len(ticket_rows) == 0:
+            continue
+        new_ticket_dict[ticket_id][LAST_LOG_ID] = int(ticket_rows[-1]["id"])
+        name: str = '"' + str(new_ticket_dict[ticket_id].get("name", None)) + '"'
+        lines: typing.List[str] = [
+            f"Изменения в заявке <a href=\"{GLPI_TICKET_URL}{ticket_id}\">{ticket_id} {name}</a>:"
+        ]
+        lines.extend(describe_row(row) for row in ticket_rows)
+        messages[ticket_id] = "\n".join(lines)
+    logging.info("history messages for tickets %s", list(messages))
+    return messages
+
+
+def merge_messages(
+    diff_messages: typing.Tuple[typing.Dict, typing.Dict, typing.Dict],
+    history: typing.Dict[int, str],
+) -> typing.Tuple[typing.Dict, typing.Dict, typing.Dict]:
+    """History replaces plain status messages. Proposed solutions keep their
+    message (it has the solution and needs buttons), closed tickets stay silent
+
+    Args:
+        diff_messages (typing.Tuple[typing.Dict, typing.Dict, typing.Dict]): result of check_diff
+        history (typing.Dict[int, str]): result of history_messages
+
+    Returns:
+        typing.Tuple[typing.Dict, typing.Dict, typing.Dict]: messages, proposed_solutions, closed_tickets
+    """
+    messages, proposed_solutions, closed_tickets = diff_messages
+    merged: typing.Dict[int, str] = dict(messages)
+    for ticket_id, text in history.items():
+        if ticket_id in proposed_solutions or ticket_id in closed_tickets:
+            continue
+        merged[ticket_id] = text
+    return merged, proposed_solutions, closed_tickets
@@ -0,0 +1,117 @@
+"""Backup of users and ticket snapshots as json lines, read from the storage
+batch by batch. Inside the bot the event loop serves other tasks between
+batches; the file is replaced only when the backup is complete.
+
+Checker state is not saved: after a restore every glpi user is checked again.
+Snapshots of glpi users no telegram user is linked to are not saved either.
+
+Usage (stop the bot and the checker before a restore):
+    python -m bot.db.backup dump /data/backup.jsonl
+    python -m bot.db.backup restore /data/backup.jsonl
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import typing
+
+from bot.db.dbhelper import BATCH_SIZE
+from bot.db.storage import Storage, open_storage
+
+
+async def backup(storage: Storage, filename: str, batch_size: int = BATCH_SIZE) -> int:
+    """Write users and ticket snapshots of linked glpi users to the file
+
+    Args:
+        storage (Storage): storage to read
+        filename (str): json lines file, replaced when the backup is complete
+        batch_size (int, optional): records read at once. Defaults to BATCH_SIZE.
+
+    Returns:
+        int: number of saved users
+    """
+    users: int = 0
+    tmp_filename: str = filename + ".tmp"
+    with open(tmp_filename, "w", encoding="utf8") as file:
+        # Records are read past the cache of the bot, it keeps the users it works with
+        for batch in storage.iter_user_records(batch_size):
+            for record in batch:
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            users += len(batch)
+            await asyncio.sleep(0)
+        for glpi_batch in storage.iter_glpi_index(batch_size=batch_size):
+            for glpi_id, _ in glpi_batch:
+                for tickets in storage.iter_tickets_glpi(glpi_id, batch_size):
+                    file.write(
+                        json.dumps({"glpi_id": glpi_id, "tickets": tickets}, ensure_ascii=False)
+                        + "\n"
+                    )
+                    await asyncio.sleep(0)
+    os.replace(tmp_filename, filename)
+    logging.info("backup: %d users are saved to %s", users, filename)
+    return users
+
+
+async def restore(storage: Storage, filename: str) -> int:
+    """Write users and ticket snapshots from the backup file to the storage
+
+    Args:
+        storage (Storage): storage to write
+        filename (str): json lines file made by backup
+
+    Returns:
+        int: number of restored users
+    """
+    users: int = 0
+    with open(filename, encoding="utf8") as file:
+        for line in file:
+            record: typing.Dict = json.loads(line)
+            if "user" in record:
+                user_id: int = record["user"]
+                await storage.set_state(chat=user_id, user=user_id, state=record["state"])
+                await storage.set_data(chat=user_id, user=user_id, data=record["data"])
+                await storage.set_bucket(chat=user_id, user=user_id, bucket=record["bucket"])
+                users += 1
+            else:
+                storage.update_tickets_glpi(
+                    record["glpi_id"],
+                    {int(ticket_id): ticket for ticket_id, ticket in record["tickets"].items()},
+                )
+    logging.info("restore: %d users are restored from %s", users, filename)
+    return users
+
+
+async def backuper(storage: Storage, filename: str, period: float) -> None:
+    """ Backs the storage up every period seconds """
+    while True:
+        await asyncio.sleep(period)
+        try:
+            await backup(storage, filename)
+        except OSError as err:
+            logging.error("Backup is not saved: %s", err)
+
+
+def main() -> int:
+    """ Entry point """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=("dump", "restore"))
+    parser.add_argument("filename", help="json lines file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    storage: Storage = open_storage()
+    loop = asyncio.get_event_loop()
+    try:
+        if args.command == "dump":
+            loop.run_until_complete(backup(storage, args.filename))
+        else:
+            loop.run_until_complete(restore(storage, args.filename))
+    finally:
+        loop.run_until_complete(storage.close())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,11 @@
 """Manage comunication with vedis database
 """
+import asyncio
+import bisect
+import collections
+import contextlib
+import copy
+import itertools
 import json
 import logging
 import typing
@@ -9,6 +15,20 @@ import vedis
 STATE = "state"
 DATA = "data"
 BUCKET = "bucket"
+PARTS = (STATE, DATA, BUCKET)
+GLPI_ID = "glpi_id"
+# Value in the user_id hash for users whose state, data and bucket are separate keys,
+# and in the tickets hash for glpi users whose tickets are separate keys.
+# Before that the hashes kept one json blob per user.
+SPLIT = b"split"
+# Records read at once by the iterators over users, glpi users and tickets
+BATCH_SIZE = 500
+# Seconds before a failed commit of pending writes is tried again
+FLUSH_RETRY = 1.0
+# Hashes whose keys are kept in the sorted key index, vedis itself gives all keys at once
+INDEXED = ("user_id", "glpi", "tickets")
+# Keys in one page of the sorted key index, a page is split when it doubles
+PAGE_SIZE = 500
 
 
 def bytes_to_int(source: bytes) -> int:
@@ -53,29 +73,335 @@ def dict_to_bytes(source: typing.Dict) -> bytes:
     return json.dumps(source).encode("utf8")
 
 
+def bytes_to_list(source: bytes) -> typing.List[int]:
+    """Convert bytes into list of ids
+
+    Args:
+        source (bytes): Source string in bytes
+
+    Returns:
+        typing.List[int]: Resulting list
+    """
+    return json.loads(source.decode("utf8"))
+
+
+def list_to_bytes(source: typing.List[int]) -> bytes:
+    """Converts list of ids into bytes
+
+    Args:
+        source (typing.List[int]): Source list
+
+    Returns:
+        bytes: Resulting string in bytes
+    """
+    return json.dumps(source).encode("utf8")
+
+
 class DBHelper(BaseStorage):
     """Main class to communicate with vedis
     By default it write to memory, although it is highly recommended to use file instead.
 
     Problems:
     1) sometimes I have key as telegram user_id, and sometimes as glpi login
-    2) there is no possibility to iterate over vedis keys
+    2) there is no possibility to iterate over vedis keys, so keys of user_id, glpi and tickets
+       hashes are also kept sorted in pages of PAGE_SIZE (hashes "pages" and "pages:<name>")
     3) one login can have more then one user_id
     """
 
-    def __init__(self, filename: str = ":mem:"):
+    def __init__(
+        self,
+        filename: str = ":mem:",
+        cache_size: int = 0,
+        batch_window: typing.Optional[float] = None,
+    ):
+        """
+        Args:
+            filename (str, optional): vedis file. Defaults to ":mem:".
+            cache_size (int, optional): how many decoded user records are kept in memory.
+                Writes go through to vedis, so only the process that is the single writer
+                of user records may cache them. Defaults to 0 - no cache.
+            batch_window (typing.Optional[float], optional): writes made within this many
+                seconds (0 - within one tick of the event loop) are committed in one
+                transaction. Any read commits them first. Defaults to None - every write
+                is its own transaction.
+        """
         logging.debug("DBHelper __init__")
         self._filename: str = filename
         self._database: vedis = vedis.Vedis(self._filename)
         self._userid: vedis.Hash = self._database.Hash("user_id")
         self._glpi_id: vedis.Hash = self._database.Hash("glpi")
         self._tickets: vedis.Hash = self._database.Hash("tickets")
+        self._checker: vedis.Hash = self._database.Hash("checker")
+        self._parts: typing.Dict[str, vedis.Hash] = {
+            part: self._database.Hash(part) for part in PARTS
+        }
+        self._cache_size: int = cache_size
+        # user_id -> decoded state, data and bucket (those read so far), the least recently used first
+        self._cache: typing.OrderedDict[str, typing.Dict] = collections.OrderedDict()
+        self._batch_window: typing.Optional[float] = batch_window
+        # (hash name, key) -> value to write, None to delete
+        self._pending: typing.Dict[typing.Tuple[str, str], typing.Optional[bytes]] = {}
+        self._flush_handle: typing.Optional[asyncio.Handle] = None
+        # glpi users whose tickets are known to be in the split layout
+        self._split_tickets: typing.Set[int] = set()
+        for name in INDEXED:
+            if self._read("pages", name) is None:
+                self._build_pages(name)
+        self._warm_up()
         # export = self.export()
         # for key in export:
         #     logging.info("key = %s data = %s", key, export[key])
 
+    def _warm_up(self) -> None:
+        """ Fill the cache with state and data of users up to its size """
+        if self._cache_size <= 0:
+            return
+        users: typing.Iterator[int] = itertools.chain.from_iterable(self.iter_users())
+        for user_id in itertools.islice(users, self._cache_size):
+            self._resolve_address(chat=user_id, user=user_id)
+            self._peek_part(str(user_id), STATE)
+            self._peek_part(str(user_id), DATA)
+        logging.info("DBHelper cache: %d user records are loaded", len(self._cache))
+
+    def _cache_record(self, user_id: str, record: typing.Dict) -> None:
+        """ Put decoded parts to the cache, evict the least recently used user """
+        if self._cache_size <= 0:
+            return
+        self._cache[user_id] = record
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _remember(self, user_id: str, part: str, value: typing.Any) -> None:
+        """ Put decoded part to the cache """
+        if self._cache_size <= 0:
+            return
+        if user_id in self._cache:
+            self._cache[user_id][part] = value
+            self._cache.move_to_end(user_id)
+        else:
+            self._cache_record(user_id, {part: value})
+
+    def _batching(self) -> bool:
+        """ Writes wait for the flush: batching is on and the event loop will run it """
+        if self._batch_window is None:
+            return False
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    def _put(self, name: str, key: typing.Union[str, int], value: typing.Optional[bytes]) -> None:
+        """Write value to the hash, None deletes the key.
+        Without batching it must be called inside a transaction
+
+        Args:
+            name (str): name of vedis hash
+            key (typing.Union[str, int]): key in the hash
+            value (typing.Optional[bytes]): encoded value or None
+        """
+        if not self._batching():
+            self._apply(name, str(key), value)
+            return
+        self._pending[(name, str(key))] = value
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self._batch_window is not None and self._batch_window > 0:
+                self._flush_handle = loop.call_later(self._batch_window, self._flush_later)
+            else:
+                self._flush_handle = loop.call_soon(self._flush_later)
+
+    def _apply(self, name: str, key: str, value: typing.Optional[bytes]) -> None:
+        target: vedis.Hash = self._database.Hash(name)
+        if value is not None:
+            target[key] = value
+        elif key in target:
+            del target[key]
+
+    def _read(self, name: str, key: typing.Union[str, int]) -> typing.Optional[bytes]:
+        """ Value in the hash with writes of the caller that wait for the flush, without flushing them """
+        pending: typing.Tuple[str, str] = (name, str(key))
+        if pending in self._pending:
+            return self._pending[pending]
+        with self._database.transaction():
+            return self._database.Hash(name)[str(key)]
+
+    def _flush(self) -> None:
+        """Commit pending writes in one transaction.
+        They stay pending until the commit succeeds, a failed one is rolled back and raises
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if len(self._pending) == 0:
+            return
+        with self._database.transaction():
+            for (name, key), value in self._pending.items():
+                self._apply(name, key, value)
+        self._pending = {}
+
+    def _flush_later(self) -> None:
+        self._flush_handle = None
+        try:
+            self._flush()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception(
+                "DBHelper: commit of %d pending writes failed, retry in %s s",
+                len(self._pending),
+                FLUSH_RETRY,
+            )
+            if self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(
+                    FLUSH_RETRY, self._flush_later
+                )
+
+    def _transaction(self) -> typing.ContextManager:
+        """ Transaction to read in: it sees every write made before """
+        self._flush()
+        return self._database.transaction()
+
+    def _writing(self) -> typing.ContextManager:
+        """ Transaction for writes made with _put, none if they wait for the flush """
+        if self._batching():
+            return contextlib.nullcontext()
+        return self._database.transaction()
+
+    def _build_pages(self, name: str) -> None:
+        """Fill the sorted key index of the hash from its keys.
+        vedis gives them all at once, so this is done only when the index is missing
+        or the hash is rebuilt
+
+        Args:
+            name (str): one of INDEXED
+        """
+        self._flush()
+        with self._database.transaction():
+            old: typing.Optional[bytes] = self._database.Hash("pages")[name]
+            for _, number in [] if old is None else bytes_to_dict(old)["pages"]:
+                self._apply(f"pages:{name}", str(number), None)
+            keys: typing.List[int] = sorted(
+                map(bytes_to_int, self._database.Hash(name).keys() or [])
+            )
+            pages: typing.List[typing.List[int]] = []
+            for start in range(0, len(keys), PAGE_SIZE):
+                self._apply(
+                    f"pages:{name}", str(len(pages)), list_to_bytes(keys[start : start + PAGE_SIZE])
+                )
+                pages.append([keys[start], len(pages)])
+            self._apply("pages", name, dict_to_bytes({"next": len(pages), "pages": pages}))
+        logging.info("DBHelper: index of %s is built, %d keys", name, len(keys))
+
+    def _directory(self, name: str) -> typing.Dict:
+        """ Pages of the key index: {"next": number of a new page, "pages": [[lowest key, number]]} """
+        raw: typing.Optional[bytes] = self._read("pages", name)
+        return {"next": 0, "pages": []} if raw is None else bytes_to_dict(raw)
+
+    def _page(self, name: str, number: int) -> typing.List[int]:
+        """ Sorted keys in the page of the key index """
+        raw: typing.Optional[bytes] = self._read(f"pages:{name}", number)
+        return [] if raw is None else bytes_to_list(raw)
+
+    @staticmethod
+    def _find_page(pages: typing.List[typing.List[int]], key: int) -> int:
+        """ Position of the page where the key is or must be """
+        return max(bisect.bisect_right([low for low, _ in pages], key) - 1, 0)
+
+    def _index_add(self, name: str, key: int) -> None:
+        """Put a new key of the hash to the key index, a page of 2 * PAGE_SIZE keys is split.
+        Pages are written with _put, so they are committed together with the hash
+
+        Args:
+            name (str): one of INDEXED
+            key (int): new key
+        """
+        directory: typing.Dict = self._directory(name)
+        pages: typing.List[typing.List[int]] = directory["pages"]
+        changed: bool = len(pages) == 0
+        if changed:
+            pages.append([key, directory["next"]])
+            directory["next"] += 1
+        position: int = self._find_page(pages, key)
+        number: int = pages[position][1]
+        keys: typing.List[int] = self._page(name, number)
+        place: int = bisect.bisect_left(keys, key)
+        if place < len(keys) and keys[place] == key:
+            return
+        keys.insert(place, key)
+        if key < pages[position][0]:
+            pages[position][0] = key
+            changed = True
+        if len(keys) >= 2 * PAGE_SIZE:
+            half: int = len(keys) // 2
+            pages.insert(position + 1, [keys[half], directory["next"]])
+            self._put(f"pages:{name}", directory["next"], list_to_bytes(keys[half:]))
+            directory["next"] += 1
+            keys = keys[:half]
+            changed = True
+        self._put(f"pages:{name}", number, list_to_bytes(keys))
+        if changed:
+            self._put("pages", name, dict_to_bytes(directory))
+
+    def _index_remove(self, name: str, key: int) -> None:
+        """Remove a deleted key of the hash from the key index, an empty page is dropped
+
+        Args:
+            name (str): one of INDEXED
+            key (int): deleted key
+        """
+        directory: typing.Dict = self._directory(name)
+        pages: typing.List[typing.List[int]] = directory["pages"]
+        if len(pages) == 0:
+            return
+        position: int = self._find_page(pages, key)
+        number: int = pages[position][1]
+        keys: typing.List[int] = self._page(name, number)
+        if key not in keys:
+            return
+        keys.remove(key)
+        if len(keys) == 0 and len(pages) > 1:
+            pages.pop(position)
+            self._put(f"pages:{name}", number, None)
+            self._put("pages", name, dict_to_bytes(directory))
+        else:
+            self._put(f"pages:{name}", number, list_to_bytes(keys))
+
+    def _iter_index(
+        self, name: str, after: typing.Optional[int], batch_size: int
+    ) -> typing.Iterator[typing.List[int]]:
+        """Keys of the hash in ascending order, batch_size at a time.
+        Only one page is read at once, and the index is read again for the next page,
+        so keys added or removed meanwhile are seen
+
+        Args:
+            name (str): one of INDEXED
+            after (typing.Optional[int]): start after this key
+            batch_size (int): keys in one batch
+
+        Yields:
+            typing.List[int]: next batch of keys
+        """
+        batch: typing.List[int] = []
+        while True:
+            pages: typing.List[typing.List[int]] = self._directory(name)["pages"]
+            keys: typing.List[int] = []
+            for _, number in pages[0 if after is None else self._find_page(pages, after) :]:
+                keys = [key for key in self._page(name, number) if after is None or key > after]
+                if len(keys) > 0:
+                    break
+            if len(keys) == 0:
+                break
+            after = keys[-1]
+            batch.extend(keys)
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if len(batch) > 0:
+            yield batch
+
     async def close(self) -> None:
         logging.debug("DBHelper close")
+        self._flush()
         self._database.close()
 
     async def wait_closed(self) -> None:
@@ -89,69 +415,199 @@ class DBHelper(BaseStorage):
         """
         logging.debug("DBHelper debug")
         result = {}
-        with self._database.transaction():
+        with self._transaction():
             result["user_id"] = self._userid.to_dict()
+            for part in PARTS:
+                result[part] = self._parts[part].to_dict()
             result["glpi_id"] = self._glpi_id.to_dict()
             result["ticket"] = self._tickets.to_dict()
+            result["checker"] = self._checker.to_dict()
         return result
 
+    def _ticket_hash(self, glpi_id: int) -> vedis.Hash:
+        """Tickets of the glpi user, one key per ticket.
+        Must be called inside a transaction: a snapshot of the single blob layout
+        is moved there on the first access"""
+        tickets: vedis.Hash = self._database.Hash(f"tickets:{glpi_id}")
+        if glpi_id in self._split_tickets:
+            return tickets
+        layout: typing.Optional[bytes] = self._tickets[glpi_id]
+        if layout != SPLIT:
+            if layout is not None:
+                for ticket_id, ticket in bytes_to_dict(layout).items():
+                    tickets[ticket_id] = dict_to_bytes(ticket)
+            else:
+                self._index_add("tickets", glpi_id)
+            self._tickets[glpi_id] = SPLIT
+        self._split_tickets.add(glpi_id)
+        return tickets
+
     def all_tickets_glpi(self, glpi_id: int) -> typing.Dict[int, typing.Dict]:
         """ Return all tickets for glpi user """
-        with self._database.transaction():
-            if self._tickets and glpi_id in self._tickets:
-                tickets: typing.Dict = bytes_to_dict(self._tickets[glpi_id])
-                logging.info("tickets = %s", tickets)
-                return {int(ticket_id): tickets[ticket_id] for ticket_id in tickets}
-        return {}
+        with self._transaction():
+            tickets: typing.Dict[int, typing.Dict] = {
+                bytes_to_int(ticket_id): bytes_to_dict(ticket)
+                for ticket_id, ticket in self._ticket_hash(glpi_id).items()
+            }
+        logging.debug("all_tickets_glpi: glpi_id = %s tickets = %d", glpi_id, len(tickets))
+        return tickets
 
     def all_user(self) -> typing.List[int]:
         """ Return all user_id """
-        logging.info("dbhelper.all_user")
-        with self._database.transaction():
-            logging.info(
-                "self._userid = %s, self._userid.keys() = %s",
-                self._userid,
-                self._userid.keys(),
-            )
-            if self._userid.keys() is None:
-                return []
-            return list(map(bytes_to_int, self._userid.keys()))
+        return [user_id for batch in self.iter_users() for user_id in batch]
+
+    def iter_users(self, batch_size: int = BATCH_SIZE) -> typing.Iterator[typing.List[int]]:
+        """Telegram user_id in ascending order, batch_size at a time
+
+        Args:
+            batch_size (int, optional): users in one batch. Defaults to BATCH_SIZE.
+
+        Yields:
+            typing.List[int]: next batch of user_id
+        """
+        yield from self._iter_index("user_id", None, batch_size)
+
+    def iter_user_records(
+        self, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.List[typing.Dict]]:
+        """State, data and bucket of users in ascending order of user_id.
+        They are read from vedis past the cache, so a pass over all users
+        does not evict the users the bot works with
+
+        Args:
+            batch_size (int, optional): users in one batch. Defaults to BATCH_SIZE.
+
+        Yields:
+            typing.List[typing.Dict]: next batch of {"user", "state", "data", "bucket"}
+        """
+        for batch in self.iter_users(batch_size):
+            user_ids: typing.List[str] = [str(user_id) for user_id in batch]
+            with self._transaction():
+                layouts: typing.List[typing.Optional[bytes]] = self._userid.mget(*user_ids)
+                # mget of a hash that was never written gives None
+                parts: typing.Dict[str, typing.List[typing.Optional[bytes]]] = {
+                    part: self._parts[part].mget(*user_ids) or [None] * len(user_ids)
+                    for part in PARTS
+                }
+            records: typing.List[typing.Dict] = []
+            for position, (user_id, layout) in enumerate(zip(batch, layouts)):
+                if layout is not None and layout != SPLIT:
+                    whole_data: typing.Dict = bytes_to_dict(layout)
+                    state: typing.Any = whole_data.get(STATE, None)
+                    data: typing.Any = whole_data.get(DATA, None) or {}
+                    bucket: typing.Any = whole_data.get(BUCKET, None) or {}
+                else:
+                    raw_state: typing.Optional[bytes] = parts[STATE][position]
+                    raw_data: typing.Optional[bytes] = parts[DATA][position]
+                    raw_bucket: typing.Optional[bytes] = parts[BUCKET][position]
+                    state = None if raw_state is None else raw_state.decode("utf8")
+                    data = {} if raw_data is None else bytes_to_dict(raw_data)
+                    bucket = {} if raw_bucket is None else bytes_to_dict(raw_bucket)
+                records.append({"user": user_id, STATE: state, DATA: data, BUCKET: bucket})
+            yield records
+
+    def iter_glpi_index(
+        self, after: typing.Optional[int] = None, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.List[typing.Tuple[int, typing.List[int]]]]:
+        """Glpi users with their telegram users in ascending order of glpi_id.
+        glpi_id are taken from the key index, the lists of telegram users with one mget per batch
+
+        Args:
+            after (typing.Optional[int], optional): start after this glpi_id. Defaults to None.
+            batch_size (int, optional): glpi users in one batch. Defaults to BATCH_SIZE.
+
+        Yields:
+            typing.List[typing.Tuple[int, typing.List[int]]]: next batch of (glpi_id, user_id list)
+        """
+        for batch in self._iter_index("glpi", after, batch_size):
+            with self._transaction():
+                user_lists: typing.List[typing.Optional[bytes]] = self._glpi_id.mget(*batch)
+            yield [
+                (glpi_id, bytes_to_list(user_list))
+                for glpi_id, user_list in zip(batch, user_lists)
+                if user_list is not None
+            ]
+
+    def count_glpi_users(self) -> int:
+        """ Return number of glpi users linked to telegram users """
+        with self._transaction():
+            return self._database.hlen("glpi")
+
+    def iter_ticket_owners(self, batch_size: int = BATCH_SIZE) -> typing.Iterator[typing.List[int]]:
+        """Glpi users with saved tickets in ascending order of glpi_id, batch_size at a time.
+        They may be no longer linked to a telegram user
+
+        Args:
+            batch_size (int, optional): glpi users in one batch. Defaults to BATCH_SIZE.
+
+        Yields:
+            typing.List[int]: next batch of glpi_id
+        """
+        yield from self._iter_index("tickets", None, batch_size)
+
+    def iter_tickets_glpi(
+        self, glpi_id: int, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.Dict[int, typing.Dict]]:
+        """Tickets of the glpi user in ascending order of ticket_id, batch_size at a time
+
+        Args:
+            glpi_id (int): glpi user id
+            batch_size (int, optional): tickets in one batch. Defaults to BATCH_SIZE.
+
+        Yields:
+            typing.Dict[int, typing.Dict]: next batch of tickets by ticket_id
+        """
+        with self._transaction():
+            tickets: vedis.Hash = self._ticket_hash(glpi_id)
+            ticket_ids: typing.List[int] = sorted(map(bytes_to_int, tickets.keys() or []))
+        for start in range(0, len(ticket_ids), batch_size):
+            batch: typing.List[int] = ticket_ids[start : start + batch_size]
+            with self._transaction():
+                values: typing.List[typing.Optional[bytes]] = tickets.mget(*batch)
+            yield {
+                ticket_id: bytes_to_dict(ticket)
+                for ticket_id, ticket in zip(batch, values)
+                if ticket is not None
+            }
 
     def write_tickets_glpi(
         self, glpi_id: int, data: typing.Dict[int, typing.Dict]
     ) -> None:
-        """ Write tickets corresponding to specific glpi_id user """
-        with self._database.transaction():
-            self._tickets[glpi_id] = dict_to_bytes(data)
-
-    # def update_tickets(
-    #     self,
-    #     replace_ticket_dict: typing.Dict = None,
-    #     delete_ticket_id: typing.List[int] = None,
-    # ):
-    #     """ Add changed tickets, delete deleted tickets """
-    #     if replace_ticket_dict is None:
-    #         replace_ticket_dict = dict()
-    #     if delete_ticket_id is None:
-    #         delete_ticket_id = []
-    #     if len(replace_ticket_dict) == 0 and len(delete_ticket_id) == 0:
-    #         return
-
-    #     logging.info(
-    #         "update_tickets: replace_ticket_dict = %s %s delete_ticket_id = %s",
-    #         len(replace_ticket_dict),
-    #         replace_ticket_dict,
-    #         delete_ticket_id,
-    #     )
-    #     with self._database.transaction():
-    #         for ticket_id in replace_ticket_dict:
-    #             self._tickets[ticket_id] = dict_to_bytes(replace_ticket_dict[ticket_id])
-    #         for ticket_id in delete_ticket_id:
-    #             del self._tickets[ticket_id]
+        """ Write tickets corresponding to specific glpi_id user, the others are deleted """
+        with self._transaction():
+            stored: typing.List[int] = list(
+                map(bytes_to_int, self._ticket_hash(glpi_id).keys() or [])
+            )
+        self.update_tickets_glpi(
+            glpi_id, data, [ticket_id for ticket_id in stored if ticket_id not in data]
+        )
+
+    def update_tickets_glpi(
+        self,
+        glpi_id: int,
+        changed: typing.Dict[int, typing.Dict],
+        deleted: typing.Iterable[int] = (),
+    ) -> None:
+        """Write only changed tickets of the glpi user and delete removed ones
+
+        Args:
+            glpi_id (int): glpi user id
+            changed (typing.Dict[int, typing.Dict]): new or changed tickets
+            deleted (typing.Iterable[int]): ids of tickets to delete. Defaults to ().
+        """
+        if glpi_id not in self._split_tickets:
+            with self._transaction():
+                self._ticket_hash(glpi_id)
+        with self._writing():
+            for ticket_id in deleted:
+                self._put(f"tickets:{glpi_id}", ticket_id, None)
+            for ticket_id, ticket in changed.items():
+                self._put(f"tickets:{glpi_id}", ticket_id, dict_to_bytes(ticket))
+
     def _resolve_address(
         self, chat: typing.Union[str, int, None], user: typing.Union[str, int, None]
     ) -> str:
-        """Fills data if the user is new
+        """Fills data if the user is new, moves the user to the split layout
 
         Args:
             chat (int): chat_id for telegram
@@ -170,47 +626,105 @@ class DBHelper(BaseStorage):
             )
         user_id = str(user)
 
-        if user_id not in self._userid:
-            self._userid[user_id] = dict_to_bytes({STATE: None, DATA: {}, BUCKET: {}})
+        if user_id in self._cache:
+            return user_id
+        with self._transaction():
+            layout: typing.Optional[bytes] = self._userid[user_id]
+            if layout is None:
+                self._put("user_id", user_id, SPLIT)
+                self._index_add("user_id", int(user_id))
+                self._cache_record(user_id, {STATE: None, DATA: {}, BUCKET: {}})
+            elif layout != SPLIT:
+                self._split(user_id, bytes_to_dict(layout))
         return user_id
 
-    def _get_whole_data(
-        self,
-        chat: typing.Union[str, int, None] = None,
-        user: typing.Union[str, int, None] = None,
-    ) -> typing.Dict:
-        """Return all known data for current telegram user
+    def _split(self, user_id: str, whole_data: typing.Dict) -> None:
+        """Moves record of the single blob layout to separate keys.
+        Must be called inside a transaction
 
         Args:
-            chat (typing.Union[str, int, None], optional): chat_id for telegram. Defaults to None.
-            user (typing.Union[str, int, None], optional): user_id for telegram. Defaults to None.
+            user_id (str): telegram user_id
+            whole_data (typing.Dict): decoded blob with state, data and bucket
+        """
+        logging.info("DBHelper: user %s is moved to the split layout", user_id)
+        for part in PARTS:
+            self._store_part(user_id, part, whole_data.get(part, None))
+        self._put("user_id", user_id, SPLIT)
+
+    def migrate(self) -> int:
+        """Moves all users of the single blob layout to separate keys.
+        Users are moved on their first access anyway, this only speeds it up
 
         Returns:
-            typing.Dict: [description]
+            int: number of moved users
         """
-        user = self._resolve_address(chat=chat, user=user)
-        with self._database.transaction():
-            whole_data: typing.Dict = bytes_to_dict(self._userid[user])
-        return whole_data
+        moved: int = 0
+        for batch in self.iter_users():
+            user_ids: typing.List[str] = [str(user_id) for user_id in batch]
+            with self._transaction():
+                layouts: typing.List[typing.Optional[bytes]] = self._userid.mget(*user_ids)
+                for user_id, layout in zip(user_ids, layouts):
+                    if layout is not None and layout != SPLIT:
+                        self._split(user_id, bytes_to_dict(layout))
+                        moved += 1
+        if moved > 0:
+            logging.info("DBHelper migrate: %d users are moved to the split layout", moved)
+        return moved
 
-    def _set_whole_data(
-        self,
-        chat: typing.Union[str, int, None] = None,
-        user: typing.Union[str, int, None] = None,
-        whole_data: typing.Optional[typing.Dict] = None,
-    ) -> None:
-        """Writes all known data for specific user to database
+    def _peek_part(self, user_id: str, part: str) -> typing.Any:
+        """Return state, data or bucket of the user without a copy.
+        The result may be the cached value, so it must not be changed
 
         Args:
-            chat (typing.Union[str, int, None], optional): chat_id for telegram. Defaults to None.
-            user (typing.Union[str, int, None], optional): user_id for telegram. Defaults to None.
-            whole_data (typing.Dict, optional): data to store. Defaults to None.
+            user_id (str): resolved telegram user_id
+            part (str): STATE, DATA or BUCKET
+
+        Returns:
+            typing.Any: decoded value, None or empty dict when it was never written
         """
-        if whole_data is None:
-            whole_data = {}
-        user = self._resolve_address(chat=chat, user=user)
-        with self._database.transaction():
-            self._userid[user] = dict_to_bytes(whole_data)
+        record: typing.Optional[typing.Dict] = self._cache.get(user_id, None)
+        if record is not None:
+            self._cache.move_to_end(user_id)
+            if part in record:
+                return record[part]
+        with self._transaction():
+            raw: typing.Optional[bytes] = self._parts[part][user_id]
+        value: typing.Any
+        if part == STATE:
+            value = None if raw is None else raw.decode("utf8")
+        else:
+            value = {} if raw is None else bytes_to_dict(raw)
+        self._remember(user_id, part, value)
+        return value
+
+    def _get_part(self, user_id: str, part: str) -> typing.Any:
+        """ Return state, data or bucket of the user, free to change """
+        value: typing.Any = self._peek_part(user_id, part)
+        if self._cache_size <= 0:
+            return value
+        return copy.deepcopy(value)
+
+    def _store_part(self, user_id: str, part: str, value: typing.Any) -> None:
+        """ Encodes and writes one part with _put """
+        if value is None:
+            self._put(part, user_id, None)
+        elif part == STATE:
+            self._put(part, user_id, str(value).encode("utf8"))
+        else:
+            self._put(part, user_id, dict_to_bytes(value))
+
+    def _write_part(self, user_id: str, part: str, value: typing.Any) -> None:
+        """Writes state, data or bucket of the user, nothing else is touched
+
+        Args:
+            user_id (str): resolved telegram user_id
+            part (str): STATE, DATA or BUCKET
+            value (typing.Any): new value, the caller may change it later
+        """
+        with self._writing():
+            self._store_part(user_id, part, value)
+        if self._cache_size > 0:
+            self._remember(user_id, part, copy.deepcopy(value))
 
     async def get_state(
         self,
@@ -220,7 +734,10 @@ class DBHelper(BaseStorage):
         default: typing.Optional[str] = None,
     ) -> typing.Optional[str]:
         logging.debug("DBHelper get_state")
-        return self._get_whole_data(chat=chat, user=user).get(STATE, default)
+        state: typing.Optional[str] = self._peek_part(
+            self._resolve_address(chat=chat, user=user), STATE
+        )
+        return default if state is None else state
 
     async def set_state(
         self,
@@ -228,12 +745,9 @@ class DBHelper(BaseStorage):
         chat: typing.Union[str, int, None],
         user: typing.Union[str, int, None],
         state: typing.Optional[typing.AnyStr],
-    ):
+    ) -> None:
         # logging.debug("DBHelper set_state %s", state)
-        whole_data = self._get_whole_data(chat, user)
-        whole_data[STATE] = state
-        # logging.info("DBHelper set_state writes %s", whole_data)
-        self._set_whole_data(chat=chat, user=user, whole_data=whole_data)
+        self._write_part(self._resolve_address(chat=chat, user=user), STATE, state)
 
     async def get_data(
         self,
@@ -243,7 +757,7 @@ class DBHelper(BaseStorage):
         default: typing.Optional[typing.Dict] = None,
     ) -> typing.Dict:
         logging.debug("DBHelper get_data")
-        return self._get_whole_data(chat, user).get(DATA, default)
+        return self._get_part(self._resolve_address(chat=chat, user=user), DATA)
 
     async def set_data(
         self,
@@ -253,9 +767,9 @@ class DBHelper(BaseStorage):
         data: typing.Dict,
     ) -> None:
         logging.debug("DBHelper set_data")
-        whole_data = self._get_whole_data(chat, user)
-        whole_data[DATA] = data
-        self._set_whole_data(chat=chat, user=user, whole_data=whole_data)
+        user_id: str = self._resolve_address(chat=chat, user=user)
+        self._update_glpi_index(user_id, self._peek_part(user_id, DATA), data)
+        self._write_part(user_id, DATA, data)
 
     async def update_data(
         self,
@@ -266,57 +780,245 @@ class DBHelper(BaseStorage):
         **kwargs: typing.Dict[str, typing.Any],
     ) -> None:
         logging.debug("DBHelper update_data")
-        whole_data = self._get_whole_data(chat, user)
-        whole_data["data"].update(data, **kwargs)
-        self._set_whole_data(chat=chat, user=user, whole_data=whole_data)
-
-    # def add_glpi_id(self, user: typing.Union[str, int, None], glpi_id: int):
-    #     with self._database.transaction():
-    #         if glpi_id in self._glpi_id:
-    #             data = bytes_to_dict(self._glpi_id[glpi_id])
-    #         else:
-    #             data = []
-    #         self._glpi_id[glpi_id] = dict_to_bytes(data + [int(user)])
-
-    # def delete_glpi_id(self, user: typing.Union[str, int, None], glpi_id: int):
-    #     with self._database.transaction():
-    #         if glpi_id in self._glpi_id:
-    #             data = bytes_to_dict(self._glpi_id[glpi_id])
-    #         else:
-    #             return
-    #         try:
-    #             data.remove(int(user))
-    #         except ValueError:
-    #             return
-    #         self._glpi_id[glpi_id] = dict_to_bytes(data)
+        self._modify_data(
+            self._resolve_address(chat=chat, user=user),
+            lambda new_data: new_data.update(data, **kwargs),
+        )
+
+    async def pop_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        keys: typing.Iterable[str],
+        default: typing.Any = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """Deletes several keys from data of the user in one write
+
+        Args:
+            chat (typing.Union[str, int, None]): chat_id for telegram
+            user (typing.Union[str, int, None]): user_id for telegram
+            keys (typing.Iterable[str]): keys to delete
+            default (typing.Any, optional): value of a missing key. Defaults to None.
+
+        Returns:
+            typing.Dict[str, typing.Any]: deleted values by key
+        """
+        logging.debug("DBHelper pop_data")
+        return self._modify_data(
+            self._resolve_address(chat=chat, user=user),
+            lambda new_data: {key: new_data.pop(key, default) for key in keys},
+        )
+
+    async def compare_and_update_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        expected: typing.Dict,
+        data: typing.Dict,
+    ) -> bool:
+        """Updates data of the user only if it still has the expected values
+
+        Args:
+            chat (typing.Union[str, int, None]): chat_id for telegram
+            user (typing.Union[str, int, None]): user_id for telegram
+            expected (typing.Dict): values to compare, None stands for a missing key
+            data (typing.Dict): values to set when all of them match
+
+        Returns:
+            bool: True if data is updated
+        """
+        logging.debug("DBHelper compare_and_update_data")
+
+        def change(new_data: typing.Dict) -> bool:
+            if any(new_data.get(key, None) != value for key, value in expected.items()):
+                return False
+            new_data.update(data)
+            return True
+
+        return self._modify_data(self._resolve_address(chat=chat, user=user), change)
+
+    def _modify_data(
+        self, user_id: str, change: typing.Callable[[typing.Dict], typing.Any]
+    ) -> typing.Any:
+        """Read-modify-write of data of the user. Nothing is awaited in between,
+        so other handlers of the bot can't change the data meanwhile
+
+        Args:
+            user_id (str): resolved telegram user_id
+            change (typing.Callable[[typing.Dict], typing.Any]): changes a copy of data in place
+
+        Returns:
+            typing.Any: result of change
+        """
+        old_data: typing.Dict = self._peek_part(user_id, DATA)
+        new_data: typing.Dict = dict(old_data)
+        result: typing.Any = change(new_data)
+        if new_data != old_data:
+            self._update_glpi_index(user_id, old_data, new_data)
+            self._write_part(user_id, DATA, new_data)
+        return result
+
+    def add_glpi_id(self, user: typing.Union[str, int], glpi_id: int) -> None:
+        """ Link telegram user to glpi user """
+        user_list: typing.Optional[bytes] = self._read("glpi", glpi_id)
+        data: typing.List[int] = [] if user_list is None else bytes_to_list(user_list)
+        if int(user) not in data:
+            # The index is committed together with the user data
+            with self._writing():
+                self._put("glpi", glpi_id, list_to_bytes(data + [int(user)]))
+                if user_list is None:
+                    self._index_add("glpi", glpi_id)
+
+    def delete_glpi_id(self, user: typing.Union[str, int], glpi_id: int) -> None:
+        """ Unlink telegram user from glpi user """
+        user_list: typing.Optional[bytes] = self._read("glpi", glpi_id)
+        data: typing.List[int] = [] if user_list is None else bytes_to_list(user_list)
+        if int(user) not in data:
+            return
+        data.remove(int(user))
+        with self._writing():
+            self._put("glpi", glpi_id, list_to_bytes(data) if len(data) > 0 else None)
+            if len(data) == 0:
+                self._index_remove("glpi", glpi_id)
+
+    def _update_glpi_index(
+        self,
+        user: typing.Union[str, int],
+        old_data: typing.Optional[typing.Dict],
+        new_data: typing.Optional[typing.Dict],
+    ) -> None:
+        """Keeps glpi_id -> user_id index in line with user data
+
+        Args:
+            user (typing.Union[str, int]): user_id for telegram
+            old_data (typing.Optional[typing.Dict]): data before the change
+            new_data (typing.Optional[typing.Dict]): data after the change
+        """
+        old_glpi_id = (old_data or {}).get(GLPI_ID, None)
+        new_glpi_id = (new_data or {}).get(GLPI_ID, None)
+        if old_glpi_id == new_glpi_id:
+            return
+        if old_glpi_id is not None:
+            self.delete_glpi_id(user, old_glpi_id)
+        if new_glpi_id is not None:
+            self.add_glpi_id(user, new_glpi_id)
+
+    def glpi_index(self) -> typing.Dict[int, typing.List[int]]:
+        """ Return telegram users for every known glpi user """
+        with self._transaction():
+            return {
+                bytes_to_int(glpi_id): bytes_to_list(user_list)
+                for glpi_id, user_list in self._glpi_id.items()
+            }
+
+    def rebuild_glpi_index(self) -> None:
+        """ Fill glpi_id -> user_id index from data of every user """
+        index: typing.Dict[int, typing.List[int]] = {}
+        for batch in self.iter_users():
+            for user_id in batch:
+                glpi_id = self._peek_part(
+                    self._resolve_address(chat=user_id, user=user_id), DATA
+                ).get(GLPI_ID, None)
+                if glpi_id is not None:
+                    index.setdefault(glpi_id, []).append(user_id)
+        with self._transaction():
+            for glpi_id in self._glpi_id.keys() or []:
+                if bytes_to_int(glpi_id) not in index:
+                    del self._glpi_id[glpi_id]
+            for glpi_id, user_list in index.items():
+                self._glpi_id[glpi_id] = list_to_bytes(user_list)
+        self._build_pages("glpi")
+        logging.info("DBHelper rebuild_glpi_index: %d glpi users", len(index))
+
+    def get_checker_state(self, key: str, default: typing.Any = None) -> typing.Any:
+        """ Return value saved by the checker """
+        with self._transaction():
+            if key in self._checker:
+                return json.loads(self._checker[key].decode("utf8"))
+        return default
+
+    def set_checker_state(self, key: str, value: typing.Any) -> None:
+        """ Save value of the checker """
+        with self._writing():
+            self._put("checker", key, json.dumps(value).encode("utf8"))
+
+    def iter_checker_states(
+        self, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+        """Every value saved by the checker, batch_size at a time.
+        There is one key per polled glpi user
+
+        Args:
+            batch_size (int, optional): values in one batch. Defaults to BATCH_SIZE.
+
+        Yields:
+            typing.Dict[str, typing.Any]: next batch of values by key
+        """
+        with self._transaction():
+            keys: typing.List[str] = sorted(key.decode("utf8") for key in self._checker.keys() or [])
+        for start in range(0, len(keys), batch_size):
+            batch: typing.List[str] = keys[start : start + batch_size]
+            with self._transaction():
+                values: typing.List[typing.Optional[bytes]] = self._checker.mget(*batch)
+            yield {
+                key: json.loads(value.decode("utf8"))
+                for key, value in zip(batch, values)
+                if value is not None
+            }
+
+    def get_checker_states(
+        self, keys: typing.List[str], default: typing.Any = None
+    ) -> typing.Dict[str, typing.Any]:
+        """ Return several values saved by the checker in one transaction """
+        with self._transaction():
+            return {
+                key: json.loads(self._checker[key].decode("utf8"))
+                if key in self._checker
+                else default
+                for key in keys
+            }
+
+    def set_checker_states(self, values: typing.Dict[str, typing.Any]) -> None:
+        """ Save several values of the checker in one transaction """
+        with self._writing():
+            for key, value in values.items():
+                self._put("checker", key, json.dumps(value).encode("utf8"))
+
+    def has_bucket(self) -> bool:
+        return True
 
     async def get_bucket(
         self,
         *,
-        chat: typing.Union[str, int, None],
-        user: typing.Union[str, int, None],
-        default: typing.Optional[dict],
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        default: typing.Optional[dict] = None,
     ) -> typing.Dict:
-        # TODO under construction
-        raise NotImplementedError
+        logging.debug("DBHelper get_bucket")
+        return self._get_part(self._resolve_address(chat=chat, user=user), BUCKET)
 
     async def set_bucket(
         self,
         *,
-        chat: typing.Union[str, int, None],
-        user: typing.Union[str, int, None],
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
         bucket: typing.Dict,
     ) -> None:
-        # TODO under construction
-        raise NotImplementedError
+        logging.debug("DBHelper set_bucket")
+        self._write_part(self._resolve_address(chat=chat, user=user), BUCKET, bucket)
 
     async def update_bucket(
         self,
         *,
-        chat: typing.Union[str, int, None],
-        user: typing.Union[str, int, None],
-        bucket: typing.Dict,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        bucket: typing.Optional[typing.Dict] = None,
         **kwargs: typing.Dict[str, typing.Any],
     ) -> None:
-        # TODO under construction
-        raise NotImplementedError
+        logging.debug("DBHelper update_bucket")
+        user_id: str = self._resolve_address(chat=chat, user=user)
+        new_bucket: typing.Dict = dict(self._peek_part(user_id, BUCKET))
+        new_bucket.update(bucket or {}, **kwargs)
+        self._write_part(user_id, BUCKET, new_bucket)
@@ -0,0 +1,41 @@
+"""Async locks of user records. Handlers hold the lock of the user from the first
+read of the record to the last write, so updates of one user go one by one while
+different users are served in parallel
+"""
+import asyncio
+import typing
+
+# Keys share this many locks, so memory does not grow with the number of users
+STRIPES = 1024
+
+
+class KeyedLocks:
+    """asyncio lock for every key, keys with the same hash modulo stripes share one"""
+
+    def __init__(self, stripes: int = STRIPES):
+        self._locks: typing.List[typing.Optional[asyncio.Lock]] = [None] * stripes
+
+    def __call__(self, key: typing.Hashable) -> asyncio.Lock:
+        """Lock of the key, to be used as `async with locks(key):`
+
+        Args:
+            key (typing.Hashable): normally telegram user_id
+
+        Returns:
+            asyncio.Lock: the lock, not reentrant
+        """
+        stripe: int = hash(key) % len(self._locks)
+        lock: typing.Optional[asyncio.Lock] = self._locks[stripe]
+        if lock is None:
+            # Created on first use: the lock is bound to the running event loop
+            lock = asyncio.Lock()
+            self._locks[stripe] = lock
+        return lock
+
+    def locked(self, key: typing.Hashable) -> bool:
+        """ The record of the key is being changed now """
+        lock: typing.Optional[asyncio.Lock] = self._locks[hash(key) % len(self._locks)]
+        return lock is not None and lock.locked()
+
+
+USER_LOCKS = KeyedLocks()
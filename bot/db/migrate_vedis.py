@@ -0,0 +1,121 @@
+"""Copies users, tickets and checker state from vedis file to SQLite file.
+
+Stop the bot and the checker first. Records of the single blob layout are
+split in the vedis file on the way, it stays usable by DBHelper.
+With STORAGE_BACKEND=sqlite the bot and the checker do it themselves on the
+first start when there is DB_FILE and no SQLITE_FILE yet.
+
+Usage:
+    python -m bot.db.migrate_vedis /data/db.db /data/db.sqlite3
+"""
+import argparse
+import asyncio
+import fcntl
+import logging
+import os
+import sys
+
+from bot.db.dbhelper import DBHelper
+from bot.db.sqlitehelper import SQLiteHelper
+
+
+async def migrate(source: DBHelper, target: SQLiteHelper) -> None:
+    """ Copy everything from source to target, one batch of records at a time """
+    source.migrate()
+    users: int = 0
+    for batch in source.iter_users():
+        for user_id in batch:
+            await target.set_state(
+                chat=user_id, user=user_id, state=await source.get_state(chat=user_id, user=user_id)
+            )
+            await target.set_data(
+                chat=user_id, user=user_id, data=await source.get_data(chat=user_id, user=user_id)
+            )
+            await target.set_bucket(
+                chat=user_id,
+                user=user_id,
+                bucket=await source.get_bucket(chat=user_id, user=user_id),
+            )
+        users += len(batch)
+    owners: int = 0
+    for batch in source.iter_ticket_owners():
+        for glpi_id in batch:
+            target.write_tickets_glpi(glpi_id, {})
+            for tickets in source.iter_tickets_glpi(glpi_id):
+                target.update_tickets_glpi(glpi_id, tickets)
+        owners += len(batch)
+    keys: int = 0
+    for states in source.iter_checker_states():
+        target.set_checker_states(states)
+        keys += len(states)
+    logging.info(
+        "migrate_vedis: %d users, %d glpi users with tickets, %d checker keys",
+        users,
+        owners,
+        keys,
+    )
+
+
+def migrate_files(vedis_file: str, sqlite_file: str) -> None:
+    """Copy vedis file to SQLite file on an event loop of its own
+
+    Args:
+        vedis_file (str): vedis file of DBHelper
+        sqlite_file (str): SQLite file, created if missing
+    """
+    source = DBHelper(vedis_file)
+    target = SQLiteHelper(sqlite_file)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(migrate(source, target))
+    finally:
+        loop.run_until_complete(source.close())
+        loop.run_until_complete(target.close())
+        loop.close()
+
+
+def migrate_once(vedis_file: str, sqlite_file: str) -> bool:
+    """Copy vedis file to SQLite file unless the SQLite file exists.
+    The bot and the checker start together: the lock lets one of them copy while
+    the other waits. The copy gets its name only when complete, so an interrupted
+    one starts over on the next start
+
+    Args:
+        vedis_file (str): vedis file of DBHelper
+        sqlite_file (str): SQLite file
+
+    Returns:
+        bool: True if the data is copied now
+    """
+    with open(sqlite_file + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(sqlite_file) or not os.path.exists(vedis_file):
+            return False
+        logging.warning(
+            "migrate_vedis: %s is copied to %s, the vedis file is not used any more",
+            vedis_file,
+            sqlite_file,
+        )
+        partial: str = sqlite_file + ".partial"
+        for name in (partial, partial + "-wal", partial + "-shm"):
+            if os.path.exists(name):
+                os.remove(name)
+        migrate_files(vedis_file, partial)
+        os.replace(partial, sqlite_file)
+    return True
+
+
+def main() -> int:
+    """ Entry point """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("vedis", help="vedis file of DBHelper")
+    parser.add_argument("sqlite", help="SQLite file, created if missing")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    migrate_files(args.vedis, args.sqlite)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""Durable queue of notifications between the checker and the bot processes
+"""
+import json
+import logging
+import os
+import time
+import typing
+import uuid
+
+MESSAGE = "message"
+LOGOUT = "logout"
+
+_NEW = "new"
+_TMP = "tmp"
+_KEYS = "keys"
+
+
+def new_entry(
+    user_id: int,
+    text: str,
+    reply_markup: typing.Optional[typing.Dict],
+    action: str,
+    changed: typing.Optional[float],
+) -> typing.Tuple[str, typing.Dict]:
+    """Name and content of a new queue entry.
+    Names start with time in nanoseconds, so sorting them keeps the order
+
+    Returns:
+        typing.Tuple[str, typing.Dict]: name without extension and the entry
+    """
+    name: str = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+    entry: typing.Dict = {
+        "user_id": user_id,
+        "action": action,
+        "text": text,
+        "reply_markup": reply_markup,
+        "created": time.time(),
+        "changed": changed,
+    }
+    return name, entry
+
+
+class Outbox:
+    """Spool directory used as a local durable queue.
+
+    Every notification is a separate json file. The file is written in tmp/ and
+    then atomically renamed into new/, so the reader never sees a partial entry
+    and nothing is lost if one of the processes is killed.
+    File names start with time in nanoseconds, so sorting them keeps the order.
+
+    An entry may carry an idempotency key: the key is remembered in keys/ and
+    the same notification put again (e.g. after the checker was restarted
+    before it saved tickets) is dropped.
+    """
+
+    def __init__(self, directory: str):
+        logging.debug("Outbox __init__ %s", directory)
+        self._new: str = os.path.join(directory, _NEW)
+        self._tmp: str = os.path.join(directory, _TMP)
+        self._keys: str = os.path.join(directory, _KEYS)
+        os.makedirs(self._new, exist_ok=True)
+        os.makedirs(self._tmp, exist_ok=True)
+        os.makedirs(self._keys, exist_ok=True)
+
+    def put(
+        self,
+        user_id: int,
+        text: str = "",
+        reply_markup: typing.Optional[typing.Dict] = None,
+        action: str = MESSAGE,
+        key: typing.Optional[str] = None,
+        changed: typing.Optional[float] = None,
+    ) -> typing.Optional[str]:
+        """Add notification to the queue
+
+        Args:
+            user_id (int): telegram user id
+            text (str): message text
+            reply_markup (typing.Optional[typing.Dict]): keyboard as python dict. Defaults to None.
+            action (str): what the bot should do. Defaults to MESSAGE.
+            key (typing.Optional[str]): idempotency key. Defaults to None.
+            changed (typing.Optional[float]): when the change happened in GLPI, to measure lag. Defaults to None.
+
+        Returns:
+            typing.Optional[str]: name of the queue entry, None if it is a repeat
+        """
+        key_path: typing.Optional[str] = None
+        if key is not None:
+            key_path = os.path.join(self._keys, key)
+            if os.path.exists(key_path):
+                logging.info("Outbox drops repeated notification %s", key)
+                return None
+        name, entry = new_entry(user_id, text, reply_markup, action, changed)
+        name += ".json"
+        self._write(name, entry)
+        if key_path is not None:
+            # After the entry: a crash in between gives a repeat, not a loss
+            with open(key_path, "w", encoding="utf8"):
+                pass
+        logging.debug("Outbox put %s %s", name, entry)
+        return name
+
+    def _write(self, name: str, entry: typing.Dict) -> None:
+        """ Write entry to tmp/ and move it to new/ """
+        tmp_path: str = os.path.join(self._tmp, name)
+        with open(tmp_path, "w", encoding="utf8") as file:
+            json.dump(entry, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, os.path.join(self._new, name))
+
+    def update(self, name: str, entry: typing.Dict) -> None:
+        """ Atomically replace queued entry, e.g. to save delivery progress """
+        self._write(name, entry)
+
+    def pending(self) -> typing.List[str]:
+        """ Return names of all queued entries, the oldest first """
+        return sorted(name for name in os.listdir(self._new) if name.endswith(".json"))
+
+    def read(self, name: str) -> typing.Dict:
+        """ Return queued entry """
+        with open(os.path.join(self._new, name), encoding="utf8") as file:
+            return json.load(file)
+
+    def ack(self, name: str) -> None:
+        """ Remove delivered entry from the queue """
+        try:
+            os.remove(os.path.join(self._new, name))
+        except FileNotFoundError:
+            logging.warning("Outbox entry %s is already removed", name)
+
+    def expire_keys(self, max_age: float) -> int:
+        """Forget idempotency keys older than max_age seconds
+
+        Returns:
+            int: number of removed keys
+        """
+        deadline: float = time.time() - max_age
+        removed: int = 0
+        with os.scandir(self._keys) as entries:
+            for key in entries:
+                try:
+                    if key.stat().st_mtime < deadline:
+                        os.remove(key.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
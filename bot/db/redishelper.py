@@ -0,0 +1,572 @@
+"""Manage comunication with Redis.
+The same storage as DBHelper for several bot and checker processes that share
+it over the network. Keys (PREFIX is prepended):
+    users - set of telegram user_id
+    user:<user_id> - hash with state, data and bucket of the user
+    glpi_of - hash telegram user_id -> glpi_id
+    tickets:<glpi_id> - hash ticket_id -> snapshot of the ticket
+    checker - hash with state of the checker
+    outbox - hash entry name -> notification queued for the bot
+    outbox_key:<key> - idempotency key of a notification, expires by itself
+"""
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import typing
+from aiogram.dispatcher.storage import BaseStorage
+import redis
+
+from bot.db.dbhelper import BATCH_SIZE, BUCKET, DATA, GLPI_ID, STATE
+from bot.db.outbox import MESSAGE, new_entry
+
+PREFIX = "glpibot:"
+# Threads that run commands of the async methods, so the event loop does not wait for Redis
+THREADS = 4
+
+
+class RedisHelper(BaseStorage):
+    """Storage of the bot and the checker in Redis.
+    Writes of several keys are sent as one MULTI/EXEC pipeline, read-modify-write
+    of user data retries on a concurrent change (WATCH).
+    The async methods of aiogram storage run the client in THREADS threads,
+    the other ones are called by the checker and block like the other storages
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = PREFIX):
+        logging.debug("RedisHelper __init__")
+        self._prefix: str = prefix
+        self._redis: redis.Redis = redis.Redis.from_url(url, decode_responses=True)
+        self._users: str = prefix + "users"
+        self._glpi_of: str = prefix + "glpi_of"
+        self._checker: str = prefix + "checker"
+        self._executor: concurrent.futures.ThreadPoolExecutor = (
+            concurrent.futures.ThreadPoolExecutor(THREADS, thread_name_prefix="redis")
+        )
+
+    async def _call(self, function: typing.Callable[..., typing.Any], *args: typing.Any) -> typing.Any:
+        """ Run blocking function of the client in a thread """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(function, *args)
+        )
+
+    def _user(self, user_id: str) -> str:
+        return f"{self._prefix}user:{user_id}"
+
+    def _tickets(self, glpi_id: typing.Union[int, str]) -> str:
+        return f"{self._prefix}tickets:{glpi_id}"
+
+    # The client decodes responses, so every reply holds str, never bytes
+    def _hget(self, name: str, key: str) -> typing.Optional[str]:
+        return typing.cast(typing.Optional[str], self._redis.hget(name, key))
+
+    def _smembers(self, name: str) -> typing.Set[str]:
+        return typing.cast(typing.Set[str], self._redis.smembers(name))
+
+    def _hscan(self, name: str, cursor: int, count: int) -> typing.Tuple[int, typing.Dict[str, str]]:
+        return typing.cast(
+            typing.Tuple[int, typing.Dict[str, str]], self._redis.hscan(name, cursor, count=count)
+        )
+
+    async def close(self) -> None:
+        logging.debug("RedisHelper close")
+        self._executor.shutdown(wait=True)
+        self._redis.close()
+
+    async def wait_closed(self) -> None:
+        logging.debug("RedisHelper wait_closed")
+
+    def export(self) -> typing.Dict:
+        """Exports database content
+
+        Returns:
+            typing.Dict: database content
+        """
+        logging.debug("RedisHelper export")
+        users: typing.List[str] = sorted(self._smembers(self._users))
+        pipe = self._redis.pipeline(transaction=False)
+        for user_id in users:
+            pipe.hgetall(self._user(user_id))
+        records = pipe.execute()
+        tickets_prefix: str = self._prefix + "tickets:"
+        tickets: typing.Dict[str, typing.Dict] = {
+            key[len(tickets_prefix) :]: self._redis.hgetall(key)
+            for key in self._redis.scan_iter(match=tickets_prefix + "*")
+        }
+        return {
+            "users": dict(zip(users, records)),
+            "glpi_of": self._redis.hgetall(self._glpi_of),
+            "tickets": tickets,
+            "checker": self._redis.hgetall(self._checker),
+        }
+
+    def migrate(self) -> int:
+        """ Nothing to migrate, keys are created on write """
+        return 0
+
+    def all_tickets_glpi(self, glpi_id: int) -> typing.Dict[int, typing.Dict]:
+        """ Return all tickets for glpi user """
+        return {
+            int(ticket_id): json.loads(ticket)
+            for ticket_id, ticket in self._redis.hgetall(self._tickets(glpi_id)).items()
+        }
+
+    def all_user(self) -> typing.List[int]:
+        """ Return all user_id """
+        return sorted(int(user_id) for user_id in self._smembers(self._users))
+
+    def iter_users(self, batch_size: int = BATCH_SIZE) -> typing.Iterator[typing.List[int]]:
+        """Telegram user_id read with SSCAN, batch_size is a hint for Redis.
+        Unlike the other storages the order is arbitrary, and a user added
+        meanwhile may come twice"""
+        cursor: int = 0
+        while True:
+            cursor, members = self._redis.sscan(self._users, cursor, count=batch_size)
+            if len(members) > 0:
+                yield sorted(int(user_id) for user_id in members)
+            if cursor == 0:
+                return
+
+    def iter_user_records(
+        self, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.List[typing.Dict]]:
+        """ State, data and bucket of users in the order of iter_users, one pipeline per batch """
+        for batch in self.iter_users(batch_size):
+            pipe = self._redis.pipeline(transaction=False)
+            for user_id in batch:
+                pipe.hmget(self._user(str(user_id)), STATE, DATA, BUCKET)
+            yield [
+                {
+                    "user": user_id,
+                    STATE: state,
+                    DATA: json.loads(data or "{}"),
+                    BUCKET: json.loads(bucket or "{}"),
+                }
+                for user_id, (state, data, bucket) in zip(batch, pipe.execute())
+            ]
+
+    def iter_glpi_index(
+        self, after: typing.Optional[int] = None, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.List[typing.Tuple[int, typing.List[int]]]]:
+        """Glpi users with their telegram users in ascending order of glpi_id.
+        glpi_of is keyed by telegram user, so it is read with HSCAN and
+        grouped by glpi_id first: only ids are kept in memory"""
+        index: typing.Dict[int, typing.List[int]] = {}
+        for user_id, glpi_id in self._redis.hscan_iter(self._glpi_of, count=batch_size):
+            if after is None or int(glpi_id) > after:
+                index.setdefault(int(glpi_id), []).append(int(user_id))
+        glpi_ids: typing.List[int] = sorted(index)
+        for start in range(0, len(glpi_ids), batch_size):
+            yield [
+                (glpi_id, sorted(index[glpi_id]))
+                for glpi_id in glpi_ids[start : start + batch_size]
+            ]
+
+    def count_glpi_users(self) -> int:
+        """ Return number of glpi users linked to telegram users """
+        return len(set(self._redis.hvals(self._glpi_of)))
+
+    def iter_tickets_glpi(
+        self, glpi_id: int, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.Dict[int, typing.Dict]]:
+        """ Tickets of the glpi user read with HSCAN, in arbitrary order """
+        cursor: int = 0
+        while True:
+            cursor, tickets = self._hscan(self._tickets(glpi_id), cursor, batch_size)
+            if len(tickets) > 0:
+                yield {int(ticket_id): json.loads(ticket) for ticket_id, ticket in tickets.items()}
+            if cursor == 0:
+                return
+
+    def write_tickets_glpi(
+        self, glpi_id: int, data: typing.Dict[int, typing.Dict]
+    ) -> None:
+        """ Write tickets corresponding to specific glpi_id user """
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.delete(self._tickets(glpi_id))
+        if len(data) > 0:
+            pipe.hset(
+                self._tickets(glpi_id),
+                mapping={ticket_id: json.dumps(ticket) for ticket_id, ticket in data.items()},
+            )
+        pipe.execute()
+
+    def update_tickets_glpi(
+        self,
+        glpi_id: int,
+        changed: typing.Dict[int, typing.Dict],
+        deleted: typing.Iterable[int] = (),
+    ) -> None:
+        """ Write only changed tickets of the glpi user and delete removed ones """
+        deleted = list(deleted)
+        pipe = self._redis.pipeline(transaction=True)
+        if len(deleted) > 0:
+            pipe.hdel(self._tickets(glpi_id), *deleted)
+        if len(changed) > 0:
+            pipe.hset(
+                self._tickets(glpi_id),
+                mapping={ticket_id: json.dumps(ticket) for ticket_id, ticket in changed.items()},
+            )
+        pipe.execute()
+
+    def _resolve_address(
+        self, chat: typing.Union[str, int, None], user: typing.Union[str, int, None]
+    ) -> str:
+        """Checks the address. A user gets its keys on the first write only
+
+        Args:
+            chat (int): chat_id for telegram
+            user (int): user_id for telegram
+
+        Raises:
+            AttributeError: chat_id is not equal to user_id
+
+        Returns:
+            str: telegram user_id
+        """
+        chat, user = self.check_address(chat=chat, user=user)
+        if chat != user:
+            raise AttributeError(
+                f"Program error: chat_id {chat} is not equal user_id {user}"
+            )
+        return str(user)
+
+    def _write(self, pipe: typing.Any, user_id: str, part: str, value: typing.Any) -> None:
+        """ Queue write of one part of the user to the pipeline """
+        pipe.sadd(self._users, user_id)
+        if value is None:
+            pipe.hdel(self._user(user_id), part)
+        elif part == STATE:
+            pipe.hset(self._user(user_id), part, str(value))
+        else:
+            pipe.hset(self._user(user_id), part, json.dumps(value))
+        if part == DATA:
+            glpi_id: typing.Optional[int] = (value or {}).get(GLPI_ID, None)
+            if glpi_id is None:
+                pipe.hdel(self._glpi_of, user_id)
+            else:
+                pipe.hset(self._glpi_of, user_id, glpi_id)
+
+    def _set_part(self, user_id: str, part: str, value: typing.Any) -> None:
+        pipe = self._redis.pipeline(transaction=True)
+        self._write(pipe, user_id, part, value)
+        pipe.execute()
+
+    def _modify_part(
+        self, user_id: str, part: str, change: typing.Callable[[typing.Dict], typing.Any]
+    ) -> typing.Any:
+        """Read-modify-write of data or bucket, again if another process changed it meanwhile
+
+        Args:
+            user_id (str): telegram user_id
+            part (str): DATA or BUCKET
+            change (typing.Callable[[typing.Dict], typing.Any]): changes the value in place
+
+        Returns:
+            typing.Any: result of change
+        """
+
+        def modify(pipe: typing.Any) -> typing.Any:
+            old_value: typing.Dict = json.loads(pipe.hget(self._user(user_id), part) or "{}")
+            new_value: typing.Dict = dict(old_value)
+            result: typing.Any = change(new_value)
+            pipe.multi()
+            if new_value != old_value:
+                self._write(pipe, user_id, part, new_value)
+            return result
+
+        return self._redis.transaction(modify, self._user(user_id), value_from_callable=True)
+
+    def _update_part(self, user_id: str, part: str, changes: typing.Dict) -> None:
+        """ Merge changes into data or bucket """
+        self._modify_part(user_id, part, lambda value: value.update(changes))
+
+    async def get_state(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        default: typing.Optional[str] = None,
+    ) -> typing.Optional[str]:
+        logging.debug("RedisHelper get_state")
+        state: typing.Optional[str] = await self._call(
+            self._hget, self._user(self._resolve_address(chat, user)), STATE
+        )
+        return default if state is None else state
+
+    async def set_state(
+        self,
+        *,
+        chat: typing.Union[str, int, None],
+        user: typing.Union[str, int, None],
+        state: typing.Optional[typing.AnyStr],
+    ) -> None:
+        await self._call(self._set_part, self._resolve_address(chat, user), STATE, state)
+
+    async def get_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        default: typing.Optional[typing.Dict] = None,
+    ) -> typing.Dict:
+        logging.debug("RedisHelper get_data")
+        return json.loads(
+            await self._call(self._hget, self._user(self._resolve_address(chat, user)), DATA)
+            or "{}"
+        )
+
+    async def set_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        data: typing.Dict,
+    ) -> None:
+        logging.debug("RedisHelper set_data")
+        await self._call(self._set_part, self._resolve_address(chat, user), DATA, data)
+
+    async def update_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None],
+        user: typing.Union[str, int, None],
+        data: typing.Dict,
+        **kwargs: typing.Dict[str, typing.Any],
+    ) -> None:
+        logging.debug("RedisHelper update_data")
+        await self._call(
+            self._update_part, self._resolve_address(chat, user), DATA, dict(data, **kwargs)
+        )
+
+    async def pop_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        keys: typing.Iterable[str],
+        default: typing.Any = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """ Delete several keys from data of the user, return their values """
+        logging.debug("RedisHelper pop_data")
+        # The change may run again on a conflict
+        keys = list(keys)
+        return await self._call(
+            self._modify_part,
+            self._resolve_address(chat, user),
+            DATA,
+            lambda new_data: {key: new_data.pop(key, default) for key in keys},
+        )
+
+    async def compare_and_update_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        expected: typing.Dict,
+        data: typing.Dict,
+    ) -> bool:
+        """ Update data of the user only if it still has the expected values """
+        logging.debug("RedisHelper compare_and_update_data")
+
+        def change(new_data: typing.Dict) -> bool:
+            if any(new_data.get(key, None) != value for key, value in expected.items()):
+                return False
+            new_data.update(data)
+            return True
+
+        return await self._call(self._modify_part, self._resolve_address(chat, user), DATA, change)
+
+    def has_bucket(self) -> bool:
+        return True
+
+    async def get_bucket(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        default: typing.Optional[dict] = None,
+    ) -> typing.Dict:
+        logging.debug("RedisHelper get_bucket")
+        return json.loads(
+            await self._call(self._hget, self._user(self._resolve_address(chat, user)), BUCKET)
+            or "{}"
+        )
+
+    async def set_bucket(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        bucket: typing.Dict,
+    ) -> None:
+        logging.debug("RedisHelper set_bucket")
+        await self._call(self._set_part, self._resolve_address(chat, user), BUCKET, bucket)
+
+    async def update_bucket(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        bucket: typing.Optional[typing.Dict] = None,
+        **kwargs: typing.Dict[str, typing.Any],
+    ) -> None:
+        logging.debug("RedisHelper update_bucket")
+        await self._call(
+            self._update_part,
+            self._resolve_address(chat, user),
+            BUCKET,
+            dict(bucket or {}, **kwargs),
+        )
+
+    def glpi_index(self) -> typing.Dict[int, typing.List[int]]:
+        """ Return telegram users for every known glpi user """
+        index: typing.Dict[int, typing.List[int]] = {}
+        for user_id, glpi_id in self._redis.hgetall(self._glpi_of).items():
+            index.setdefault(int(glpi_id), []).append(int(user_id))
+        for user_list in index.values():
+            user_list.sort()
+        return index
+
+    def rebuild_glpi_index(self) -> None:
+        """ Fill glpi_of from data of every user """
+        users: typing.List[str] = list(self._smembers(self._users))
+        pipe = self._redis.pipeline(transaction=False)
+        for user_id in users:
+            pipe.hget(self._user(user_id), DATA)
+        glpi_of: typing.Dict[str, int] = {}
+        for user_id, data in zip(users, pipe.execute()):
+            glpi_id = json.loads(data or "{}").get(GLPI_ID, None)
+            if glpi_id is not None:
+                glpi_of[user_id] = glpi_id
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.delete(self._glpi_of)
+        if len(glpi_of) > 0:
+            pipe.hset(
+                self._glpi_of, mapping={user_id: glpi_id for user_id, glpi_id in glpi_of.items()}
+            )
+        pipe.execute()
+        logging.info("RedisHelper rebuild_glpi_index: %d glpi users", len(set(glpi_of.values())))
+
+    def get_checker_state(self, key: str, default: typing.Any = None) -> typing.Any:
+        """ Return value saved by the checker """
+        value: typing.Optional[str] = self._hget(self._checker, key)
+        return default if value is None else json.loads(value)
+
+    def set_checker_state(self, key: str, value: typing.Any) -> None:
+        """ Save value of the checker """
+        self._redis.hset(self._checker, key, json.dumps(value))
+
+    def get_checker_states(
+        self, keys: typing.List[str], default: typing.Any = None
+    ) -> typing.Dict[str, typing.Any]:
+        """ Return several values saved by the checker in one round trip """
+        if len(keys) == 0:
+            return {}
+        return {
+            key: default if value is None else json.loads(value)
+            for key, value in zip(keys, self._redis.hmget(self._checker, keys))
+        }
+
+    def set_checker_states(self, values: typing.Dict[str, typing.Any]) -> None:
+        """ Save several values of the checker in one round trip """
+        if len(values) == 0:
+            return
+        self._redis.hset(
+            self._checker, mapping={key: json.dumps(value) for key, value in values.items()}
+        )
+
+
+class RedisOutbox:
+    """The outbox of bot/db/outbox.py kept in Redis, for bot and checker processes
+    that do not share a disk. An entry and its idempotency key are written in one
+    MULTI/EXEC, so a crash gives neither a loss nor a repeat, and Redis expires
+    the keys after key_ttl seconds itself
+    """
+
+    def __init__(self, url: str, key_ttl: int, prefix: str = PREFIX):
+        logging.debug("RedisOutbox __init__")
+        self._redis: redis.Redis = redis.Redis.from_url(url, decode_responses=True)
+        self._entries: str = prefix + "outbox"
+        self._key_prefix: str = prefix + "outbox_key:"
+        self._key_ttl: int = key_ttl
+
+    def put(
+        self,
+        user_id: int,
+        text: str = "",
+        reply_markup: typing.Optional[typing.Dict] = None,
+        action: str = MESSAGE,
+        key: typing.Optional[str] = None,
+        changed: typing.Optional[float] = None,
+    ) -> typing.Optional[str]:
+        """Add notification to the queue
+
+        Args:
+            user_id (int): telegram user id
+            text (str): message text
+            reply_markup (typing.Optional[typing.Dict]): keyboard as python dict. Defaults to None.
+            action (str): what the bot should do. Defaults to MESSAGE.
+            key (typing.Optional[str]): idempotency key. Defaults to None.
+            changed (typing.Optional[float]): when the change happened in GLPI, to measure lag. Defaults to None.
+
+        Returns:
+            typing.Optional[str]: name of the queue entry, None if it is a repeat
+        """
+        name, entry = new_entry(user_id, text, reply_markup, action, changed)
+        watched: typing.List[str] = [] if key is None else [self._key_prefix + key]
+
+        def add(pipe: typing.Any) -> typing.Any:
+            if len(watched) > 0 and pipe.exists(*watched):
+                return None
+            pipe.multi()
+            pipe.hset(self._entries, name, json.dumps(entry))
+            for key_name in watched:
+                pipe.set(key_name, name, ex=self._key_ttl)
+            return name
+
+        result: typing.Optional[str] = typing.cast(
+            typing.Optional[str], self._redis.transaction(add, *watched, value_from_callable=True)
+        )
+        if result is None:
+            logging.info("Outbox drops repeated notification %s", key)
+        else:
+            logging.debug("Outbox put %s %s", name, entry)
+        return result
+
+    def update(self, name: str, entry: typing.Dict) -> None:
+        """ Replace queued entry, e.g. to save delivery progress. An acked entry stays removed """
+
+        def replace(pipe: typing.Any) -> None:
+            if pipe.hexists(self._entries, name):
+                pipe.multi()
+                pipe.hset(self._entries, name, json.dumps(entry))
+
+        self._redis.transaction(replace, self._entries)
+
+    def pending(self) -> typing.List[str]:
+        """ Return names of all queued entries, the oldest first """
+        return sorted(typing.cast(typing.List[str], self._redis.hkeys(self._entries)))
+
+    def read(self, name: str) -> typing.Dict:
+        """ Return queued entry, KeyError if it is removed """
+        value: typing.Optional[str] = typing.cast(
+            typing.Optional[str], self._redis.hget(self._entries, name)
+        )
+        if value is None:
+            raise KeyError(name)
+        return json.loads(value)
+
+    def ack(self, name: str) -> None:
+        """ Remove delivered entry from the queue """
+        if self._redis.hdel(self._entries, name) == 0:
+            logging.warning("Outbox entry %s is already removed", name)
+
+    def expire_keys(self, max_age: float) -> int:
+        """Idempotency keys expire in Redis by themselves
+
+        Returns:
+            int: always 0
+        """
+        return 0
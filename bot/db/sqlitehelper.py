@@ -0,0 +1,464 @@
+"""Manage comunication with SQLite database.
+The same storage as DBHelper, but the bot and the checker may read it at once
+(WAL journal), and users, glpi users and tickets are indexed rows
+"""
+import json
+import logging
+import sqlite3
+import typing
+from aiogram.dispatcher.storage import BaseStorage
+
+from bot.db.dbhelper import BATCH_SIZE, BUCKET, DATA, GLPI_ID, STATE
+
+# Seconds a writer waits for the other process to finish its transaction
+BUSY_TIMEOUT = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    bucket TEXT NOT NULL DEFAULT '{}',
+    glpi_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS users_glpi_id ON users (glpi_id) WHERE glpi_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS tickets (
+    glpi_id INTEGER NOT NULL,
+    ticket_id INTEGER NOT NULL,
+    ticket TEXT NOT NULL,
+    PRIMARY KEY (glpi_id, ticket_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS checker (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteHelper(BaseStorage):
+    """Storage of the bot and the checker in SQLite.
+    glpi_id of a user is a column next to its data, so glpi_index is always
+    in line with the data and needs no rebuild
+    """
+
+    def __init__(self, filename: str = ":memory:"):
+        logging.debug("SQLiteHelper __init__")
+        self._filename: str = filename
+        self._connection: sqlite3.Connection = sqlite3.connect(
+            self._filename, timeout=BUSY_TIMEOUT
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # WAL stays consistent after a crash with NORMAL, only the last commits may be lost
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    async def close(self) -> None:
+        logging.debug("SQLiteHelper close")
+        self._connection.close()
+
+    async def wait_closed(self) -> None:
+        logging.debug("SQLiteHelper wait_closed")
+
+    def export(self) -> typing.Dict:
+        """Exports database content
+
+        Returns:
+            typing.Dict: database content
+        """
+        logging.debug("SQLiteHelper export")
+        result = {}
+        for table in ("users", "tickets", "checker"):
+            result[table] = self._connection.execute(f"SELECT * FROM {table}").fetchall()
+        return result
+
+    def migrate(self) -> int:
+        """ Nothing to migrate, the schema is created on open """
+        return 0
+
+    def all_tickets_glpi(self, glpi_id: int) -> typing.Dict[int, typing.Dict]:
+        """ Return all tickets for glpi user """
+        return {
+            ticket_id: json.loads(ticket)
+            for ticket_id, ticket in self._connection.execute(
+                "SELECT ticket_id, ticket FROM tickets WHERE glpi_id = ?", (glpi_id,)
+            )
+        }
+
+    def all_user(self) -> typing.List[int]:
+        """ Return all user_id """
+        return [user_id for batch in self.iter_users() for user_id in batch]
+
+    def iter_users(self, batch_size: int = BATCH_SIZE) -> typing.Iterator[typing.List[int]]:
+        """ Telegram user_id in ascending order, one query per batch """
+        after: typing.Optional[int] = None
+        while True:
+            batch: typing.List[int] = [
+                user_id
+                for (user_id,) in self._connection.execute(
+                    "SELECT user_id FROM users WHERE ? IS NULL OR user_id > ?"
+                    " ORDER BY user_id LIMIT ?",
+                    (after, after, batch_size),
+                )
+            ]
+            if len(batch) == 0:
+                return
+            yield batch
+            after = batch[-1]
+
+    def iter_user_records(
+        self, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.List[typing.Dict]]:
+        """ State, data and bucket of users in ascending order of user_id, one query per batch """
+        after: typing.Optional[int] = None
+        while True:
+            batch: typing.List[typing.Dict] = [
+                {"user": user_id, STATE: state, DATA: json.loads(data), BUCKET: json.loads(bucket)}
+                for user_id, state, data, bucket in self._connection.execute(
+                    "SELECT user_id, state, data, bucket FROM users WHERE ? IS NULL OR user_id > ?"
+                    " ORDER BY user_id LIMIT ?",
+                    (after, after, batch_size),
+                )
+            ]
+            if len(batch) == 0:
+                return
+            yield batch
+            after = batch[-1]["user"]
+
+    def iter_glpi_index(
+        self, after: typing.Optional[int] = None, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.List[typing.Tuple[int, typing.List[int]]]]:
+        """ Glpi users with their telegram users by ascending glpi_id, two queries per batch """
+        while True:
+            glpi_ids: typing.List[int] = [
+                glpi_id
+                for (glpi_id,) in self._connection.execute(
+                    "SELECT DISTINCT glpi_id FROM users"
+                    " WHERE glpi_id IS NOT NULL AND (? IS NULL OR glpi_id > ?)"
+                    " ORDER BY glpi_id LIMIT ?",
+                    (after, after, batch_size),
+                )
+            ]
+            if len(glpi_ids) == 0:
+                return
+            batch: typing.Dict[int, typing.List[int]] = {glpi_id: [] for glpi_id in glpi_ids}
+            for glpi_id, user_id in self._connection.execute(
+                "SELECT glpi_id, user_id FROM users WHERE glpi_id BETWEEN ? AND ?"
+                " ORDER BY glpi_id, user_id",
+                (glpi_ids[0], glpi_ids[-1]),
+            ):
+                if glpi_id in batch:
+                    batch[glpi_id].append(user_id)
+            yield [(glpi_id, user_ids) for glpi_id, user_ids in batch.items() if user_ids]
+            after = glpi_ids[-1]
+
+    def count_glpi_users(self) -> int:
+        """ Return number of glpi users linked to telegram users """
+        return self._connection.execute(
+            "SELECT COUNT(DISTINCT glpi_id) FROM users"
+        ).fetchone()[0]
+
+    def iter_tickets_glpi(
+        self, glpi_id: int, batch_size: int = BATCH_SIZE
+    ) -> typing.Iterator[typing.Dict[int, typing.Dict]]:
+        """ Tickets of the glpi user in ascending order of ticket_id, one query per batch """
+        after: int = -1
+        while True:
+            batch: typing.Dict[int, typing.Dict] = {
+                ticket_id: json.loads(ticket)
+                for ticket_id, ticket in self._connection.execute(
+                    "SELECT ticket_id, ticket FROM tickets WHERE glpi_id = ? AND ticket_id > ?"
+                    " ORDER BY ticket_id LIMIT ?",
+                    (glpi_id, after, batch_size),
+                )
+            }
+            if len(batch) == 0:
+                return
+            yield batch
+            after = max(batch)
+
+    def write_tickets_glpi(
+        self, glpi_id: int, data: typing.Dict[int, typing.Dict]
+    ) -> None:
+        """ Write tickets corresponding to specific glpi_id user """
+        with self._connection:
+            self._connection.execute("DELETE FROM tickets WHERE glpi_id = ?", (glpi_id,))
+            self._connection.executemany(
+                "INSERT INTO tickets (glpi_id, ticket_id, ticket) VALUES (?, ?, ?)",
+                (
+                    (glpi_id, int(ticket_id), json.dumps(ticket))
+                    for ticket_id, ticket in data.items()
+                ),
+            )
+
+    def update_tickets_glpi(
+        self,
+        glpi_id: int,
+        changed: typing.Dict[int, typing.Dict],
+        deleted: typing.Iterable[int] = (),
+    ) -> None:
+        """ Upsert only changed tickets of the glpi user and delete removed ones """
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM tickets WHERE glpi_id = ? AND ticket_id = ?",
+                ((glpi_id, int(ticket_id)) for ticket_id in deleted),
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO tickets (glpi_id, ticket_id, ticket) VALUES (?, ?, ?)",
+                (
+                    (glpi_id, int(ticket_id), json.dumps(ticket))
+                    for ticket_id, ticket in changed.items()
+                ),
+            )
+
+    def _resolve_address(
+        self, chat: typing.Union[str, int, None], user: typing.Union[str, int, None]
+    ) -> int:
+        """Checks the address. Unlike DBHelper a user gets a row on the first write only
+
+        Args:
+            chat (int): chat_id for telegram
+            user (int): user_id for telegram
+
+        Raises:
+            AttributeError: chat_id is not equal to user_id
+
+        Returns:
+            int: telegram user_id
+        """
+        chat, user = self.check_address(chat=chat, user=user)
+        if chat != user:
+            raise AttributeError(
+                f"Program error: chat_id {chat} is not equal user_id {user}"
+            )
+        return int(user)
+
+    def _read(self, user_id: int, column: str) -> typing.Optional[str]:
+        row = self._connection.execute(
+            f"SELECT {column} FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _write(self, user_id: int, **columns: typing.Any) -> None:
+        """ Insert or update some columns of the user row """
+        names: typing.List[str] = list(columns)
+        with self._connection:
+            self._connection.execute(
+                f"INSERT INTO users (user_id, {', '.join(names)})"
+                f" VALUES (?{', ?' * len(names)})"
+                " ON CONFLICT (user_id) DO UPDATE SET "
+                + ", ".join(f"{name} = excluded.{name}" for name in names),
+                (user_id, *columns.values()),
+            )
+
+    async def get_state(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        default: typing.Optional[str] = None,
+    ) -> typing.Optional[str]:
+        logging.debug("SQLiteHelper get_state")
+        state: typing.Optional[str] = self._read(self._resolve_address(chat, user), "state")
+        return default if state is None else state
+
+    async def set_state(
+        self,
+        *,
+        chat: typing.Union[str, int, None],
+        user: typing.Union[str, int, None],
+        state: typing.Optional[typing.AnyStr],
+    ) -> None:
+        self._write(
+            self._resolve_address(chat, user), state=None if state is None else str(state)
+        )
+
+    async def get_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        default: typing.Optional[typing.Dict] = None,
+    ) -> typing.Dict:
+        logging.debug("SQLiteHelper get_data")
+        return json.loads(self._read(self._resolve_address(chat, user), "data") or "{}")
+
+    async def set_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        data: typing.Dict,
+    ) -> None:
+        logging.debug("SQLiteHelper set_data")
+        self._write(
+            self._resolve_address(chat, user),
+            data=json.dumps(data),
+            glpi_id=data.get(GLPI_ID, None),
+        )
+
+    async def update_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None],
+        user: typing.Union[str, int, None],
+        data: typing.Dict,
+        **kwargs: typing.Dict[str, typing.Any],
+    ) -> None:
+        logging.debug("SQLiteHelper update_data")
+        self._modify_data(
+            self._resolve_address(chat, user),
+            lambda new_data: new_data.update(data, **kwargs),
+        )
+
+    async def pop_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        keys: typing.Iterable[str],
+        default: typing.Any = None,
+    ) -> typing.Dict[str, typing.Any]:
+        """ Delete several keys from data of the user, return their values """
+        logging.debug("SQLiteHelper pop_data")
+        return self._modify_data(
+            self._resolve_address(chat, user),
+            lambda new_data: {key: new_data.pop(key, default) for key in keys},
+        )
+
+    async def compare_and_update_data(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        expected: typing.Dict,
+        data: typing.Dict,
+    ) -> bool:
+        """ Update data of the user only if it still has the expected values """
+        logging.debug("SQLiteHelper compare_and_update_data")
+
+        def change(new_data: typing.Dict) -> bool:
+            if any(new_data.get(key, None) != value for key, value in expected.items()):
+                return False
+            new_data.update(data)
+            return True
+
+        return self._modify_data(self._resolve_address(chat, user), change)
+
+    def _modify_data(
+        self, user_id: int, change: typing.Callable[[typing.Dict], typing.Any]
+    ) -> typing.Any:
+        """Read-modify-write of data of the user. The write lock is taken before
+        the read, so the other process can't change the row in between
+
+        Args:
+            user_id (int): telegram user_id
+            change (typing.Callable[[typing.Dict], typing.Any]): changes data in place
+
+        Returns:
+            typing.Any: result of change
+        """
+        with self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            old_data: typing.Dict = json.loads(self._read(user_id, "data") or "{}")
+            new_data: typing.Dict = dict(old_data)
+            result: typing.Any = change(new_data)
+            if new_data != old_data:
+                self._connection.execute(
+                    "INSERT INTO users (user_id, data, glpi_id) VALUES (?, ?, ?)"
+                    " ON CONFLICT (user_id) DO UPDATE SET"
+                    " data = excluded.data, glpi_id = excluded.glpi_id",
+                    (user_id, json.dumps(new_data), new_data.get(GLPI_ID, None)),
+                )
+        return result
+
+    def has_bucket(self) -> bool:
+        return True
+
+    async def get_bucket(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        default: typing.Optional[dict] = None,
+    ) -> typing.Dict:
+        logging.debug("SQLiteHelper get_bucket")
+        return json.loads(self._read(self._resolve_address(chat, user), "bucket") or "{}")
+
+    async def set_bucket(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        bucket: typing.Dict,
+    ) -> None:
+        logging.debug("SQLiteHelper set_bucket")
+        self._write(self._resolve_address(chat, user), bucket=json.dumps(bucket))
+
+    async def update_bucket(
+        self,
+        *,
+        chat: typing.Union[str, int, None] = None,
+        user: typing.Union[str, int, None] = None,
+        bucket: typing.Optional[typing.Dict] = None,
+        **kwargs: typing.Dict[str, typing.Any],
+    ) -> None:
+        logging.debug("SQLiteHelper update_bucket")
+        new_bucket: typing.Dict = await self.get_bucket(chat=chat, user=user)
+        new_bucket.update(bucket or {}, **kwargs)
+        await self.set_bucket(chat=chat, user=user, bucket=new_bucket)
+
+    def glpi_index(self) -> typing.Dict[int, typing.List[int]]:
+        """ Return telegram users for every known glpi user """
+        index: typing.Dict[int, typing.List[int]] = {}
+        for glpi_id, user_id in self._connection.execute(
+            "SELECT glpi_id, user_id FROM users WHERE glpi_id IS NOT NULL ORDER BY glpi_id"
+        ):
+            index.setdefault(glpi_id, []).append(user_id)
+        return index
+
+    def rebuild_glpi_index(self) -> None:
+        """ Fill glpi_id column from data of every user, for rows written by hand """
+        with self._connection:
+            self._connection.execute(
+                "UPDATE users SET glpi_id = json_extract(data, '$.glpi_id')"
+                " WHERE glpi_id IS NOT json_extract(data, '$.glpi_id')"
+            )
+        logging.info("SQLiteHelper rebuild_glpi_index: %d glpi users", len(self.glpi_index()))
+
+    def get_checker_state(self, key: str, default: typing.Any = None) -> typing.Any:
+        """ Return value saved by the checker """
+        row = self._connection.execute(
+            "SELECT value FROM checker WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_checker_state(self, key: str, value: typing.Any) -> None:
+        """ Save value of the checker """
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO checker (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    def get_checker_states(
+        self, keys: typing.List[str], default: typing.Any = None
+    ) -> typing.Dict[str, typing.Any]:
+        """ Return several values saved by the checker in one query """
+        result: typing.Dict[str, typing.Any] = {key: default for key in keys}
+        # Stay below the limit of SQLite on query parameters
+        for start in range(0, len(keys), 500):
+            chunk: typing.List[str] = keys[start : start + 500]
+            for key, value in self._connection.execute(
+                f"SELECT key, value FROM checker WHERE key IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ):
+                result[key] = json.loads(value)
+        return result
+
+    def set_checker_states(self, values: typing.Dict[str, typing.Any]) -> None:
+        """ Save several values of the checker in one transaction """
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO checker (key, value) VALUES (?, ?)",
+                ((key, json.dumps(value)) for key, value in values.items()),
+            )
@@ -0,0 +1,55 @@
+"""Opens the storage selected in config
+"""
+import typing
+
+import config
+from bot.db.dbhelper import DBHelper
+from bot.db.migrate_vedis import migrate_once
+from bot.db.outbox import Outbox
+from bot.db.sqlitehelper import SQLiteHelper
+
+if typing.TYPE_CHECKING:
+    from bot.db.redishelper import RedisHelper, RedisOutbox  # pylint: disable=unused-import
+
+Storage = typing.Union[DBHelper, SQLiteHelper, "RedisHelper"]
+NotificationQueue = typing.Union[Outbox, "RedisOutbox"]
+
+
+def open_storage(
+    cache_size: int = 0, batch_window: typing.Optional[float] = None
+) -> Storage:
+    """Storage of STORAGE_BACKEND
+
+    Args:
+        cache_size (int, optional): user records kept in memory by vedis storage,
+            SQLite has its own page cache. Defaults to 0.
+        batch_window (typing.Optional[float], optional): seconds vedis storage
+            gathers writes into one transaction. Defaults to None - no batching.
+
+    Returns:
+        Storage: DBHelper, SQLiteHelper or RedisHelper
+    """
+    if config.STORAGE_BACKEND == "redis":
+        # redis is needed only for this backend
+        from bot.db.redishelper import RedisHelper  # pylint: disable=import-outside-toplevel
+
+        return RedisHelper(config.REDIS_URL)
+    if config.STORAGE_BACKEND == "sqlite":
+        # Users of a deployment that ran on vedis before keep their logins
+        migrate_once(config.DB_FILE, config.SQLITE_FILE)
+        return SQLiteHelper(config.SQLITE_FILE)
+    return DBHelper(config.DB_FILE, cache_size=cache_size, batch_window=batch_window)
+
+
+def open_outbox() -> NotificationQueue:
+    """Queue of notifications from the checker to the bot.
+    With STORAGE_BACKEND=redis it is kept in Redis too, so the processes need no common disk
+
+    Returns:
+        NotificationQueue: Outbox in OUTBOX_DIR or RedisOutbox
+    """
+    if config.STORAGE_BACKEND == "redis":
+        from bot.db.redishelper import RedisOutbox  # pylint: disable=import-outside-toplevel
+
+        return RedisOutbox(config.REDIS_URL, key_ttl=config.OUTBOX_KEY_TTL)
+    return Outbox(config.OUTBOX_DIR)
@@ -15,6 +15,8 @@ from functools import wraps
 import requests
 import urllib3
 
+from bot.metrics import count_glpi_request
+
 _UPLOAD_MANIFEST = (
     '{{ "input": {{ "name": "{name:s}", "_filename" : ["{filename:s}"] }} }}'
 )
@@ -119,6 +121,7 @@ class GLPI:
 
         # Initialize session.
         self.session = requests.Session()
+        self.session.hooks["response"].append(count_glpi_request)
         if not verify_certs:
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
             self.session.verify = False
@@ -134,6 +137,20 @@ class GLPI:
         # Use for caching field id/uid map.
         self._fields: typing.Dict[str, typing.Dict] = {}
 
+    def clone(self) -> "GLPI":
+        """Same GLPI session over its own ``requests`` session, for another thread:
+        ``requests.Session`` is not thread-safe. The clone does not kill the GLPI
+        session and must not be used after the original is closed.
+        """
+        clone: GLPI = GLPI.__new__(GLPI)
+        clone.url = self.url
+        clone.session = requests.Session()
+        clone.session.hooks["response"].append(count_glpi_request)
+        clone.session.verify = self.session.verify
+        clone.session.headers.update(self.session.headers)
+        clone._fields = {}
+        return clone
+
     def __enter__(self) -> "GLPI":
         logging.info("__enter__")
         return self
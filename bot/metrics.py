@@ -0,0 +1,135 @@
+"""In-process counters and timings of the checker and the notifier
+"""
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import time
+import typing
+
+SAMPLES = 1000
+LAG = "lag"
+
+
+class Summary:
+    """Count, total and max of all observed values plus the latest SAMPLES of them"""
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self.samples: typing.Deque[float] = collections.deque(maxlen=SAMPLES)
+
+    def observe(self, value: float) -> None:
+        """ Add value """
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, share: float) -> float:
+        """ Percentile of the latest values, share is from 0 to 1 """
+        if len(self.samples) == 0:
+            return 0.0
+        ordered: typing.List[float] = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+    def to_dict(self) -> typing.Dict[str, float]:
+        """ Summary as json-friendly dict """
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else 0.0,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+        }
+
+
+class Metrics:
+    """Named counters and summaries of one process"""
+
+    def __init__(self) -> None:
+        self.started: float = time.time()
+        self.counters: typing.Counter[str] = collections.Counter()
+        self.summaries: typing.Dict[str, Summary] = {}
+
+    def count(self, name: str, value: int = 1) -> None:
+        """ Increase counter """
+        self.counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        """ Add value to the summary """
+        if name not in self.summaries:
+            self.summaries[name] = Summary()
+        self.summaries[name].observe(value)
+
+    def error(self, err: BaseException) -> None:
+        """ Count error by its type """
+        self.count(f"errors.{type(err).__name__}")
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> typing.Iterator[None]:
+        """ Observe duration of the block in seconds """
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self) -> typing.Dict:
+        """ All metrics as json-friendly dict """
+        return {
+            "started": self.started,
+            "time": time.time(),
+            "counters": dict(self.counters),
+            "summaries": {
+                name: summary.to_dict() for name, summary in self.summaries.items()
+            },
+        }
+
+    def dump(self, filename: str) -> None:
+        """ Atomically write snapshot to the file """
+        tmp_filename: str = filename + ".tmp"
+        with open(tmp_filename, "w", encoding="utf8") as file:
+            json.dump(self.snapshot(), file, indent=1)
+        os.replace(tmp_filename, filename)
+
+    def check_slo(self, name: str, limit: float) -> bool:
+        """Warns when 95th percentile of the summary is over the limit
+
+        Returns:
+            bool: True if the objective is met
+        """
+        if name not in self.summaries:
+            return True
+        p95: float = self.summaries[name].percentile(0.95)
+        if p95 <= limit:
+            return True
+        logging.warning("SLO is violated: p95 of %s is %.1f s, limit %.1f s", name, p95, limit)
+        return False
+
+
+METRICS = Metrics()
+
+
+def count_glpi_request(response: typing.Any, *args: typing.Any, **kwargs: typing.Any) -> None:
+    """ requests response hook: count GLPI calls by endpoint (ids are left out) """
+    parts: typing.List[str] = response.request.path_url.split("?")[0].split("/")
+    if "apirest.php" in parts:
+        parts = parts[parts.index("apirest.php") + 1 :]
+    endpoint: str = "/".join(part for part in parts if part and not part.isdigit())
+    METRICS.count("glpi_requests")
+    METRICS.count(f"glpi_requests.{endpoint}")
+
+
+async def reporter(filename: str, period: float, lag_slo: float, lag: str = LAG) -> None:
+    """ Dumps metrics and checks notification lag every period seconds """
+    while True:
+        await asyncio.sleep(period)
+        METRICS.check_slo(lag, lag_slo)
+        try:
+            METRICS.dump(filename)
+        except OSError as err:
+            logging.error("Metrics are not saved: %s", err)
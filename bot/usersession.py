@@ -1,6 +1,9 @@
 """Module for UserSession class"""
 import logging
-from typing import Any, Dict, List, Optional, Union
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
 import html2text
 import html2markdown
 
@@ -17,6 +20,8 @@ GLPI_ID = "glpi_id"
 TICKET = "ticket"
 USER = "user"
 SOLUTION = "itilsolution"
+LOG = "Log"
+LOG_PAGE_SIZE = 20
 TICKET_ID = "2"
 REQUEST_USER_ID = "4"
 TICKET_STATUS = "12"
@@ -24,12 +29,127 @@ TICKET_NAME = "1"
 TICKET_LAST_UPDATE = "19"
 CLOSED_TICKED_STATUS = "6"
 ASSIGNED_TO = "5"
+REQUESTERS = "requesters"
+SEARCH_PAGE_SIZE = 500
+DETAIL_BATCH_SIZE = 50
+SOLUTION_WORKERS = 4
+SOLUTION_RANGE = 1000
+SOLUTION_CACHE_SIZE = 10000
+
+# ticket id -> (number of solutions, text of the last one)
+_solution_cache: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+_solution_cache_lock = threading.Lock()
 
 
 class StupidError(Exception):
     """Exception raised by this module."""
 
 
+def to_int(value: Union[str, int, list, None]) -> int:
+    """Search returns numbers either as int or as str
+
+    Args:
+        value (Union[str, int, list, None]): value of the field
+
+    Raises:
+        ValueError: the value is not a number
+
+    Returns:
+        int: the number
+    """
+    if isinstance(value, (str, int)):
+        return int(value)
+    raise ValueError(f"not a number: {value!r}")
+
+
+def to_id_list(value: Union[str, int, list, None]) -> List[int]:
+    """Search returns one id, list of ids or nothing for multi-user fields
+
+    Args:
+        value (Union[str, int, list, None]): value of the field
+
+    Returns:
+        List[int]: glpi ids
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [int(elem) for elem in value if elem is not None]
+    return [int(value)]
+
+
+def search_all(
+    glpi: glpi_api.GLPI, **kwargs: Any
+) -> List[Dict[str, Union[str, int, list, None]]]:
+    """Ticket search that reads every page, not only the first one
+
+    Args:
+        glpi (glpi_api.GLPI): open GLPI session
+        kwargs: search parameters
+
+    Returns:
+        List[Dict[str, Union[str, int, list, None]]]: found rows
+    """
+    result: List[Dict[str, Union[str, int, list, None]]] = []
+    start: int = 0
+    while True:
+        try:
+            page: List[Dict[str, Union[str, int, list, None]]] = glpi.search(
+                TICKET, range=f"{start}-{start + SEARCH_PAGE_SIZE - 1}", **kwargs
+            )
+        except glpi_api.GLPIError as err:
+            # The previous page was the last one and it was full
+            if start > 0 and "ERROR_RANGE_EXCEED_TOTAL" in str(err):
+                break
+            raise
+        result.extend(page)
+        if len(page) < SEARCH_PAGE_SIZE:
+            break
+        start += SEARCH_PAGE_SIZE
+    return result
+
+
+def _read_last_solution(glpi: glpi_api.GLPI, ticket_id: int) -> str:
+    """Last solution of the ticket, new solution rows are read only when
+    the ticket is already in the cache
+
+    Args:
+        glpi (glpi_api.GLPI): open GLPI session
+        ticket_id (int): ticket id
+
+    Returns:
+        str: solution text
+    """
+    with _solution_cache_lock:
+        count, text = _solution_cache.get(ticket_id, (0, ""))
+    try:
+        solution: List[Dict] = glpi.get_sub_items(
+            TICKET,
+            ticket_id,
+            SOLUTION,
+            get_hateoas=False,
+            range=f"{count}-{count + SOLUTION_RANGE - 1}",
+        )
+    except glpi_api.GLPIError as err:
+        # Nothing after the cached rows (or no solutions at all)
+        if "ERROR_RANGE_EXCEED_TOTAL" in str(err):
+            solution = []
+        else:
+            raise
+    logging.info("solution of %s = %s", ticket_id, solution)
+    if len(solution) > 0:
+        count += len(solution)
+        text = html2markdown.convert(
+            html2text.html2text(str(solution[-1].get("content")))
+        )
+    with _solution_cache_lock:
+        _solution_cache[ticket_id] = (count, text)
+        _solution_cache.move_to_end(ticket_id)
+        while len(_solution_cache) > SOLUTION_CACHE_SIZE:
+            _solution_cache.popitem(last=False)
+    return text
+
+
 class UserSession:
     """General class for user"""
 
@@ -68,6 +188,8 @@ class UserSession:
 
         self.state = state
         data: Dict = await self.state.get_data()
+        # Credentials as they were before the GLPI call
+        read: Dict[str, Any] = {LOGIN: data.get(LOGIN, None), PASSWORD: data.get(PASSWORD, None)}
         if password is None:
             pwd_hidden: str = str(None)
         else:
@@ -139,12 +261,9 @@ class UserSession:
                 data[GLPI_ID] = self.check_cred()
             except glpi_api.GLPIError:
                 data[LOGGED_IN] = False
-                try:
-                    del data[GLPI_ID]
-                except KeyError:
-                    pass
+                data[GLPI_ID] = None
                 if flag_data_changed:
-                    await state.set_data(data=data)
+                    await self._save_credentials(read, data)
                 raise
             else:
                 data[LOGGED_IN] = True
@@ -156,7 +275,26 @@ class UserSession:
         # if GLPI_ID in data:
         #     self.glpi_id = data[GLPI_ID]
         if flag_data_changed:
-            await state.set_data(data=data)
+            await self._save_credentials(read, data)
+
+    async def _save_credentials(self, read: Dict[str, Any], data: Dict) -> None:
+        """Write login, password and the result of their check, unless the
+        credentials changed while GLPI was asked: a /logout or another login
+        attempt made meanwhile must not be overwritten by stale data
+
+        Args:
+            read (Dict[str, Any]): login and password read before the check
+            data (Dict): data with the new credentials and the check result
+
+        Raises:
+            glpi_api.GLPIError: the credentials changed meanwhile
+        """
+        fields: Dict[str, Any] = {
+            key: data[key] for key in (LOGIN, PASSWORD, GLPI_ID, LOGGED_IN) if key in data
+        }
+        if not await self.compare_and_set_fields(read, fields):
+            logging.warning("UserSession: credentials of %d changed during the check", self.user_id)
+            raise glpi_api.GLPIError("credentials changed during the check")
 
     def __repr__(self) -> str:
         return (
@@ -202,7 +340,7 @@ class UserSession:
         raise glpi_api.GLPIError
 
     async def add_field(self, key: str, data: str) -> None:
-        """Add datafield to user_id in database
+        """Add datafield to user_id in database with one write
 
         Args:
             key (str): key to add
@@ -222,18 +360,47 @@ class UserSession:
         Returns:
             str: field value
         """
+        return (await self.pop_fields(key, default=default))[key]
 
+    async def pop_fields(self, *keys: str, default: str = "") -> Dict[str, str]:
+        """Delete several fields from data with one write and return their values
+
+        Args:
+            keys (str): keys to delete
+            default (str, optional): default value if a key does not exist. Defaults to "".
+
+        Returns:
+            Dict[str, str]: field values by key
+        """
         if self.state is None:
             raise StupidError("self.state = None")
-        data = await self.state.get_data()
-        if key not in data:
-            logging.warning("pop_field: there is no {key} in {data}")
-            return default
-        result = data[key]
-        del data[key]
-        await self.state.set_data(data)
+        result: Dict[str, Any] = await self.state.storage.pop_data(
+            chat=self.state.chat, user=self.state.user, keys=keys
+        )
+        for key, value in result.items():
+            if value is None:
+                logging.warning("pop_fields: there is no %s in data", key)
+                result[key] = default
         return result
 
+    async def compare_and_set_fields(
+        self, expected: Dict[str, Any], fields: Dict[str, Any]
+    ) -> bool:
+        """Set fields only if data still has the expected values
+
+        Args:
+            expected (Dict[str, Any]): values to compare, None if the key must be missing
+            fields (Dict[str, Any]): values to set
+
+        Returns:
+            bool: True if fields are set
+        """
+        if self.state is None:
+            raise StupidError("self.state = None")
+        return await self.state.storage.compare_and_update_data(
+            chat=self.state.chat, user=self.state.user, expected=expected, data=fields
+        )
+
     def get_all_my_tickets(self, open_only: bool, full_info: bool) -> Dict[int, Dict]:
         """
         Return all tickets
@@ -300,6 +467,106 @@ class UserSession:
             return result
         raise glpi_api.GLPIError
 
+    def poll_my_tickets(self, known: Dict[int, Dict]) -> Dict[int, Dict]:
+        """
+        Return all tickets of the user in two phases.
+        First a search asks only for date_mod of every ticket. Then name and status
+        are read with getMultipleItems only for tickets whose date_mod moved or that
+        are not known yet. Other tickets are copied from known
+        """
+        if self.login is None or self.password is None or not self.is_logged_in:
+            raise glpi_api.GLPIError
+        criteria = [
+            {
+                "field": REQUEST_USER_ID,
+                "searchtype": "equals",
+                "value": str(self.glpi_id),
+            }
+        ]
+        with glpi_api.GLPI(
+            url=self.URL,
+            auth=(self.login, self.password),
+            apptoken=config.GLPI_APP_API_KEY,
+        ) as glpi:
+            scan: Dict[int, Union[str, int, list, None]] = {
+                to_int(elem[TICKET_ID]): elem[TICKET_LAST_UPDATE]
+                for elem in search_all(
+                    glpi, criteria=criteria, forcedisplay=[TICKET_LAST_UPDATE], sort=TICKET_ID
+                )
+            }
+            result: Dict[int, Dict] = {}
+            moved: List[int] = []
+            for ticket_id, date_mod in scan.items():
+                if ticket_id in known and known[ticket_id].get("date_mod", None) == date_mod:
+                    result[ticket_id] = dict(known[ticket_id])
+                else:
+                    moved.append(ticket_id)
+            for start in range(0, len(moved), DETAIL_BATCH_SIZE):
+                items: List[Dict] = glpi.get_multiple_items(
+                    *[
+                        {"itemtype": TICKET, "items_id": ticket_id}
+                        for ticket_id in moved[start:start + DETAIL_BATCH_SIZE]
+                    ]
+                )
+                for item in items:
+                    try:
+                        result[int(item["id"])] = {
+                            "status": int(item["status"]),
+                            "name": item["name"],
+                            "date_mod": item["date_mod"],
+                        }
+                    except (TypeError, KeyError, ValueError):
+                        logging.warning("poll_my_tickets: unexpected item %s", item)
+            # A ticket without details is not deleted: its old snapshot stays,
+            # and its date_mod still differs, so the next poll asks for it again
+            for ticket_id in moved:
+                if ticket_id not in result and ticket_id in known:
+                    result[ticket_id] = dict(known[ticket_id])
+            logging.info(
+                "poll_my_tickets: glpi_id = %s tickets = %d details = %d",
+                self.glpi_id,
+                len(scan),
+                len(moved),
+            )
+            return result
+        raise glpi_api.GLPIError
+
+    def get_tickets_modified_since(self, since: Optional[str]) -> Dict[int, Dict]:
+        """
+        Return all tickets visible to the user that were modified after since.
+        Every ticket also has the list of glpi ids of its requesters
+        """
+        if self.login is None or self.password is None or not self.is_logged_in:
+            raise glpi_api.GLPIError
+        criteria = []
+        if since is not None:
+            criteria.append(
+                {"field": TICKET_LAST_UPDATE, "searchtype": "morethan", "value": since}
+            )
+        forcedisplay = [TICKET_NAME, TICKET_STATUS, TICKET_LAST_UPDATE, REQUEST_USER_ID]
+        result: Dict[int, Dict] = {}
+        with glpi_api.GLPI(
+            url=self.URL,
+            auth=(self.login, self.password),
+            apptoken=config.GLPI_APP_API_KEY,
+        ) as glpi:
+            for elem in search_all(
+                glpi,
+                criteria=criteria,
+                forcedisplay=forcedisplay,
+                sort=TICKET_LAST_UPDATE,
+                order="ASC",
+            ):
+                result[to_int(elem[TICKET_ID])] = {
+                    "status": to_int(elem[TICKET_STATUS]),
+                    "name": elem[TICKET_NAME],
+                    "date_mod": elem[TICKET_LAST_UPDATE],
+                    REQUESTERS: to_id_list(elem.get(REQUEST_USER_ID, None)),
+                }
+            logging.info("since = %s modified tickets = %d", since, len(result))
+            return result
+        raise glpi_api.GLPIError
+
     def get_one_ticket(self, ticket_id: int) -> Dict:
         """
         Return one ticket with ticket_id
@@ -323,6 +590,15 @@ class UserSession:
         """
         Return last proposed solution for ticket with ticket_id
         """
+        return self.get_last_solutions([ticket_id]).get(ticket_id, "")
+
+    def get_last_solutions(self, ticket_ids: List[int]) -> Dict[int, str]:
+        """
+        Return last proposed solution of every ticket.
+        Tickets are read concurrently in one GLPI session, every worker thread has
+        its own HTTP session. Solutions are cached by ticket id and their count,
+        so only rows after the cached ones are requested
+        """
         if self.login is None or self.password is None or not self.is_logged_in:
             raise glpi_api.GLPIError
         with glpi_api.GLPI(
@@ -330,15 +606,78 @@ class UserSession:
             auth=(self.login, self.password),
             apptoken=config.GLPI_APP_API_KEY,
         ) as glpi:
-            solution: Dict = glpi.get_sub_items(
-                TICKET, ticket_id, SOLUTION, get_hateoas=False
-            )
-            logging.info("solution = %s", solution)
-            if len(solution) < 1:
-                return ""
-            return html2markdown.convert(
-                html2text.html2text(str(solution[-1].get("content")))
+            worker = threading.local()
+            clones: List[glpi_api.GLPI] = []
+
+            def read(ticket_id: int) -> str:
+                if not hasattr(worker, "glpi"):
+                    worker.glpi = glpi.clone()
+                    clones.append(worker.glpi)
+                return _read_last_solution(worker.glpi, ticket_id)
+
+            try:
+                with ThreadPoolExecutor(max_workers=SOLUTION_WORKERS) as executor:
+                    texts: List[str] = list(executor.map(read, ticket_ids))
+            finally:
+                for clone in clones:
+                    clone.session.close()
+            return dict(zip(ticket_ids, texts))
+        raise glpi_api.GLPIError
+
+    def get_new_log_rows(
+        self, tickets: Dict[int, Tuple[Optional[int], Optional[str]]]
+    ) -> Dict[int, List[Dict]]:
+        """
+        Return history rows of every ticket that came after the last seen row, oldest first.
+        tickets maps ticket id to the last seen log id. When it is unknown,
+        rows are taken after the date of the previous snapshot instead.
+        All tickets are read in one GLPI session, page by page from the newest row
+        """
+        if self.login is None or self.password is None or not self.is_logged_in:
+            raise glpi_api.GLPIError
+        result: Dict[int, List[Dict]] = {}
+        with glpi_api.GLPI(
+            url=self.URL,
+            auth=(self.login, self.password),
+            apptoken=config.GLPI_APP_API_KEY,
+        ) as glpi:
+            for ticket_id, (last_log_id, last_date) in tickets.items():
+                rows: List[Dict] = []
+                start: int = 0
+                while True:
+                    try:
+                        page: List[Dict] = glpi.get_sub_items(
+                            TICKET,
+                            ticket_id,
+                            LOG,
+                            get_hateoas=False,
+                            order="DESC",
+                            range=f"{start}-{start + LOG_PAGE_SIZE - 1}",
+                        )
+                    except glpi_api.GLPIError as err:
+                        if start > 0 and "ERROR_RANGE_EXCEED_TOTAL" in str(err):
+                            break
+                        raise
+                    new_rows: List[Dict] = [
+                        row
+                        for row in page
+                        if (last_log_id is not None and int(row["id"]) > last_log_id)
+                        or (
+                            last_log_id is None
+                            and last_date is not None
+                            and str(row.get("date_mod", "")) > last_date
+                        )
+                    ]
+                    rows.extend(new_rows)
+                    if len(new_rows) < len(page) or len(page) < LOG_PAGE_SIZE:
+                        break
+                    start += LOG_PAGE_SIZE
+                result[ticket_id] = sorted(rows, key=lambda row: int(row["id"]))
+            logging.info(
+                "new log rows: %s",
+                {ticket_id: len(rows) for ticket_id, rows in result.items()},
             )
+            return result
         raise glpi_api.GLPIError
 
     def create_ticket(self, title: str, description: str, urgency: int) -> int:
@@ -409,3 +748,13 @@ class UserSession:
                 },
             )
         raise glpi_api.GLPIError
+
+
+class ServiceSession(UserSession):
+    """GLPI account of the checker. It sees tickets of every requester"""
+
+    def __init__(self) -> None:
+        super().__init__(user_id=0)
+        self.login = config.GLPI_SERVICE_LOGIN
+        self.password = config.GLPI_SERVICE_PASSWORD
+        self.is_logged_in = True
@@ -5,6 +5,7 @@ import logging
 import os
 import re
 import sys
+import typing
 import requests
 
 from dotenv import load_dotenv
@@ -50,10 +51,155 @@ GLPI_APP_API_KEY: str = os.getenv("GLPI_APP_API_KEY", default="")
 
 CHECK_PERIOD = int(os.getenv("CHECK_PERIOD", default="30"))
 
+# Where the checker takes changed tickets from:
+# "user" - one search per telegram user
+# "global" - one search of tickets modified since the last check, made by the service account
+CHECK_FEED: str = os.getenv("CHECK_FEED", default="user").lower()
+if CHECK_FEED not in ("user", "global"):
+    print(
+        f"Unknown CHECK_FEED {CHECK_FEED}. Please use user or global",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+GLPI_SERVICE_LOGIN: str = os.getenv("GLPI_SERVICE_LOGIN", default="")
+GLPI_SERVICE_PASSWORD: str = os.getenv("GLPI_SERVICE_PASSWORD", default="")
+if CHECK_FEED == "global" and (
+    len(GLPI_SERVICE_LOGIN) == 0 or len(GLPI_SERVICE_PASSWORD) == 0
+):
+    print(
+        "CHECK_FEED=global needs a service account. Please provide GLPI_SERVICE_LOGIN and GLPI_SERVICE_PASSWORD",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
+# Read history of changed tickets to report every field transition, not only the last status
+CHECK_HISTORY: bool = os.getenv("CHECK_HISTORY", default="").lower() in ("1", "true", "yes")
+
+# How the checker compares ticket snapshots: "dict" or "vector" (numpy arrays)
+DIFF_ENGINE: str = os.getenv("DIFF_ENGINE", default="dict").lower()
+if DIFF_ENGINE not in ("dict", "vector"):
+    print(
+        f"Unknown DIFF_ENGINE {DIFF_ENGINE}. Please use dict or vector",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
+# Send changes of one check as one message per user instead of one per ticket
+NOTIFY_DIGEST: bool = os.getenv("NOTIFY_DIGEST", default="").lower() in ("1", "true", "yes")
+# How long changes are collected before the digest is sent (in seconds). 0 - every check
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", default="0"))
+if DIGEST_WINDOW < 0:
+    print(f"DIGEST_WINDOW must not be negative, got {DIGEST_WINDOW}", file=sys.stderr)
+    sys.exit(1)
+
+# Status changes are held this long and only the net change is sent (in seconds). 0 - off
+DEBOUNCE_PERIOD = int(os.getenv("DEBOUNCE_PERIOD", default="0"))
+if DEBOUNCE_PERIOD < 0:
+    print(f"DEBOUNCE_PERIOD must not be negative, got {DEBOUNCE_PERIOD}", file=sys.stderr)
+    sys.exit(1)
+
+# Diff engine run next to DIFF_ENGINE only to compare results and cost: "", dict or vector
+SHADOW_ENGINE: str = os.getenv("SHADOW_ENGINE", default="").lower()
+if SHADOW_ENGINE not in ("", "dict", "vector") or SHADOW_ENGINE == DIFF_ENGINE:
+    print(
+        f"Wrong SHADOW_ENGINE {SHADOW_ENGINE}. Please use dict or vector, other than DIFF_ENGINE",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
 _data_dir: str = os.getenv("DATA_DIR", default="/data/")
 os.makedirs(_data_dir, exist_ok=True)
 DB_FILE: str = _data_dir + "db.db"
+SQLITE_FILE: str = _data_dir + "db.sqlite3"
 LOG_FILENAME: str = _data_dir + "log.txt"
+CHECKER_LOG_FILENAME: str = _data_dir + "checker_log.txt"
+OUTBOX_DIR: str = _data_dir + "outbox/"
+METRICS_FILENAME: str = _data_dir + "metrics.json"
+CHECKER_METRICS_FILENAME: str = _data_dir + "checker_metrics.json"
+BACKUP_FILENAME: str = _data_dir + "backup.jsonl"
+
+# How often the bot backs users and tickets up to DATA_DIR (in seconds). 0 - never
+BACKUP_PERIOD = float(os.getenv("BACKUP_PERIOD", default="0"))
+if BACKUP_PERIOD < 0:
+    print(f"BACKUP_PERIOD must not be negative, got {BACKUP_PERIOD}", file=sys.stderr)
+    sys.exit(1)
+
+# How often metrics are written to DATA_DIR (in seconds)
+METRICS_PERIOD = float(os.getenv("METRICS_PERIOD", default="60"))
+# Objective for the time from a change in GLPI to the telegram message (in seconds, 95th percentile)
+LAG_SLO = float(os.getenv("LAG_SLO", default="300"))
+# date_mod of GLPI is the local time of its server: its offset from UTC (in hours).
+# Empty - the server has the same time zone as the bot
+_glpi_utc_offset: str = os.getenv("GLPI_UTC_OFFSET", default="")
+GLPI_UTC_OFFSET: typing.Optional[float] = None
+if _glpi_utc_offset != "":
+    GLPI_UTC_OFFSET = float(_glpi_utc_offset)
+    if not -14 <= GLPI_UTC_OFFSET <= 14:
+        print(f"GLPI_UTC_OFFSET must be within -14..14 hours, got {GLPI_UTC_OFFSET}", file=sys.stderr)
+        sys.exit(1)
+
+# How often bot process looks for notifications produced by the checker (in seconds)
+OUTBOX_POLL_PERIOD = float(os.getenv("OUTBOX_POLL_PERIOD", default="1"))
+
+# Telegram flood limits: messages per second for the whole bot and for one chat
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", default="30"))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", default="1"))
+if NOTIFY_GLOBAL_RATE <= 0 or NOTIFY_CHAT_RATE <= 0:
+    print(
+        "NOTIFY_GLOBAL_RATE and NOTIFY_CHAT_RATE must be positive",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
+# Min time between two GLPI commands of one user (in seconds). 0 - no limit
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", default="2"))
+if THROTTLE_RATE < 0:
+    print(f"THROTTLE_RATE must not be negative, got {THROTTLE_RATE}", file=sys.stderr)
+    sys.exit(1)
+
+# Where users and tickets are kept: "sqlite" (SQLITE_FILE), "vedis" (DB_FILE)
+# or "redis" (REDIS_URL, shared by several bot and checker processes).
+# sqlite is filled from DB_FILE on the first start, see bot/db/migrate_vedis.py
+STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", default="sqlite").lower()
+if STORAGE_BACKEND not in ("vedis", "sqlite", "redis"):
+    print(
+        f"Unknown STORAGE_BACKEND {STORAGE_BACKEND}. Please use vedis, sqlite or redis",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+REDIS_URL: str = os.getenv("REDIS_URL", default="redis://localhost:6379/0")
+
+# Where the regular check of GLPI runs: "separate" - in main_checker.py,
+# "bot" - inside the bot process. A vedis file is locked by the process that opens it
+CHECK_PROCESS: str = os.getenv("CHECK_PROCESS", default="separate").lower()
+if CHECK_PROCESS not in ("bot", "separate"):
+    print(
+        f"Unknown CHECK_PROCESS {CHECK_PROCESS}. Please use bot or separate",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+if CHECK_PROCESS == "separate" and STORAGE_BACKEND == "vedis":
+    print(
+        "CHECK_PROCESS=separate needs STORAGE_BACKEND sqlite or redis: "
+        "the bot and the checker can't open one vedis file at once. "
+        "Remove STORAGE_BACKEND=vedis to move the data to sqlite, "
+        "or set CHECK_PROCESS=bot to run the check inside the bot",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
+# How many user records the bot keeps decoded in memory. 0 - every read goes to the database
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", default="10000"))
+if DB_CACHE_SIZE < 0:
+    print(f"DB_CACHE_SIZE must not be negative, got {DB_CACHE_SIZE}", file=sys.stderr)
+    sys.exit(1)
+
+# Writes of the bot made within this many seconds go to vedis in one transaction.
+# 0 - writes of one event loop tick, negative - every write is its own transaction
+DB_BATCH_WINDOW = float(os.getenv("DB_BATCH_WINDOW", default="0"))
+
+# How long the outbox remembers a notification to drop its repeats (in seconds)
+OUTBOX_KEY_TTL = int(os.getenv("OUTBOX_KEY_TTL", default="86400"))
 
 _log_level: str = os.getenv("LOG_LEVEL", default="").upper()
 LOG_LEVEL: int = logging.INFO
@@ -12,19 +12,31 @@ from aiogram.dispatcher import FSMContext, dispatcher
 from aiogram.utils import executor
 from aiogram.utils.exceptions import NetworkError
 
-from bot.app import checker
+import config
+from bot.app import checker, notifier
 from bot.app.core import dp
 from bot.app.generic import generic, onboarding
 from bot.app.bot_state import Form
+from bot.app.locking import UserLockMiddleware
+from bot.app.throttling import ThrottlingMiddleware, rate_limit
+from bot.db import backup
+from bot.db.storage import NotificationQueue, open_outbox
+from bot import metrics
 
 # TODO add /cancel
 
+# Handlers marked with rate_limit go to GLPI: repeats within THROTTLE_RATE get a notice
+dp.middleware.setup(ThrottlingMiddleware())
+# Handlers of one user run one by one, so they never overwrite each other's data
+dp.middleware.setup(UserLockMiddleware())
+
 
 @dp.callback_query_handler(
     lambda callback_query: callback_query.data
     and callback_query.data.startswith("approve_solution"),
     state="*",
 )
+@rate_limit(config.THROTTLE_RATE)
 async def process_callback_approve_solution(
     callback_query: types.CallbackQuery, state: FSMContext
 ) -> None:
@@ -55,6 +67,7 @@ async def process_callback_approve_solution(
     and callback_query.data.startswith("refuse_solution"),
     state=Form.logged_in,
 )
+@rate_limit(config.THROTTLE_RATE)
 async def process_callback_refuse_solution(
     callback_query: types.CallbackQuery, state: FSMContext
 ) -> None:
@@ -121,6 +134,7 @@ async def process_callback_refuse_solution_wrong_state(
     and callback_query.data.startswith("repeat_ticket"),
     state="*",
 )
+@rate_limit(config.THROTTLE_RATE)
 async def process_callback_repeat_ticket(
     callback_query: types.CallbackQuery, state: FSMContext
 ) -> None:
@@ -203,6 +217,7 @@ async def process_to_enter_login(message: types.Message, state: FSMContext) -> N
 
 
 @dp.message_handler(content_types=types.ContentTypes.TEXT, state=Form.to_enter_password)
+@rate_limit(config.THROTTLE_RATE)
 async def to_enter_password(message: types.Message, state: FSMContext) -> None:
     """Reacts on every text entered with the state Form.to_enter_password"""
     user_id: int = message.from_user.id
@@ -229,6 +244,7 @@ async def to_enter_password(message: types.Message, state: FSMContext) -> None:
 
 
 @dp.message_handler(commands=["Мои"], state=Form.logged_in)
+@rate_limit(config.THROTTLE_RATE)
 async def list_all_tickets(message: types.Message, state: FSMContext) -> None:
     """Reacts on /tickets command in every state"""
     user_id: int = message.from_user.id
@@ -320,6 +336,7 @@ async def to_enter_description(message: types.Message, state: FSMContext) -> Non
 @dp.message_handler(
     content_types=types.ContentTypes.TEXT, state=Form.to_select_priority
 )
+@rate_limit(config.THROTTLE_RATE)
 async def to_select_priority(message: types.Message, state: FSMContext) -> None:
     """Reacts on every text entered with the state Form.to_select_priority"""
     user_id: int = message.from_user.id
@@ -333,6 +350,7 @@ async def to_select_priority(message: types.Message, state: FSMContext) -> None:
 @dp.message_handler(
     content_types=types.ContentTypes.TEXT, state=Form.to_explain_decline
 )
+@rate_limit(config.THROTTLE_RATE)
 async def to_explain_decline(message: types.Message, state: FSMContext) -> None:
     """Reacts on every text entered with the state Form.to_explain_decline"""
     user_id: int = message.from_user.id
@@ -378,8 +396,23 @@ async def non_text_message(message: types.Message, state: FSMContext) -> None:
 
 
 async def on_startup(disp: dispatcher.Dispatcher) -> None:
-    """ Create scheduler to regularly check tickets """
-    asyncio.create_task(checker.scheduler(dbhelper=disp.storage))
+    """ Start delivery of notifications produced by the checker, and the checker itself
+    unless it runs as a separate process """
+    # The checker finds telegram users of a glpi user through this index
+    disp.storage.rebuild_glpi_index()
+    outbox: NotificationQueue = open_outbox()
+    asyncio.create_task(notifier.sender(outbox=outbox, storage=disp.storage))
+    if config.CHECK_PROCESS == "bot":
+        asyncio.create_task(checker.scheduler(dbhelper=disp.storage, outbox=outbox))
+    else:
+        logging.info("Regular check of GLPI is left to main_checker.py")
+    asyncio.create_task(
+        metrics.reporter(config.METRICS_FILENAME, config.METRICS_PERIOD, config.LAG_SLO)
+    )
+    if config.BACKUP_PERIOD > 0:
+        asyncio.create_task(
+            backup.backuper(disp.storage, config.BACKUP_FILENAME, config.BACKUP_PERIOD)
+        )
 
 
 if __name__ == "__main__":
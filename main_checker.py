@@ -0,0 +1,34 @@
+"""
+Main exec file for GLPI checker. It runs apart from the telegram bot and
+hands notifications to it through the outbox.
+"""
+
+import logging
+import asyncio
+import sys
+
+import config
+from bot.app import checker
+from bot.app.logger import init_logging
+from bot.db.storage import open_outbox, open_storage
+
+
+if __name__ == "__main__":
+    init_logging(config.CHECKER_LOG_FILENAME)
+    if config.CHECK_PROCESS != "separate":
+        logging.error("The bot runs the check itself: set CHECK_PROCESS=separate to run the checker")
+        sys.exit(1)
+    logging.info("GLPI checker is started")
+    dbhelper = open_storage()
+    # Users are polled by glpi_id: the index must cover records written before it
+    dbhelper.rebuild_glpi_index()
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(
+            checker.scheduler(dbhelper=dbhelper, outbox=open_outbox())
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(dbhelper.close())
+    logging.info("GLPI checker is closed")